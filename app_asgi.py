@@ -0,0 +1,256 @@
+import asyncio
+import io
+import json
+import logging
+import os
+
+from dotenv import load_dotenv
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+from utils import get_yolo_model, get_caption_model_processor, load_rgb_image, parse_image, parse_image_stream, enable_caption_batching, response_cache_key, COALESCE_REQUESTS
+from util.response_cache import response_cache
+from util.job_queue import JobQueue, QueueFull
+from util.metrics import REGISTRY
+from util.schema import MSGPACK_MIMETYPES, response_mimetype
+
+# Load environment variables
+load_dotenv()
+
+# Read values from .env
+BOX_THRESHOLD = float(os.getenv("BOX_THRESHOLD", 0.05))
+USE_PADDLEOCR = os.getenv("USE_PADDLEOCR", "True").lower() == "true"
+IMGSZ = int(os.getenv("IMGSZ", 640))
+IMAGE_FORMATS = ('PNG', 'JPEG', 'WEBP')
+CAPTION_BATCHING = os.getenv("CAPTION_BATCHING", "True").lower() == "true"
+CAPTION_MAX_BATCH_SIZE = int(os.getenv("CAPTION_MAX_BATCH_SIZE", 16))
+CAPTION_MAX_WAIT_MS = float(os.getenv("CAPTION_MAX_WAIT_MS", 10))
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", 2))
+MAX_QUEUE = int(os.getenv("MAX_QUEUE", 16))
+MAX_JOBS = int(os.getenv("MAX_JOBS", 1024))
+WAIT_TIMEOUT = float(os.getenv("WAIT_TIMEOUT", 120))
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Load models once
+model_path = 'weights/icon_detect_v1_5/model.pt'
+yolo_model = get_yolo_model(model_path=model_path)
+caption_model_processor = get_caption_model_processor(
+    model_name="florence2",
+    model_name_or_path="weights/icon_caption_florence"
+)
+if CAPTION_BATCHING:
+    # one scheduler owns the caption model and batches crops across the inference workers
+    enable_caption_batching(caption_model_processor, max_batch_size=CAPTION_MAX_BATCH_SIZE, max_wait_ms=CAPTION_MAX_WAIT_MS)
+
+
+def parse_kwargs(output_image, image_format, image_quality):
+    return dict(
+        use_paddleocr=USE_PADDLEOCR,
+        BOX_TRESHOLD=BOX_THRESHOLD,
+        caption_model_processor=caption_model_processor,
+        imgsz=IMGSZ,
+        output_image=output_image,
+        image_format=image_format,
+        image_quality=image_quality
+    )
+
+
+def lookup_cached(image_bytes, output_image, image_format, image_quality):
+    """ Decode the upload and look it up in the response cache, off the event loop.
+        Returns (decoded image, key or None when neither the cache nor coalescing is enabled, cached result, cache status).
+    """
+    pil_image = load_rgb_image(io.BytesIO(image_bytes))
+    if not response_cache.enabled and not COALESCE_REQUESTS:
+        return pil_image, None, None, 'bypass'
+    cache_key = response_cache_key(pil_image, yolo_model, **parse_kwargs(output_image, image_format, image_quality))
+    if not response_cache.enabled:
+        return pil_image, cache_key, None, 'bypass'
+    result, tier = response_cache.get(cache_key)
+    return pil_image, cache_key, result, tier or 'miss'
+
+
+def run_parse(pil_image, cache_key, output_image, image_format, image_quality, sink=None):
+    """ One parse job, run on an inference worker thread: OCR/detection/captioning of the decoded upload.
+        sink: streaming job, called with every parse_image_stream event instead of returning a result
+    """
+    if sink is not None:
+        try:
+            for event in parse_image_stream(pil_image, yolo_model, caption_model_processor=caption_model_processor,
+                                            use_paddleocr=USE_PADDLEOCR, BOX_TRESHOLD=BOX_THRESHOLD, imgsz=IMGSZ):
+                sink(event)
+        except Exception:
+            sink({'event': 'error', 'error': 'Internal server error'})
+            raise
+        return None
+    result = parse_image(pil_image, yolo_model, return_result=True, **parse_kwargs(output_image, image_format, image_quality))
+    if cache_key is not None and response_cache.enabled:
+        response_cache.put(cache_key, result)
+    return result
+
+
+jobs = JobQueue(run_parse, workers=INFERENCE_WORKERS, max_queue=MAX_QUEUE, max_jobs=MAX_JOBS)
+
+
+def error_response(message, status_code, retry_after=None):
+    headers = {'Retry-After': str(retry_after)} if retry_after is not None else None
+    return JSONResponse({'error': message}, status_code=status_code, headers=headers)
+
+
+def cache_headers(cache_status):
+    """ X-Cache: HIT (with X-Cache-Tier: memory or disk), COALESCED, MISS or BYPASS. """
+    if cache_status in ('memory', 'disk'):
+        return {'X-Cache': 'HIT', 'X-Cache-Tier': cache_status}
+    return {'X-Cache': cache_status.upper()}
+
+
+def result_response(request, result, include_image=False, extra=None, cache_status=None):
+    """ JSON by default, msgpack (util.schema.ParseResult.to_msgpack) when the Accept header prefers it.
+        cache_status: from lookup_cached, None for a parsed result
+    """
+    cache_status = cache_status or ('miss' if response_cache.enabled else 'bypass')
+    mimetype = response_mimetype(request.headers.get('accept'))
+    if mimetype in MSGPACK_MIMETYPES:
+        return Response(result.to_msgpack(include_image=include_image, extra=extra), media_type=mimetype,
+                        headers=cache_headers(cache_status))
+    response = result.to_dict(include_image=include_image)
+    # kept for clients of the line based format
+    response['parsed_content'] = '\n'.join(result.parsed_content_list())
+    response.update(extra or {})
+    return JSONResponse(response, headers=cache_headers(cache_status))
+
+
+def job_status(job):
+    return {'job_id': job.id, 'status': job.status}
+
+
+async def process_image(request):
+    """
+    Same form fields and response as app_gpu's /process_image, plus `wait`:
+    with wait=false the job id is returned at once (202) and the result is polled at /jobs/{job_id}.
+    Responds 429 with Retry-After when the job queue is full, and 503 with the job id when the result
+    takes longer than WAIT_TIMEOUT seconds. Results found in the response cache are returned at once,
+    without a job and regardless of wait, with X-Cache: HIT. An upload identical to a job still queued or
+    running attaches to that job (same job id, X-Cache: COALESCED) instead of queueing a duplicate.
+    """
+    form = await request.form()
+    uploaded_file = form.get('file')
+    if uploaded_file is None or isinstance(uploaded_file, str):
+        return error_response('No file provided', 400)
+
+    output_image = form.get('output_image', 'false').lower() == 'true'
+    image_format = form.get('image_format', 'PNG').upper()
+    image_quality = form.get('image_quality')
+    wait = form.get('wait', 'true').lower() == 'true'
+    if image_format not in IMAGE_FORMATS:
+        return error_response(f'image_format must be one of {", ".join(IMAGE_FORMATS)}', 400)
+    try:
+        image_quality = int(image_quality) if image_quality else None
+    except ValueError:
+        return error_response('image_quality must be an integer', 400)
+
+    image_bytes = await uploaded_file.read()
+    try:
+        pil_image, cache_key, result, cache_status = await asyncio.to_thread(
+            lookup_cached, image_bytes, output_image, image_format, image_quality)
+    except Exception:
+        logger.exception("Error decoding image")
+        return error_response('Internal server error', 500)
+    if result is not None:
+        return result_response(request, result, include_image=output_image, cache_status=cache_status)
+
+    try:
+        if COALESCE_REQUESTS:
+            job, coalesced = jobs.submit_coalesced(cache_key, pil_image, cache_key, output_image, image_format, image_quality)
+        else:
+            job, coalesced = jobs.submit(pil_image, cache_key, output_image, image_format, image_quality), False
+    except QueueFull as e:
+        return error_response('Too many requests queued, retry later', 429, retry_after=e.retry_after)
+    if coalesced:
+        logger.info("Coalesced request into job %s (%d attached)", job.id, job.coalesced)
+
+    if not wait:
+        headers = dict(cache_headers('coalesced'), Location=f'/jobs/{job.id}') if coalesced else {'Location': f'/jobs/{job.id}'}
+        return JSONResponse(job_status(job), status_code=202, headers=headers)
+    try:
+        # shielded: a timed out request leaves the job running, its result can still be polled
+        result = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(job.future)), WAIT_TIMEOUT)
+    except asyncio.TimeoutError:
+        return JSONResponse(dict(job_status(job), error='Timed out waiting for the result, poll the job instead'),
+                            status_code=503, headers={'Retry-After': str(jobs.retry_after()), 'Location': f'/jobs/{job.id}'})
+    except Exception:
+        logger.exception("Error processing image")
+        return error_response('Internal server error', 500)
+    return result_response(request, result, include_image=result.image is not None, cache_status='coalesced' if coalesced else None)
+
+
+async def process_image_stream(request):
+    """
+    /process_image as newline-delimited JSON events (see utils.parse_image_stream): the elements as soon
+    as the boxes are known, then one event per caption batch, then "done" (or "error").
+    Queued like /process_image, 429 with Retry-After when the job queue is full.
+    """
+    form = await request.form()
+    uploaded_file = form.get('file')
+    if uploaded_file is None or isinstance(uploaded_file, str):
+        return error_response('No file provided', 400)
+    image_bytes = await uploaded_file.read()
+    try:
+        pil_image = await asyncio.to_thread(load_rgb_image, io.BytesIO(image_bytes))
+    except Exception:
+        logger.exception("Error decoding image")
+        return error_response('Internal server error', 500)
+
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+    try:
+        jobs.submit(pil_image, None, False, 'PNG', None, sink=lambda event: loop.call_soon_threadsafe(events.put_nowait, event))
+    except QueueFull as e:
+        return error_response('Too many requests queued, retry later', 429, retry_after=e.retry_after)
+
+    async def stream():
+        while True:
+            event = await events.get()
+            yield json.dumps(event) + '\n'
+            if event['event'] in ('done', 'error'):
+                return
+
+    return StreamingResponse(stream(), media_type='application/x-ndjson')
+
+
+async def get_job(request):
+    """ Status of a job submitted with wait=false; once done, the same response as /process_image. """
+    job = jobs.get(request.path_params['job_id'])
+    if job is None:
+        return error_response('Unknown or expired job id', 404)
+    if not job.future.done():
+        return JSONResponse(job_status(job), headers={'Retry-After': str(jobs.retry_after())})
+    if job.future.exception() is not None:
+        logger.error("Job %s failed: %s", job.id, job.future.exception())
+        return JSONResponse(dict(job_status(job), error='Internal server error'), status_code=500)
+    result = job.future.result()
+    return result_response(request, result, include_image=result.image is not None, extra=job_status(job))
+
+
+async def health(request):
+    return JSONResponse({'status': 'healthy', 'queued': len(jobs), 'max_queue': jobs.max_queue, 'workers': jobs.workers})
+
+
+async def metrics(request):
+    return Response(REGISTRY.render(), media_type='text/plain; version=0.0.4')
+
+
+app = Starlette(routes=[
+    Route('/process_image', process_image, methods=['POST']),
+    Route('/process_image_stream', process_image_stream, methods=['POST']),
+    Route('/jobs/{job_id}', get_job, methods=['GET']),
+    Route('/health', health, methods=['GET']),
+    Route('/metrics', metrics, methods=['GET']),
+])
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host='0.0.0.0', port=int(os.getenv("SERVER_PORT", 58000)))
@@ -3,13 +3,13 @@ from flasgger import Swagger
 from PIL import Image
 import os
 import logging
-import tempfile
 
 from dotenv import load_dotenv
+from util.metrics import register_flask_metrics
 load_dotenv()
 
 # For OCR
-from utils import check_ocr_box
+from utils import check_ocr_box, load_rgb_image
 
 # Environment variables
 USE_PADDLEOCR = os.getenv("USE_PADDLEOCR", "True").lower() == "true"
@@ -17,6 +17,8 @@ USE_PADDLEOCR = os.getenv("USE_PADDLEOCR", "True").lower() == "true"
 # Initialize Flask app
 app = Flask(__name__)
 swagger = Swagger(app)
+# GET /metrics with per-stage latency histograms, box counts and in-flight requests
+register_flask_metrics(app)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -25,7 +27,7 @@ logger = logging.getLogger(__name__)
 @app.route('/process_image', methods=['POST'])
 def process_image():
     """
-    Process an uploaded image to extract OCR data using a unique temp file path.
+    Process an uploaded image to extract OCR data, entirely in memory.
     ---
     consumes:
       - multipart/form-data
@@ -52,32 +54,21 @@ def process_image():
 
     uploaded_file = request.files['file']
     try:
-        # 1) Load the image in-memory (PIL)
-        pil_image = Image.open(uploaded_file.stream)
+        # Decode the upload once and hand the in-memory image to the OCR stage
+        pil_image = load_rgb_image(uploaded_file.stream)
 
-        # 2) Create a unique temp file
-        with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as tmp:
-            temp_path = tmp.name
-            pil_image.save(tmp, format='PNG')
+        # Run ONLY check_ocr_box to get OCR text
+        (text, ocr_bbox), _ = check_ocr_box(
+            pil_image,
+            display_img=False,
+            output_bb_format='xyxy',
+            use_paddleocr=USE_PADDLEOCR
+        )
 
-        try:
-            # 3) Run ONLY check_ocr_box to get OCR text
-            text, ocr_bbox = check_ocr_box(
-                temp_path,
-                display_img=False,
-                output_bb_format='xyxy',
-                use_paddleocr=USE_PADDLEOCR
-            )
-
-            # 'text' might be the recognized text
-            # If check_ocr_box returns multiple lines, you can join them or structure them
-            # For now, let's just send 'text' directly:
-            return jsonify({'parsed_content': text})
-
-        finally:
-            # 4) Clean up the temp file
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
+        # 'text' might be the recognized text
+        # If check_ocr_box returns multiple lines, you can join them or structure them
+        # For now, let's just send 'text' directly:
+        return jsonify({'parsed_content': text})
 
     except Exception:
         logger.exception("Error processing image")
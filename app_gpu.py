@@ -1,12 +1,16 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
+import io
+import json
 from flasgger import Swagger
 import torch
 from PIL import Image
-from utils import check_ocr_box, get_yolo_model, get_caption_model_processor, get_som_labeled_img
+from utils import get_yolo_model, get_caption_model_processor, load_rgb_image, parse_image_cached, parse_image_stream, parse_images, parse_image_incremental, enable_caption_batching, share_models
+from util.ocr_pool import preload_ocr_engine
 from dotenv import load_dotenv
+from util.metrics import register_flask_metrics
+from util.schema import MSGPACK_MIMETYPES, response_mimetype
 import os
 import logging
-import tempfile  # <-- for unique temp files
 
 # Load environment variables
 load_dotenv()
@@ -16,27 +20,72 @@ BOX_THRESHOLD = float(os.getenv("BOX_THRESHOLD", 0.05))
 IOU_THRESHOLD = float(os.getenv("IOU_THRESHOLD", 0.1))
 USE_PADDLEOCR = os.getenv("USE_PADDLEOCR", "True").lower() == "true"
 IMGSZ = int(os.getenv("IMGSZ", 640))
+IMAGE_FORMATS = ('PNG', 'JPEG', 'WEBP')
+MAX_BATCH_IMAGES = int(os.getenv("MAX_BATCH_IMAGES", 64))
+CAPTION_BATCHING = os.getenv("CAPTION_BATCHING", "True").lower() == "true"
+CAPTION_MAX_BATCH_SIZE = int(os.getenv("CAPTION_MAX_BATCH_SIZE", 16))
+CAPTION_MAX_WAIT_MS = float(os.getenv("CAPTION_MAX_WAIT_MS", 10))
+PRELOAD = os.getenv("PRELOAD", "False").lower() == "true"
 
 # Initialize Flask app
 app = Flask(__name__)
 swagger = Swagger(app)
+# GET /metrics with per-stage latency histograms, box counts and in-flight requests
+register_flask_metrics(app)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Load models once
+if PRELOAD and torch.cuda.is_available():
+    # the master would have to load everything on the CPU: refuse instead of silently giving up GPU captioning
+    raise RuntimeError("PRELOAD=True cannot be used with a CUDA device: forked workers cannot use CUDA once the master "
+                       "initialized it. Set PRELOAD=False to run the models on the GPU, or hide the GPUs with "
+                       "CUDA_VISIBLE_DEVICES= to preload them on the CPU")
 model_path = 'weights/icon_detect_v1_5/model.pt'
 yolo_model = get_yolo_model(model_path=model_path)
 caption_model_processor = get_caption_model_processor(
     model_name="florence2",
     model_name_or_path="weights/icon_caption_florence"
 )
+if CAPTION_BATCHING:
+    # one scheduler owns the caption model and batches crops across concurrent requests
+    enable_caption_batching(caption_model_processor, max_batch_size=CAPTION_MAX_BATCH_SIZE, max_wait_ms=CAPTION_MAX_WAIT_MS)
+if PRELOAD:
+    # gunicorn --preload: loaded once in the master, the forked workers share the weights read-only.
+    # PaddleOCR's native inference engine is not fork-safe, so with it each worker builds its own on first use.
+    ocr_engines = [] if USE_PADDLEOCR else [preload_ocr_engine(use_paddleocr=False)]
+    share_models(yolo_model, caption_model_processor, *ocr_engines)
+
+def result_response(result, include_image=False, extra=None, cache_status=None):
+    """ JSON by default, msgpack (util.schema.ParseResult.to_msgpack) when the Accept header prefers it.
+        cache_status: from parse_image_cached, reported in the X-Cache headers
+    """
+    mimetype = response_mimetype(request.headers.get('Accept'))
+    if mimetype in MSGPACK_MIMETYPES:
+        response = Response(result.to_msgpack(include_image=include_image, extra=extra), mimetype=mimetype)
+    else:
+        body = result.to_dict(include_image=include_image)
+        # kept for clients of the line based format
+        body['parsed_content'] = '\n'.join(result.parsed_content_list())
+        body.update(extra or {})
+        response = jsonify(body)
+    response.headers.update(cache_headers(cache_status))
+    return response
+
+def cache_headers(cache_status):
+    """ X-Cache: HIT (with X-Cache-Tier: memory or disk), COALESCED, MISS or BYPASS. """
+    if cache_status is None:
+        return {}
+    if cache_status in ('memory', 'disk'):
+        return {'X-Cache': 'HIT', 'X-Cache-Tier': cache_status}
+    return {'X-Cache': cache_status.upper()}
 
 @app.route('/process_image', methods=['POST'])
 def process_image():
     """
-    Process an uploaded image to extract OCR data using a unique temp file path.
+    Process an uploaded image to extract OCR data, entirely in memory.
     ---
     consumes:
       - multipart/form-data
@@ -46,62 +95,275 @@ def process_image():
         type: file
         required: true
         description: The image file to process.
+      - in: formData
+        name: output_image
+        type: boolean
+        default: false
+        description: Also return the annotated image. When false nothing is drawn or encoded.
+      - in: formData
+        name: image_format
+        type: string
+        enum: [PNG, JPEG, WEBP]
+        default: PNG
+        description: Encoder of the annotated image.
+      - in: formData
+        name: image_quality
+        type: integer
+        description: Quality of lossy encoders (JPEG, WEBP), 1-100.
+      - in: formData
+        name: session_id
+        type: string
+        description: Screenshots of the same session are parsed incrementally, only the regions changed since the previous frame are parsed again. Not combinable with output_image.
+      - in: formData
+        name: delta
+        type: boolean
+        default: false
+        description: With session_id, also return the elements added and removed since the previous frame.
+      - in: header
+        name: Accept
+        type: string
+        enum: [application/json, application/msgpack]
+        default: application/json
+        description: application/msgpack returns the same fields msgpack encoded, with bbox and confidence packed as float32 arrays (see util.schema).
     responses:
       200:
         description: The OCR data extracted from the image.
         schema:
           type: object
           properties:
+            width:
+              type: integer
+            height:
+              type: integer
+            elements:
+              type: array
+              description: Parsed elements in id order, text boxes first.
+              items:
+                type: object
+                properties:
+                  id:
+                    type: integer
+                  type:
+                    type: string
+                    enum: [text, icon]
+                  bbox:
+                    type: array
+                    items:
+                      type: number
+                    description: xyxy in pixels.
+                  bbox_ratio:
+                    type: array
+                    items:
+                      type: number
+                    description: xyxy as fractions of the image size.
+                  content:
+                    type: string
+                    description: OCR text or icon caption.
+                  confidence:
+                    type: number
+                    description: Detector confidence, null for text boxes.
             parsed_content:
               type: string
-              description: The parsed OCR content from the image.
+              description: The same elements as "Text Box ID i" / "Icon Box ID i" lines.
+            image:
+              type: string
+              description: Base64 annotated image, only when output_image is true.
+            delta:
+              type: object
+              description: Elements added (uid, type, bbox ratio xyxy, content), removed uids and reused count, only when delta is true.
+        headers:
+          X-Cache:
+            type: string
+            description: HIT when served from the response cache (keyed by the decoded pixels and parse parameters), COALESCED when an identical parse was already in progress and its result was shared, MISS, or BYPASS for session requests and a disabled cache.
+          X-Cache-Tier:
+            type: string
+            description: memory or disk, on hits only.
       400:
-        description: Bad Request - No file provided.
+        description: Bad Request - No file provided or invalid output options.
     """
     if 'file' not in request.files:
         return jsonify({'error': 'No file provided'}), 400
 
-    uploaded_file = request.files['file']
+    output_image = request.form.get('output_image', 'false').lower() == 'true'
+    image_format = request.form.get('image_format', 'PNG').upper()
+    image_quality = request.form.get('image_quality')
+    if image_format not in IMAGE_FORMATS:
+        return jsonify({'error': f'image_format must be one of {", ".join(IMAGE_FORMATS)}'}), 400
     try:
-        # 1) Load the image in-memory
-        pil_image = Image.open(uploaded_file.stream)
+        image_quality = int(image_quality) if image_quality else None
+    except ValueError:
+        return jsonify({'error': 'image_quality must be an integer'}), 400
+    session_id = request.form.get('session_id')
+    return_delta = request.form.get('delta', 'false').lower() == 'true'
+    if session_id and output_image:
+        return jsonify({'error': 'output_image is not supported with session_id'}), 400
 
-        # 2) Create a unique temporary file (thread-safe for concurrency)
-        with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as tmp:
-            temp_path = tmp.name
-            pil_image.save(tmp, format='PNG')
+    uploaded_file = request.files['file']
+    try:
+        # Decode the upload once; every stage shares the same in-memory image
+        pil_image = load_rgb_image(uploaded_file.stream)
 
-        # 3) Use that temp file path in your existing OCR functions
-        try:
-            text, ocr_bbox = check_ocr_box(
-                temp_path,
-                display_img=False,
-                output_bb_format='xyxy',
-                use_paddleocr=USE_PADDLEOCR
+        if session_id:
+            # only the regions changed since the previous frame of this session are parsed again
+            result, delta = parse_image_incremental(
+                pil_image,
+                session_id,
+                yolo_model,
+                caption_model_processor=caption_model_processor,
+                use_paddleocr=USE_PADDLEOCR,
+                BOX_TRESHOLD=BOX_THRESHOLD,
+                imgsz=IMGSZ,
+                return_result=True
             )
+            return result_response(result, extra={'delta': delta} if return_delta else None, cache_status='bypass')
+
+        # OCR and icon detection run concurrently, then join for overlap removal and captioning;
+        # re-submitted screens are served from the response cache, and identical concurrent uploads share one parse
+        result, cache_status = parse_image_cached(
+            pil_image,
+            yolo_model,
+            use_paddleocr=USE_PADDLEOCR,
+            BOX_TRESHOLD=BOX_THRESHOLD,
+            caption_model_processor=caption_model_processor,
+            imgsz=IMGSZ,
+            output_image=output_image,
+            image_format=image_format,
+            image_quality=image_quality
+        )
+        if cache_status == 'coalesced':
+            logger.info("Shared the result of an identical parse already in progress")
+        return result_response(result, include_image=output_image, cache_status=cache_status)
+
+    except Exception:
+        logger.exception("Error processing image")  # Print full traceback
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/process_image_stream', methods=['POST'])
+def process_image_stream():
+    """
+    Process an uploaded image and stream the result as newline-delimited JSON events.
+    ---
+    consumes:
+      - multipart/form-data
+    produces:
+      - application/x-ndjson
+    parameters:
+      - in: formData
+        name: file
+        type: file
+        required: true
+        description: The image file to process.
+    responses:
+      200:
+        description: >
+          One JSON object per line. "elements" comes first, as soon as the text and icon boxes are known
+          (width, height and elements as in /process_image, icon contents still null). Then one "captions"
+          event per caption batch as it finishes, with the id and content of the captioned icons. The stream
+          ends with "done" (parsed_content of the complete result), or "error" if the parse failed midway.
+      400:
+        description: Bad Request - No file provided.
+    """
+    if 'file' not in request.files:
+        return jsonify({'error': 'No file provided'}), 400
+    uploaded_file = request.files['file']
+    try:
+        pil_image = load_rgb_image(uploaded_file.stream)
+    except Exception:
+        logger.exception("Error decoding image")
+        return jsonify({'error': 'Internal server error'}), 500
 
-            _, _, parsed_content_list = get_som_labeled_img(
-                temp_path,
+    def generate():
+        try:
+            for event in parse_image_stream(
+                pil_image,
                 yolo_model,
-                BOX_TRESHOLD=BOX_THRESHOLD,
-                output_coord_in_ratio=True,
-                ocr_bbox=ocr_bbox,
                 caption_model_processor=caption_model_processor,
+                use_paddleocr=USE_PADDLEOCR,
+                BOX_TRESHOLD=BOX_THRESHOLD,
                 imgsz=IMGSZ
-            )
+            ):
+                yield json.dumps(event) + '\n'
+        except Exception:
+            # the status line is already sent, the failure is reported in the stream
+            logger.exception("Error streaming image")
+            yield json.dumps({'event': 'error', 'error': 'Internal server error'}) + '\n'
 
-            parsed_content = '\n'.join(parsed_content_list)
-            return jsonify({'parsed_content': parsed_content})
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson',
+                    headers={'X-Accel-Buffering': 'no'})
 
-        finally:
-            # 4) Clean up the temp file
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
+@app.route('/process_batch', methods=['POST'])
+def process_batch():
+    """
+    Process many uploaded images in one request, with shared detection and caption batches.
+    ---
+    consumes:
+      - multipart/form-data
+    parameters:
+      - in: formData
+        name: files
+        type: file
+        required: true
+        description: The image files to process, repeat the field once per image.
+    responses:
+      200:
+        description: One result per uploaded file, in upload order.
+        schema:
+          type: object
+          properties:
+            results:
+              type: array
+              items:
+                type: object
+                properties:
+                  filename:
+                    type: string
+                  elements:
+                    type: array
+                    description: Parsed elements of this image, same fields as /process_image.
+                    items:
+                      type: object
+                  parsed_content:
+                    type: string
+                    description: The parsed content of this image.
+                  error:
+                    type: string
+                    description: Set instead of parsed_content when this image failed.
+      400:
+        description: Bad Request - No files provided or too many files.
+    """
+    uploaded_files = request.files.getlist('files')
+    if not uploaded_files:
+        return jsonify({'error': 'No files provided'}), 400
+    if len(uploaded_files) > MAX_BATCH_IMAGES:
+        return jsonify({'error': f'At most {MAX_BATCH_IMAGES} files per batch'}), 400
 
+    try:
+        # raw bytes are decoded in parallel inside parse_images
+        images = [io.BytesIO(uploaded_file.read()) for uploaded_file in uploaded_files]
+        results = parse_images(
+            images,
+            yolo_model,
+            caption_model_processor=caption_model_processor,
+            use_paddleocr=USE_PADDLEOCR,
+            BOX_TRESHOLD=BOX_THRESHOLD,
+            imgsz=IMGSZ,
+            output_image=False,
+            return_result=True
+        )
     except Exception:
-        logger.exception("Error processing image")  # Print full traceback
+        logger.exception("Error processing batch")
         return jsonify({'error': 'Internal server error'}), 500
 
+    response = []
+    for uploaded_file, result in zip(uploaded_files, results):
+        if isinstance(result, Exception):
+            logger.error("Error processing %s: %s", uploaded_file.filename, result)
+            response.append({'filename': uploaded_file.filename, 'error': str(result)})
+        else:
+            response.append(dict(result.to_dict(include_image=False), filename=uploaded_file.filename,
+                                 parsed_content='\n'.join(result.parsed_content_list())))
+    return jsonify({'results': response})
+
 if __name__ == '__main__':
     # For local debugging only. In production, use gunicorn or another WSGI server.
     app.run(host='0.0.0.0', port=58090, threaded=True)
\ No newline at end of file
@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+"""
+Stage-level latency benchmark of the OmniParser pipeline.
+
+Runs every image of one or more directories through the pipeline for each point of a
+parameter grid and reports p50/p95 wall time per stage (decode, ocr, yolo, remove_overlap,
+caption, annotate, encode), peak RSS (per configuration on linux) and box counts. Results
+are written as JSON so runs can be compared across commits:
+
+    python benchmark.py --images imgs --imgsz 640 1280 --use-paddleocr true false --output bench.json
+    python benchmark.py --images imgs --output new.json --compare bench.json
+
+With --yolo-backend onnx / onnx-int8 each configuration also reports detector parity with the
+torch model: the share of torch boxes matched by a box of the same image at IoU >= 0.5, and
+the mean IoU of those matches.
+
+--caption-precision / --caption-decoding compare the reduced-precision CPU caption modes. When the
+grid includes the fp32 + beam reference, every other caption mode reports its captions' agreement
+with the reference on the same boxes (exact match rate and mean text similarity):
+
+    python benchmark.py --images imgs --caption-precision fp32 int8 bf16 --caption-decoding beam greedy
+"""
+import argparse
+import difflib
+import itertools
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+from torchvision.ops import box_convert, box_iou
+
+from utils import (load_rgb_image, check_ocr_box, predict_yolo, remove_overlap, get_parsed_content_icon,
+                   annotate, encode_image, get_yolo_model, get_caption_model_processor)
+
+
+STAGES = ['decode', 'ocr', 'yolo', 'remove_overlap', 'caption', 'annotate', 'encode']
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.webp')
+
+
+def str2bool(value):
+    return str(value).lower() in ('true', '1', 'yes')
+
+
+def reset_peak_rss():
+    """ Reset the peak RSS of this process to its current RSS (linux >= 4.0), so each configuration reports its
+        own peak. Returns False where that is not supported and peak_rss_mb stays the peak of the whole run.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    # VmHWM follows reset_peak_rss, ru_maxrss is the lifetime peak (in KB on linux and in bytes on macOS)
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def list_images(directories):
+    paths = []
+    for directory in directories:
+        for name in sorted(os.listdir(directory)):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                paths.append(os.path.join(directory, name))
+    return paths
+
+
+def run_pipeline(image_path, yolo_model, caption_model_processor, params):
+    """ Run the get_som_labeled_img pipeline stage by stage, returns (timings in seconds, box counts)
+    """
+    timings = {}
+
+    @contextmanager
+    def stage(name):
+        start = time.perf_counter()
+        yield
+        timings[name] = time.perf_counter() - start
+
+    with stage('decode'):
+        image = load_rgb_image(image_path)
+    with stage('ocr'):
+        (text, ocr_bbox), _ = check_ocr_box(image, display_img=False, output_bb_format='xyxy', use_paddleocr=params['use_paddleocr'])
+    with stage('yolo'):
+        xyxy, logits, _ = predict_yolo(model=yolo_model, image_path=image, box_threshold=params['box_threshold'], imgsz=params['imgsz'], sliced=params['sliced'])
+
+    image_source = np.asarray(image)
+    h, w, _ = image_source.shape
+    xyxy = xyxy / torch.Tensor([w, h, w, h]).to(xyxy.device)
+    ocr_bbox_ratio = (torch.tensor(ocr_bbox) / torch.Tensor([w, h, w, h])).tolist() if ocr_bbox else None
+    with stage('remove_overlap'):
+        filtered_boxes = remove_overlap(boxes=xyxy, iou_threshold=params['iou_threshold'], ocr_bbox=ocr_bbox_ratio)
+
+    with stage('caption'):
+        captions = []
+        if caption_model_processor is not None:
+            captions = get_parsed_content_icon(filtered_boxes, ocr_bbox_ratio, image_source, caption_model_processor, cache=params['caption_cache'])
+
+    cxcywh = box_convert(boxes=filtered_boxes, in_fmt="xyxy", out_fmt="cxcywh")
+    with stage('annotate'):
+        annotated_frame, _ = annotate(image_source=image_source, boxes=cxcywh, logits=logits, phrases=list(range(len(cxcywh))), text_scale=0.4)
+    with stage('encode'):
+        encode_image(annotated_frame, image_format=params['image_format'])
+
+    counts = {'ocr_boxes': len(text), 'yolo_boxes': len(xyxy), 'filtered_boxes': len(filtered_boxes), 'captions': len(captions)}
+    return timings, counts, captions
+
+
+def detector_parity(image_paths, yolo_model, reference_model, params, match_iou=0.5):
+    """ Agreement of yolo_model's detections with reference_model's (torch) on the same images """
+    matched, total, ious = 0, 0, []
+    for image_path in image_paths:
+        image = load_rgb_image(image_path)
+        kwargs = dict(box_threshold=params['box_threshold'], imgsz=params['imgsz'], sliced=params['sliced'])
+        reference, _, _ = predict_yolo(model=reference_model, image_path=image, **kwargs)
+        boxes, _, _ = predict_yolo(model=yolo_model, image_path=image, **kwargs)
+        total += len(reference)
+        if len(reference) and len(boxes):
+            best = box_iou(reference.float().cpu(), boxes.float().cpu()).max(dim=1).values
+            matched += int((best >= match_iou).sum())
+            ious.extend(best[best >= match_iou].tolist())
+    return {'match_rate': matched / total if total else 1.0, 'mean_iou': float(np.mean(ious)) if ious else None}
+
+
+def caption_agreement(records, reference_records):
+    """ Captions of the first run of every image against the reference configuration's, crop by crop """
+    reference = {}
+    for record in reference_records:
+        reference.setdefault(record['image'], record['captions'])
+    exact, similarities = 0, []
+    seen = set()
+    for record in records:
+        if record['image'] in seen or record['image'] not in reference:
+            continue
+        seen.add(record['image'])
+        for caption, expected in zip(record['captions'], reference[record['image']]):
+            exact += caption == expected
+            similarities.append(difflib.SequenceMatcher(None, caption, expected).ratio())
+    if not similarities:
+        return None
+    return {'exact_match': exact / len(similarities), 'mean_similarity': float(np.mean(similarities)), 'captions': len(similarities)}
+
+
+def summarize(records):
+    summary = {}
+    for stage_name in STAGES + ['total']:
+        values = np.array([r['timings'][stage_name] for r in records])
+        summary[stage_name] = {'p50': float(np.percentile(values, 50)), 'p95': float(np.percentile(values, 95))}
+    return summary
+
+
+def print_summary(config_results, baseline=None):
+    for result in config_results:
+        print(f"\n{json.dumps(result['params'])}  peak_rss={result['peak_rss_mb']:.0f}MB  "
+              f"mean boxes ocr/yolo/filtered={result['mean_counts']['ocr_boxes']:.0f}/"
+              f"{result['mean_counts']['yolo_boxes']:.0f}/{result['mean_counts']['filtered_boxes']:.0f}")
+        if result.get('parity') is not None:
+            parity = result['parity']
+            mean_iou = 'n/a' if parity['mean_iou'] is None else f"{parity['mean_iou']:.3f}"
+            print(f"  parity vs torch: match_rate={parity['match_rate']:.1%}  mean_iou={mean_iou}")
+        if result.get('caption_quality') is not None:
+            quality = result['caption_quality']
+            print(f"  captions vs fp32/beam: exact_match={quality['exact_match']:.1%}  "
+                  f"mean_similarity={quality['mean_similarity']:.3f}  ({quality['captions']} captions)")
+        reference = None
+        if baseline is not None:
+            reference = next((r for r in baseline['configs'] if r['params'] == result['params']), None)
+        for stage_name, stats in result['summary'].items():
+            line = f"  {stage_name:<15} p50={stats['p50'] * 1000:9.1f}ms  p95={stats['p95'] * 1000:9.1f}ms"
+            if reference is not None and reference['summary'][stage_name]['p50'] > 0:
+                change = stats['p50'] / reference['summary'][stage_name]['p50'] - 1
+                line += f"  p50 {change:+.1%} vs {baseline['commit'] or 'baseline'}"
+            print(line)
+
+
+def print_caption_report(config_results):
+    """ Markdown table of the caption modes of the run: caption stage latency and agreement with fp32/beam """
+    rows = [r for r in config_results if r['params'].get('caption_precision') is not None]
+    if len({(r['params']['caption_precision'], r['params']['caption_decoding']) for r in rows}) < 2:
+        return
+    print("\n| precision | decoding | caption p50 | caption p95 | total p50 | exact match | mean similarity |")
+    print("|---|---|---|---|---|---|---|")
+    for result in rows:
+        params, summary, quality = result['params'], result['summary'], result.get('caption_quality')
+        if quality is not None:
+            agreement = f"{quality['exact_match']:.1%} | {quality['mean_similarity']:.3f}"
+        elif params['caption_precision'] in ('fp32', 'fp16') and params['caption_decoding'] == 'beam':
+            agreement = "reference | reference"
+        else:
+            agreement = "n/a | n/a"
+        print(f"| {params['caption_precision']} | {params['caption_decoding']} | {summary['caption']['p50'] * 1000:.0f}ms | "
+              f"{summary['caption']['p95'] * 1000:.0f}ms | {summary['total']['p50'] * 1000:.0f}ms | {agreement} |")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', nargs='+', default=['imgs'], help='directories of screenshots')
+    parser.add_argument('--box-threshold', nargs='+', type=float, default=[0.05])
+    parser.add_argument('--iou-threshold', nargs='+', type=float, default=[0.1])
+    parser.add_argument('--imgsz', nargs='+', type=int, default=[640])
+    parser.add_argument('--use-paddleocr', nargs='+', type=str2bool, default=[True])
+    parser.add_argument('--sliced', nargs='+', type=str2bool, default=[False], help='sliced icon detection of large screens')
+    parser.add_argument('--yolo-backend', nargs='+', choices=['torch', 'onnx', 'onnx-int8'], default=['torch'],
+                        help='icon detector runtime, the onnx models are exported next to --yolo-model on first use')
+    parser.add_argument('--yolo-model', default='weights/icon_detect_v1_5/model.pt')
+    parser.add_argument('--caption-model', default='weights/icon_caption_florence', help="path of the florence2 caption model, 'none' to skip captioning")
+    parser.add_argument('--caption-precision', nargs='+', choices=['fp32', 'int8', 'bf16'], default=[None],
+                        help='caption model precision on CPU, default CAPTION_PRECISION')
+    parser.add_argument('--caption-decoding', nargs='+', choices=['beam', 'greedy'], default=[None],
+                        help='caption decoding profile, default CAPTION_DECODING')
+    parser.add_argument('--caption-cache', action='store_true', help='keep the caption cache enabled (measures cache hits on repeats)')
+    parser.add_argument('--image-format', default='PNG')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per image and configuration')
+    parser.add_argument('--warmup', type=int, default=1, help='untimed runs before each configuration')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare', help='previous results file to compare p50 against')
+    args = parser.parse_args()
+
+    image_paths = list_images(args.images)
+    if not image_paths:
+        parser.error(f'no images found in {args.images}')
+
+    load_start = time.perf_counter()
+    yolo_models = {backend: get_yolo_model(model_path=args.yolo_model, backend=backend) for backend in args.yolo_backend}
+    caption_models = {precision: None for precision in args.caption_precision}
+    if args.caption_model.lower() != 'none':
+        caption_models = {precision: get_caption_model_processor(model_name="florence2", model_name_or_path=args.caption_model, precision=precision)
+                          for precision in args.caption_precision}
+    model_load_time = time.perf_counter() - load_start
+
+    caption_cache = None
+    if args.caption_cache:
+        from util.caption_cache import caption_cache
+
+    reference_model = None
+    if any(backend != 'torch' for backend in args.yolo_backend):
+        # not timed, only the reference for the parity check
+        reference_model = yolo_models.get('torch') or get_yolo_model(model_path=args.yolo_model, backend='torch')
+
+    config_results = []
+    grid = itertools.product(args.yolo_backend, args.box_threshold, args.iou_threshold, args.imgsz, args.use_paddleocr, args.sliced,
+                             args.caption_precision, args.caption_decoding)
+    for yolo_backend, box_threshold, iou_threshold, imgsz, use_paddleocr, sliced, caption_precision, caption_decoding in grid:
+        params = {'yolo_backend': yolo_backend, 'box_threshold': box_threshold, 'iou_threshold': iou_threshold, 'imgsz': imgsz,
+                  'use_paddleocr': use_paddleocr, 'sliced': sliced}
+        yolo_model = yolo_models[yolo_backend]
+        caption_model_processor = caption_models[caption_precision]
+        if caption_model_processor is not None:
+            # the precision actually used (bf16 may fall back to fp32), decoding only changes generate arguments
+            caption_model_processor = dict(caption_model_processor, decoding=caption_decoding or caption_model_processor['decoding'])
+            params.update(caption_precision=caption_model_processor['precision'], caption_decoding=caption_model_processor['decoding'])
+        run_params = dict(params, caption_cache=caption_cache, image_format=args.image_format)
+        rss_scope = 'config' if reset_peak_rss() else 'process'
+        for _ in range(args.warmup):
+            run_pipeline(image_paths[0], yolo_model, caption_model_processor, run_params)
+        records = []
+        for image_path in image_paths:
+            for _ in range(args.repeat):
+                timings, counts, captions = run_pipeline(image_path, yolo_model, caption_model_processor, run_params)
+                timings['total'] = sum(timings.values())
+                records.append({'image': image_path, 'timings': timings, 'counts': counts, 'captions': captions})
+        config_results.append({
+            'params': params,
+            'summary': summarize(records),
+            'peak_rss_mb': peak_rss_mb(),
+            'peak_rss_scope': rss_scope,
+            'mean_counts': {k: float(np.mean([r['counts'][k] for r in records])) for k in records[0]['counts']},
+            'parity': detector_parity(image_paths, yolo_model, reference_model, params) if yolo_backend != 'torch' else None,
+            'runs': records,
+        })
+
+    # caption quality of the reduced-precision / greedy modes, against fp32 (fp16 on GPU) beam search on the same boxes
+    for result in config_results:
+        params = result['params']
+        if params.get('caption_precision') is None or (params['caption_precision'] in ('fp32', 'fp16') and params['caption_decoding'] == 'beam'):
+            continue
+        reference = next((r for r in config_results
+                          if r['params'] == dict(params, caption_precision=r['params']['caption_precision'], caption_decoding='beam')
+                          and r['params']['caption_precision'] in ('fp32', 'fp16')), None)
+        if reference is not None:
+            result['caption_quality'] = caption_agreement(result['runs'], reference['runs'])
+
+    results = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'device': 'cuda' if torch.cuda.is_available() else 'cpu',
+        'model_load_time': model_load_time,
+        'images': image_paths,
+        'repeat': args.repeat,
+        'configs': config_results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_summary(config_results, baseline)
+    print_caption_report(config_results)
+    print(f"\nResults written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
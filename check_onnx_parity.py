@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Parity check of the ONNX icon detector (YOLO_BACKEND=onnx / onnx-int8) against the torch model.
+
+Runs both detectors on the screenshots of --images one image at a time, as one mixed-shape batch
+and through predict_yolo_sliced (full frame plus tiles in each call), and matches every box of
+one detector to the box of the other with the highest IoU, in both directions:
+
+    python check_onnx_parity.py --images imgs --yolo-model weights/icon_detect_v1_5/model.pt
+    python check_onnx_parity.py --images imgs --backend onnx-int8
+
+Fails (exit status 1) when, in any mode, fewer than --min-match of the boxes have a match at
+IoU >= --match-iou, when the mean IoU of the matches is below --min-iou, or when matched boxes
+differ in confidence by more than --conf-tol. The defaults depend on the backend: fp32 ONNX must
+agree with torch up to float rounding, int8 within the error of its quantized weights.
+"""
+import argparse
+import os
+import sys
+
+import numpy as np
+import torch
+from torchvision.ops import box_iou
+
+from utils import get_yolo_model, load_rgb_image, predict_yolo_sliced
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.webp')
+# min_match, min_iou, conf_tol
+TOLERANCES = {'onnx': (0.98, 0.99, 0.01), 'onnx-int8': (0.9, 0.9, 0.05)}
+
+
+def match(boxes, conf, other_boxes, other_conf, match_iou):
+    """ For every box, IoU and confidence difference of its best match among the other boxes, when IoU >= match_iou """
+    if not len(boxes) or not len(other_boxes):
+        return 0, [], []
+    boxes, other_boxes = boxes.float().cpu(), other_boxes.float().cpu()
+    # boxes clamped flat against the image border have no area: no IoU (NaN between two of them) even with themselves
+    same = (boxes[:, None, :] - other_boxes[None, :, :]).abs().amax(dim=2) <= 1
+    iou = torch.where(same, torch.ones(()), box_iou(boxes, other_boxes).nan_to_num(0.0))
+    # among equally good boxes (e.g. flat ones kept next to each other by NMS) take the closest confidence
+    conf_diff = (conf.float().cpu()[:, None] - other_conf.float().cpu()[None, :]).abs()
+    index = (iou - 1e-3 * conf_diff).argmax(dim=1)
+    rows = torch.arange(len(boxes))
+    best, conf_diff = iou[rows, index], conf_diff[rows, index]
+    matched = best >= match_iou
+    return int(matched.sum()), best[matched].tolist(), conf_diff[matched].tolist()
+
+
+def compare(pairs, match_iou):
+    """ pairs: ((boxes, conf) of torch, (boxes, conf) of onnx) per image; matched both ways """
+    matched, total, ious, conf_diffs = 0, 0, [], []
+    for (boxes, conf), (other_boxes, other_conf) in pairs:
+        for a, b in (((boxes, conf), (other_boxes, other_conf)), ((other_boxes, other_conf), (boxes, conf))):
+            n, best, diff = match(a[0], a[1], b[0], b[1], match_iou)
+            matched += n
+            total += len(a[0])
+            ious.extend(best)
+            conf_diffs.extend(diff)
+    return {'boxes': total, 'match_rate': matched / total if total else 1.0,
+            'mean_iou': float(np.mean(ious)) if ious else 1.0, 'max_conf_diff': max(conf_diffs, default=0.0)}
+
+
+def detections(results):
+    return [(result.boxes.xyxy, result.boxes.conf) for result in results]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', nargs='+', default=['imgs'], help='image files or directories')
+    parser.add_argument('--yolo-model', default='weights/icon_detect_v1_5/model.pt')
+    parser.add_argument('--backend', choices=sorted(TOLERANCES), default='onnx')
+    parser.add_argument('--imgsz', type=int, default=640)
+    parser.add_argument('--box-threshold', type=float, default=0.05)
+    parser.add_argument('--match-iou', type=float, default=0.5)
+    parser.add_argument('--min-match', type=float, default=None)
+    parser.add_argument('--min-iou', type=float, default=None)
+    parser.add_argument('--conf-tol', type=float, default=None)
+    args = parser.parse_args()
+    min_match, min_iou, conf_tol = [default if value is None else value for value, default in
+                                    zip((args.min_match, args.min_iou, args.conf_tol), TOLERANCES[args.backend])]
+
+    image_paths = []
+    for path in args.images:
+        if os.path.isdir(path):
+            image_paths.extend(sorted(os.path.join(path, name) for name in os.listdir(path)
+                                      if name.lower().endswith(IMAGE_EXTENSIONS)))
+        else:
+            image_paths.append(path)
+    images = [load_rgb_image(path) for path in image_paths]
+
+    reference = get_yolo_model(model_path=args.yolo_model, backend='torch')
+    model = get_yolo_model(model_path=args.yolo_model, backend=args.backend)
+    kwargs = dict(conf=args.box_threshold, imgsz=args.imgsz, verbose=False)
+    modes = {
+        'single': [(detections(reference.predict(source=image, **kwargs))[0], detections(model.predict(source=image, **kwargs))[0])
+                   for image in images],
+        'batch': list(zip(detections(reference.predict(source=images, **kwargs)), detections(model.predict(source=images, **kwargs)))),
+        'sliced': [(predict_yolo_sliced(reference, image, args.box_threshold, args.imgsz),
+                    predict_yolo_sliced(model, image, args.box_threshold, args.imgsz)) for image in images],
+    }
+
+    failed = False
+    for mode, pairs in modes.items():
+        result = compare(pairs, args.match_iou)
+        ok = result['match_rate'] >= min_match and result['mean_iou'] >= min_iou and result['max_conf_diff'] <= conf_tol
+        failed |= not ok
+        print(f"{mode:<7} {'ok  ' if ok else 'FAIL'} boxes={result['boxes']}  match_rate={result['match_rate']:.1%} (>= {min_match:.0%})  "
+              f"mean_iou={result['mean_iou']:.4f} (>= {min_iou})  max_conf_diff={result['max_conf_diff']:.4f} (<= {conf_tol})")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
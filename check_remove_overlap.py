@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Randomized equivalence check of utils.remove_overlap against the original python loop.
+
+Draws random sets of icon boxes (with duplicates, nested, touching and zero-area boxes, on a
+coarse grid so area and overlap ties are common), with and without OCR boxes, over a range of
+IoU thresholds, and checks that the vectorized remove_overlap keeps exactly the same boxes in
+the same order as the loop it replaced (copied below as remove_overlap_reference):
+
+    python check_remove_overlap.py --cases 2000 --seed 0
+
+Exits with status 1 and prints the first mismatching case when they differ.
+"""
+import argparse
+import sys
+import time
+from typing import List
+
+import numpy as np
+import torch
+
+from utils import remove_overlap
+
+
+def remove_overlap_reference(boxes, iou_threshold, ocr_bbox=None):
+    """ The original implementation of utils.remove_overlap, kept as the reference. """
+    assert ocr_bbox is None or isinstance(ocr_bbox, List)
+
+    def box_area(box):
+        return (box[2] - box[0]) * (box[3] - box[1])
+
+    def intersection_area(box1, box2):
+        x1 = max(box1[0], box2[0])
+        y1 = max(box1[1], box2[1])
+        x2 = min(box1[2], box2[2])
+        y2 = min(box1[3], box2[3])
+        return max(0, x2 - x1) * max(0, y2 - y1)
+
+    def IoU(box1, box2):
+        intersection = intersection_area(box1, box2)
+        union = box_area(box1) + box_area(box2) - intersection + 1e-6
+        if box_area(box1) > 0 and box_area(box2) > 0:
+            ratio1 = intersection / box_area(box1)
+            ratio2 = intersection / box_area(box2)
+        else:
+            ratio1, ratio2 = 0, 0
+        return max(intersection / union, ratio1, ratio2)
+
+    boxes = boxes.tolist()
+    filtered_boxes = []
+    if ocr_bbox:
+        filtered_boxes.extend(ocr_bbox)
+    for i, box1 in enumerate(boxes):
+        is_valid_box = True
+        for j, box2 in enumerate(boxes):
+            if i != j and IoU(box1, box2) > iou_threshold and box_area(box1) > box_area(box2):
+                is_valid_box = False
+                break
+        if is_valid_box:
+            if ocr_bbox:
+                if not any(IoU(box1, box3) > iou_threshold for k, box3 in enumerate(ocr_bbox)):
+                    filtered_boxes.append(box1)
+            else:
+                filtered_boxes.append(box1)
+    return torch.tensor(filtered_boxes)
+
+
+def random_boxes(rng, n, grid):
+    """ n xyxy ratio boxes snapped to a 1/grid lattice, with some duplicated, nested or degenerate. """
+    if n == 0:
+        return np.zeros((0, 4), dtype=np.float32)
+    xy = rng.integers(0, grid, size=(n, 2))
+    wh = rng.integers(0, grid // 4 + 1, size=(n, 2))
+    boxes = np.concatenate([xy, np.minimum(xy + wh, grid)], axis=1)
+    for i in range(1, n):
+        kind = rng.random()
+        if kind < 0.1:
+            boxes[i] = boxes[rng.integers(0, i)]
+        elif kind < 0.2:
+            # nested in an earlier box
+            x1, y1, x2, y2 = boxes[rng.integers(0, i)]
+            boxes[i] = [x1 + (x2 - x1) // 4, y1 + (y2 - y1) // 4, x2 - (x2 - x1) // 4, y2 - (y2 - y1) // 4]
+    return (boxes / grid).astype(np.float32)
+
+
+def check_case(rng):
+    grid = int(rng.choice([8, 32, 1000]))
+    boxes = torch.from_numpy(random_boxes(rng, int(rng.integers(0, 60)), grid))
+    num_ocr = int(rng.integers(0, 20)) if rng.random() < 0.7 else 0
+    ocr_bbox = random_boxes(rng, num_ocr, grid).tolist() if num_ocr else None
+    iou_threshold = float(rng.choice([0.0, 0.1, 0.5, 0.7, 0.9, 1.0, rng.random()]))
+
+    expected = remove_overlap_reference(boxes, iou_threshold, ocr_bbox=ocr_bbox).reshape(-1, 4)
+    actual = remove_overlap(boxes, iou_threshold, ocr_bbox=ocr_bbox).reshape(-1, 4)
+    if expected.shape != actual.shape or not torch.equal(expected.float(), actual.float()):
+        return dict(boxes=boxes.tolist(), ocr_bbox=ocr_bbox, iou_threshold=iou_threshold,
+                    expected=expected.tolist(), actual=actual.tolist())
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cases', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    start = time.perf_counter()
+    for case in range(args.cases):
+        mismatch = check_case(rng)
+        if mismatch is not None:
+            print(f"case {case} differs (seed {args.seed}):")
+            for key, value in mismatch.items():
+                print(f"  {key}: {value}")
+            sys.exit(1)
+    print(f"{args.cases} cases identical ({time.perf_counter() - start:.1f}s)")
+
+
+if __name__ == '__main__':
+    main()
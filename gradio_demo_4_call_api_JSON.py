@@ -8,32 +8,26 @@ def get_parsed_screen_elements(image_path):
         response = requests.post(url, files=files)
 
     if response.status_code == 200:
-        parsed_content = response.json().get('parsed_content')
+        # the server returns typed elements, no need to parse the "Text Box ID i: ..." lines
         elements = []
-
-        # Split parsed content into lines and process each line
-        for line in parsed_content.splitlines():
-            parts = line.split(": ", 1)  # Split at the first ": " only
-            if len(parts) == 2:
-                key, value = parts
-                if key.startswith("Text Box ID"):
-                    id_num = int(key.split()[-1])  # Get the last part as the ID
-                    elements.append({
-                        "Type": "TextBox",
-                        "ID": id_num,
-                        "Text": value.strip(),
-                        "Context": "General Text"
-                    })
-                elif key.startswith("Icon Box ID"):
-                    id_num = int(key.split()[-1])  # Get the last part as the ID
-                    elements.append({
-                        "Type": "IconBox",
-                        "ID": id_num,
-                        "Description": value.strip(),
-                        "Context": "UI Icon"
-                    })
+        for element in response.json().get('elements', []):
+            if element['type'] == 'text':
+                elements.append({
+                    "Type": "TextBox",
+                    "ID": element['id'],
+                    "Text": element['content'],
+                    "Context": "General Text",
+                    "BBox": element['bbox']
+                })
             else:
-                print(f"Skipping unrecognized line format: {line}")
+                elements.append({
+                    "Type": "IconBox",
+                    "ID": element['id'],
+                    "Description": element['content'],
+                    "Context": "UI Icon",
+                    "BBox": element['bbox'],
+                    "Confidence": element['confidence']
+                })
 
         # Create structured JSON
         output_json = {
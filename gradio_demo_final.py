@@ -2,7 +2,7 @@ import os
 import io
 import base64 # Not directly used in the final output for this API, but was in original 'process'
 import logging
-import tempfile # Using tempfile for more robust temporary file creation
+from typing import Optional, Tuple
 
 from flask import Flask, request, jsonify
 from PIL import Image
@@ -12,7 +12,9 @@ import torch
 # --- Import your utility functions ---
 # Ensure utils.py is in the same directory or accessible via PYTHONPATH
 try:
-    from utils import check_ocr_box, get_yolo_model, get_caption_model_processor, get_som_labeled_img
+    from utils import get_yolo_model, get_caption_model_processor, parse_image, enable_caption_batching
+    from util.caption_cache import caption_cache
+    from util.metrics import register_flask_metrics
 except ImportError as e:
     print(f"Error importing from utils.py: {e}. Make sure utils.py is accessible.")
     # You might want to exit or handle this more gracefully if utils are critical at module level
@@ -50,6 +52,12 @@ try:
 
     yolo_model = get_yolo_model(model_path=yolo_model_path)
     caption_model_processor = get_caption_model_processor(model_name="florence2", model_name_or_path=florence_model_path)
+    if os.getenv("CAPTION_BATCHING", "True").lower() == "true":
+        # batch caption crops across concurrent requests
+        enable_caption_batching(
+            caption_model_processor,
+            max_batch_size=int(os.getenv("CAPTION_MAX_BATCH_SIZE", 16)),
+            max_wait_ms=float(os.getenv("CAPTION_MAX_WAIT_MS", 10)))
     logger.info("Models loaded successfully.")
 except Exception as e:
     logger.error(f"Fatal error loading models: {e}", exc_info=True)
@@ -68,6 +76,8 @@ logger.info(f"Using device: {DEVICE}")
 
 # --- Flask App Definition ---
 app = Flask(__name__)
+# GET /metrics with per-stage latency histograms, box counts and in-flight requests
+register_flask_metrics(app)
 
 # --- Helper function for OCR extraction (adapted from original 'process') ---
 def extract_ocr_from_image(
@@ -75,23 +85,21 @@ def extract_ocr_from_image(
     box_threshold: float,
     iou_threshold: float,
     use_paddleocr: bool,
-    imgsz: int
-) -> str:
+    imgsz: int,
+    output_image: bool = False,
+    image_format: str = "PNG",
+    image_quality: Optional[int] = None
+) -> Tuple[str, Optional[str]]:
     """
     Processes a PIL Image object to extract OCR text.
+    The decoded image is shared by every stage; nothing is written to disk.
+    The annotated image is only drawn and encoded (as base64) when output_image is True,
+    otherwise None is returned in its place.
     """
     if not yolo_model or not caption_model_processor:
         logger.error("Models not loaded. Cannot process image.")
         raise RuntimeError("Models are not loaded. OCR service is unavailable.")
 
-    # Using tempfile for secure temporary file creation and cleanup
-    # Suffix is important for some libraries that infer type from extension
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".png") as tmp_file:
-        image_save_path = tmp_file.name
-        pil_image.save(image_save_path)
-    
-    logger.info(f"Temporary image saved to {image_save_path}")
-
     try:
         # Calculate draw_bbox_config, assuming it's needed by get_som_labeled_img
         image_width = pil_image.size[0]
@@ -108,48 +116,32 @@ def extract_ocr_from_image(
             'thickness': max(int(3 * box_overlay_ratio), 1),
         }
 
-        # Perform OCR
+        # OCR and icon detection run concurrently, then join for overlap removal and captioning
         # Default easyocr_args from original: {'paragraph': False, 'text_threshold':0.9}
-        ocr_bbox_rslt, _ = check_ocr_box(
-            image_save_path,
-            display_img=False,
-            output_bb_format='xyxy',
-            goal_filtering=None,
-            easyocr_args={'paragraph': False, 'text_threshold': 0.9},
-            use_paddleocr=use_paddleocr
-        )
-        text, ocr_bbox = ocr_bbox_rslt
-        logger.info(f"Raw OCR text extracted (first 50 chars): {text[:50]}")
-
-        # Get structured labeled image data (we only need the parsed content list)
-        _, _, parsed_content_list = get_som_labeled_img(
-            image_save_path,
+        # (we only need the parsed content list)
+        encoded_image, _, parsed_content_list = parse_image(
+            pil_image,
             yolo_model,
+            use_paddleocr=use_paddleocr,
+            easyocr_args={'paragraph': False, 'text_threshold': 0.9},
             BOX_TRESHOLD=box_threshold,
             output_coord_in_ratio=True,
-            ocr_bbox=ocr_bbox,
             draw_bbox_config=draw_bbox_config,
             caption_model_processor=caption_model_processor,
-            ocr_text=text,
             iou_threshold=iou_threshold,
-            imgsz=imgsz
+            imgsz=imgsz,
+            output_image=output_image,
+            image_format=image_format,
+            image_quality=image_quality
         )
         
         parsed_text_output = '\n'.join(parsed_content_list)
         logger.info("Content parsing successful.")
-        return parsed_text_output
+        return parsed_text_output, encoded_image
 
     except Exception as e:
         logger.error(f"Error during OCR extraction pipeline: {e}", exc_info=True)
         raise # Re-raise to be caught by the API route's error handler
-    finally:
-        # Clean up the temporary image
-        if os.path.exists(image_save_path):
-            try:
-                os.remove(image_save_path)
-                logger.info(f"Temporary image {image_save_path} removed.")
-            except Exception as e_rem:
-                logger.error(f"Error removing temporary image {image_save_path}: {e_rem}")
 
 
 # --- API Endpoint ---
@@ -188,6 +180,13 @@ def ocr_endpoint():
         use_paddleocr_str = request.form.get('use_paddleocr', 'true').lower()
         use_paddleocr = use_paddleocr_str == 'true'
         imgsz = int(request.form.get('imgsz', 640))
+        # Parse-only by default; the annotated image is rendered only when asked for
+        output_image = request.form.get('output_image', 'false').lower() == 'true'
+        image_format = request.form.get('image_format', 'PNG').upper()
+        if image_format not in ('PNG', 'JPEG', 'WEBP'):
+            raise ValueError(f"unsupported image_format {image_format}")
+        image_quality = request.form.get('image_quality')
+        image_quality = int(image_quality) if image_quality else None
         logger.info(f"API /ocr: Processing with params: box_threshold={box_threshold}, iou_threshold={iou_threshold}, use_paddleocr={use_paddleocr}, imgsz={imgsz}")
     except ValueError as e:
         logger.error(f"API /ocr: Invalid parameter value. Error: {e}", exc_info=True)
@@ -197,14 +196,20 @@ def ocr_endpoint():
         # Process the image to get OCR text
         # The @torch.autocast context manager can be used here if needed for mixed precision
         # with torch.autocast(device_type=DEVICE.type if DEVICE.type != 'mps' else 'cpu', dtype=torch.bfloat16 if DEVICE.type == 'cuda' else torch.float32, enabled=DEVICE.type == 'cuda'):
-        ocr_text_result = extract_ocr_from_image(
+        ocr_text_result, encoded_image = extract_ocr_from_image(
             pil_image,
             box_threshold,
             iou_threshold,
             use_paddleocr,
-            imgsz
+            imgsz,
+            output_image=output_image,
+            image_format=image_format,
+            image_quality=image_quality
         )
-        return jsonify({"ocr_text": ocr_text_result})
+        response = {"ocr_text": ocr_text_result}
+        if output_image:
+            response["image"] = encoded_image
+        return jsonify(response)
     
     except RuntimeError as e: # Catch specific model loading issues from helper
         logger.error(f"API /ocr: Runtime error during processing (likely model issue): {e}", exc_info=True)
@@ -217,7 +222,7 @@ def ocr_endpoint():
 @app.route('/health', methods=['GET'])
 def health_check():
     if yolo_model and caption_model_processor:
-        return jsonify({"status": "healthy", "models_loaded": True}), 200
+        return jsonify({"status": "healthy", "models_loaded": True, "caption_cache": caption_cache.stats()}), 200
     else:
         return jsonify({"status": "unhealthy", "models_loaded": False, "message": "One or more models failed to load."}), 503
 
@@ -1,4 +1,4 @@
-from utils import get_som_labeled_img, check_ocr_box, get_caption_model_processor,  get_dino_model, get_yolo_model
+from utils import get_som_labeled_img, check_ocr_box, get_caption_model_processor,  get_dino_model, get_yolo_model, load_rgb_image, parse_image, parse_images
 import torch
 from ultralytics import YOLO
 from PIL import Image
@@ -31,30 +31,39 @@ class Omniparser(object):
 
     def parse(self, image_path: str):
         print('Parsing image:', image_path)
-        ocr_bbox_rslt, is_goal_filtered = check_ocr_box(image_path, display_img = False, output_bb_format='xyxy', goal_filtering=None, easyocr_args={'paragraph': False, 'text_threshold':0.9})
-        text, ocr_bbox = ocr_bbox_rslt
-
+        # decode once, OCR and detection share the same in-memory image and run concurrently
+        image_source = load_rgb_image(image_path)
         draw_bbox_config = self.config['draw_bbox_config']
         BOX_TRESHOLD = self.config['BOX_TRESHOLD']
-        dino_labled_img, label_coordinates, parsed_content_list = get_som_labeled_img(image_path, self.som_model, BOX_TRESHOLD = BOX_TRESHOLD, output_coord_in_ratio=False, ocr_bbox=ocr_bbox,draw_bbox_config=draw_bbox_config, caption_model_processor=None, ocr_text=text,use_local_semantics=False)
+        result = parse_image(image_source, self.som_model, easyocr_args={'paragraph': False, 'text_threshold':0.9}, BOX_TRESHOLD = BOX_TRESHOLD, draw_bbox_config=draw_bbox_config, caption_model_processor=None, use_local_semantics=False, return_result=True)
         
-        image = Image.open(io.BytesIO(base64.b64decode(dino_labled_img)))
-        # formating output
-        return_list = [{'from': 'omniparser', 'shape': {'x':coord[0], 'y':coord[1], 'width':coord[2], 'height':coord[3]},
-                        'text': parsed_content_list[i].split(': ')[1], 'type':'text'} for i, (k, coord) in enumerate(label_coordinates.items()) if i < len(parsed_content_list)]
-        return_list.extend(
-            [{'from': 'omniparser', 'shape': {'x':coord[0], 'y':coord[1], 'width':coord[2], 'height':coord[3]},
-                        'text': 'None', 'type':'icon'} for i, (k, coord) in enumerate(label_coordinates.items()) if i >= len(parsed_content_list)]
-              )
+        return self._format_result(result)
+
+    def parse_many(self, image_paths: List[str]):
+        """ Parse many screenshots in one batched pass, see utils.parse_images.
+            Returns [image, return_list] per input, or the Exception raised for that input.
+        """
+        print('Parsing images:', len(image_paths))
+        draw_bbox_config = self.config['draw_bbox_config']
+        BOX_TRESHOLD = self.config['BOX_TRESHOLD']
+        results = parse_images(image_paths, self.som_model, easyocr_args={'paragraph': False, 'text_threshold':0.9}, BOX_TRESHOLD = BOX_TRESHOLD, draw_bbox_config=draw_bbox_config, use_local_semantics=False, return_result=True)
+        return [result if isinstance(result, Exception) else self._format_result(result) for result in results]
+
+    def _format_result(self, result):
+        image = Image.open(io.BytesIO(base64.b64decode(result.image)))
+        # formating output, straight from the structured elements (pixel xyxy boxes)
+        return_list = [{'from': 'omniparser', 'shape': {'x':e.bbox[0], 'y':e.bbox[1], 'width':e.bbox[2] - e.bbox[0], 'height':e.bbox[3] - e.bbox[1]},
+                        'text': str(e.content), 'type':e.type} for e in result.elements]
 
         return [image, return_list]
     
-parser = Omniparser(config)
-image_path = 'examples/pc_1.png'
-
-#  time the parser
-import time
-s = time.time()
-image, parsed_content_list = parser.parse(image_path)
-device = config['device']
-print(f'Time taken for Omniparser on {device}:', time.time() - s)
+if __name__ == '__main__':
+    parser = Omniparser(config)
+    image_path = 'examples/pc_1.png'
+
+    #  time the parser
+    import time
+    s = time.time()
+    image, parsed_content_list = parser.parse(image_path)
+    device = config['device']
+    print(f'Time taken for Omniparser on {device}:', time.time() - s)
@@ -18,6 +18,10 @@ def start_server():
     error_log = os.getenv('ERROR_LOG_FILE')
     capture_output = os.getenv('CAPTURE_OUTPUT', 'true').lower() == 'true'
     timeout = os.getenv('REQUEST_TIMEOUT')
+    # e.g. uvicorn.workers.UvicornWorker with FLASK_APP=app_asgi:app for the async serving mode
+    worker_class = os.getenv('WORKER_CLASS')
+    # load the models once in the master, workers fork afterwards and share them
+    preload = os.getenv('PRELOAD', 'false').lower() == 'true'
     
     # Build the gunicorn command
     cmd = [
@@ -31,6 +35,12 @@ def start_server():
         '--timeout', timeout
     ]
     
+    if worker_class:
+        cmd.extend(['-k', worker_class])
+
+    if preload:
+        cmd.append('--preload')
+
     if capture_output:
         cmd.append('--capture-output')
     
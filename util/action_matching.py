@@ -2,10 +2,16 @@
 Adapted from https://github.com/google-research/google-research/tree/master/android_in_the_wild
 '''
 
-import jax
-import jax.numpy as jnp
 import numpy as np
 
+try:
+  import jax
+  import jax.numpy as jnp
+except ImportError:
+  # without jax every function runs on NumPy, see check_actions_match_batch
+  jax = None
+  jnp = np
+
 # import action_type as action_type_lib
 import enum
 
@@ -175,10 +181,10 @@ def _check_drag_actions_match(
   # ending at (0.3, 0.5) has a main axis index of 1).
   drag_1_deltas = drag_1_lift_yx - drag_1_touch_yx
   drag_1_magnitudes = jnp.abs(drag_1_deltas)
-  drag_1_main_axis = np.argmax(drag_1_magnitudes)
+  drag_1_main_axis = jnp.argmax(drag_1_magnitudes)
   drag_2_deltas = drag_2_lift_yx - drag_2_touch_yx
   drag_2_magnitudes = jnp.abs(drag_2_deltas)
-  drag_2_main_axis = np.argmax(drag_2_magnitudes)
+  drag_2_main_axis = jnp.argmax(drag_2_magnitudes)
 
   return jnp.equal(drag_1_main_axis, drag_2_main_axis)
 
@@ -276,6 +282,173 @@ def check_actions_match(
   )
 
 
+def _actions_match(
+    xp,
+    action_1_touch_yx,
+    action_1_lift_yx,
+    action_1_action_type,
+    action_2_touch_yx,
+    action_2_lift_yx,
+    action_2_action_type,
+    annotation_positions,
+    annotation_mask,
+    tap_distance_threshold,
+    annotation_width_augment_fraction,
+    annotation_height_augment_fraction,
+):
+  """check_actions_match written against the array module `xp` (jax.numpy or numpy).
+
+  Only trailing axes are indexed, so the same code scores one step (as traced
+  by jax.vmap) or a whole batch of steps at once (NumPy backend).
+  """
+  is_tap_1 = xp.linalg.norm(action_1_touch_yx - action_1_lift_yx, axis=-1) <= _SWIPE_DISTANCE_THRESHOLD
+  is_tap_2 = xp.linalg.norm(action_2_touch_yx - action_2_lift_yx, axis=-1) <= _SWIPE_DISTANCE_THRESHOLD
+  has_non_dual_point_action = xp.logical_or(
+      action_1_action_type != ActionType.DUAL_POINT,
+      action_2_action_type != ActionType.DUAL_POINT,
+  )
+  different_dual_point_types = xp.logical_xor(is_tap_1, is_tap_2)
+  is_tap = xp.logical_and(is_tap_1, is_tap_2)
+
+  # Same resizing as _resize_annotation_bounding_boxes.
+  height_change = annotation_height_augment_fraction * annotation_positions[..., 2]
+  width_change = annotation_width_augment_fraction * annotation_positions[..., 3]
+  top = xp.maximum(0, annotation_positions[..., 0] - (height_change / 2))
+  left = xp.maximum(0, annotation_positions[..., 1] - (width_change / 2))
+  bottom = top + xp.minimum(1, annotation_positions[..., 2] + height_change)
+  right = left + xp.minimum(1, annotation_positions[..., 3] + width_change)
+
+  def in_boxes(yx):
+    y, x = yx[..., 0:1], yx[..., 1:2]
+    return (y >= top) & (y <= bottom) & (x >= left) & (x <= right)
+
+  both_in_box = xp.any(in_boxes(action_1_touch_yx) & in_boxes(action_2_touch_yx) & annotation_mask, axis=-1)
+  within_threshold = (
+      xp.linalg.norm(action_1_touch_yx - action_2_touch_yx, axis=-1)
+      <= tap_distance_threshold
+  )
+  taps_match = xp.logical_and(is_tap, xp.logical_or(both_in_box, within_threshold))
+
+  drags_match = xp.equal(
+      xp.argmax(xp.abs(action_1_lift_yx - action_1_touch_yx), axis=-1),
+      xp.argmax(xp.abs(action_2_lift_yx - action_2_touch_yx), axis=-1),
+  )
+  drags_match = xp.where(is_tap, False, drags_match)
+
+  return xp.where(
+      has_non_dual_point_action,
+      xp.equal(action_1_action_type, action_2_action_type),
+      xp.where(
+          different_dual_point_types,
+          False,
+          xp.logical_or(taps_match, drags_match),
+      ),
+  )
+
+
+_jax_actions_match = None
+
+
+def _get_jax_actions_match():
+  global _jax_actions_match
+  if _jax_actions_match is None:
+    def step(*args):
+      return _actions_match(jnp, *args)
+    # steps are mapped over the leading axis, thresholds are shared scalars
+    _jax_actions_match = jax.jit(jax.vmap(step, in_axes=(0,) * 8 + (None,) * 3))
+  return _jax_actions_match
+
+
+def pad_annotation_positions(annotation_positions_list):
+  """Stack per-step annotation boxes of different counts into one padded array.
+
+  Args:
+    annotation_positions_list: A sequence of (num_bboxes_i, 4) arrays, one per
+      step, in the (y_top_left, x_top_left, box_height, box_width) format.
+
+  Returns:
+    (annotation_positions, annotation_mask): A float32 array of shape
+      (num_steps, max_num_bboxes, 4), and a bool array of shape
+      (num_steps, max_num_bboxes) that is False for the padding rows.
+  """
+  num_bboxes = [len(positions) for positions in annotation_positions_list]
+  max_num_bboxes = max(num_bboxes + [1])
+  annotation_positions = np.zeros((len(num_bboxes), max_num_bboxes, 4), dtype=np.float32)
+  annotation_mask = np.zeros((len(num_bboxes), max_num_bboxes), dtype=bool)
+  for i, positions in enumerate(annotation_positions_list):
+    if num_bboxes[i]:
+      annotation_positions[i, :num_bboxes[i]] = np.asarray(positions, dtype=np.float32).reshape(-1, 4)
+      annotation_mask[i, :num_bboxes[i]] = True
+  return annotation_positions, annotation_mask
+
+
+def check_actions_match_batch(
+    action_1_touch_yx,
+    action_1_lift_yx,
+    action_1_action_type,
+    action_2_touch_yx,
+    action_2_lift_yx,
+    action_2_action_type,
+    annotation_positions,
+    annotation_mask=None,
+    tap_distance_threshold = _TAP_DISTANCE_THRESHOLD,
+    annotation_width_augment_fraction = ANNOTATION_WIDTH_AUGMENT_FRACTION,
+    annotation_height_augment_fraction = ANNOTATION_HEIGHT_AUGMENT_FRACTION,
+    backend=None,
+):
+  """check_actions_match over many steps at once.
+
+  With jax the per-step check is vmapped and jit-compiled; it is compiled again
+  for every new (num_steps, max_num_bboxes) shape, so score an eval set in a few
+  large calls rather than many small ones. Without jax the same computation runs
+  vectorized in NumPy. Both compute in float32 like the jax scalar version.
+
+  Args:
+    action_1_touch_yx: Array of shape (num_steps, 2), the (y, x) touch points
+      of the first actions.
+    action_1_lift_yx: Array of shape (num_steps, 2).
+    action_1_action_type: Int array of shape (num_steps,).
+    action_2_touch_yx: Array of shape (num_steps, 2).
+    action_2_lift_yx: Array of shape (num_steps, 2).
+    action_2_action_type: Int array of shape (num_steps,).
+    annotation_positions: Array of shape (num_steps, max_num_bboxes, 4), see
+      pad_annotation_positions.
+    annotation_mask: Bool array of shape (num_steps, max_num_bboxes), False
+      for padding rows. None when every row is a real box.
+    tap_distance_threshold: See check_actions_match.
+    annotation_width_augment_fraction: See check_actions_match.
+    annotation_height_augment_fraction: See check_actions_match.
+    backend: 'jax' or 'numpy', None to use jax when it is installed.
+
+  Returns:
+    A NumPy bool array of shape (num_steps,), whether each pair of actions is
+    the same.
+  """
+  if backend is None:
+    backend = 'numpy' if jax is None else 'jax'
+  if backend == 'jax' and jax is None:
+    raise ImportError("backend='jax' requires jax to be installed")
+
+  points = [np.asarray(points, dtype=np.float32).reshape(-1, 2) for points in (
+      action_1_touch_yx, action_1_lift_yx, action_2_touch_yx, action_2_lift_yx)]
+  action_1_action_type = np.asarray(action_1_action_type, dtype=np.int32).reshape(-1)
+  action_2_action_type = np.asarray(action_2_action_type, dtype=np.int32).reshape(-1)
+  annotation_positions = np.asarray(annotation_positions, dtype=np.float32).reshape(len(action_1_action_type), -1, 4)
+  if annotation_mask is None:
+    annotation_mask = np.ones(annotation_positions.shape[:2], dtype=bool)
+  annotation_mask = np.asarray(annotation_mask, dtype=bool)
+  if len(action_1_action_type) == 0:
+    return np.zeros((0,), dtype=bool)
+
+  args = (points[0], points[1], action_1_action_type, points[2], points[3], action_2_action_type,
+          annotation_positions, annotation_mask)
+  thresholds = (np.float32(tap_distance_threshold), np.float32(annotation_width_augment_fraction),
+                np.float32(annotation_height_augment_fraction))
+  if backend == 'jax':
+    return np.asarray(_get_jax_actions_match()(*args, *thresholds))
+  return np.asarray(_actions_match(np, *args, *thresholds), dtype=bool)
+
+
 def action_2_format(step_data):
     # 把test数据集中的动作格式转换为计算matching score的格式
     action_type = step_data["action_type_id"]
@@ -1,3 +1,4 @@
+from functools import lru_cache
 from typing import List, Optional, Union, Tuple
 
 import cv2
@@ -85,6 +86,8 @@ class BoxAnnotator:
             ```
         """
         font = cv2.FONT_HERSHEY_SIMPLEX
+        # index the detections once, label placement then only tests nearby boxes
+        grid = DetectionGrid(detections.xyxy) if self.avoid_overlap and not skip_label else None
         for i in range(len(detections)):
             x1, y1, x2, y2 = detections.xyxy[i].astype(int)
             class_id = (
@@ -112,12 +115,7 @@ class BoxAnnotator:
                 else labels[i]
             )
 
-            text_width, text_height = cv2.getTextSize(
-                text=text,
-                fontFace=font,
-                fontScale=self.text_scale,
-                thickness=self.text_thickness,
-            )[0]
+            text_width, text_height = get_text_size(text, font, self.text_scale, self.text_thickness)
 
             if not self.avoid_overlap:
                 text_x = x1 + self.text_padding
@@ -135,7 +133,7 @@ class BoxAnnotator:
                 # text_background_x2 = x1
                 # text_background_y2 = y1 + 2 * self.text_padding + text_height
             else:
-                text_x, text_y, text_background_x1, text_background_y1, text_background_x2, text_background_y2 = get_optimal_label_pos(self.text_padding, text_width, text_height, x1, y1, x2, y2, detections, image_size)
+                text_x, text_y, text_background_x1, text_background_y1, text_background_x2, text_background_y2 = get_optimal_label_pos(self.text_padding, text_width, text_height, x1, y1, x2, y2, detections, image_size, grid=grid)
 
             cv2.rectangle(
                 img=scene,
@@ -186,19 +184,101 @@ def IoU(box1, box2, return_max=True):
         return intersection / union
 
 
-def get_optimal_label_pos(text_padding, text_width, text_height, x1, y1, x2, y2, detections, image_size):
+@lru_cache(maxsize=4096)
+def get_text_size(text, font, text_scale, text_thickness):
+    """ cv2.getTextSize of a label, cached since the same label strings are measured on every frame
+    """
+    return cv2.getTextSize(
+        text=text,
+        fontFace=font,
+        fontScale=text_scale,
+        thickness=text_thickness,
+    )[0]
+
+
+class DetectionGrid:
+    """
+    A uniform grid over the detection boxes for fast label overlap queries.
+
+    Only detections that intersect a label background can have an IoU (or containment
+    ratio) above zero with it, so `max_overlap` looks up the grid cells covered by the
+    label and evaluates `IoU` for those candidates in one vectorized numpy pass.
+    The result is identical to calling `IoU` against every detection.
+
+    Attributes:
+        xyxy (np.ndarray): The detection boxes, cast to int as the label placement expects
+        cell_size (int): Side of a grid cell in pixels, defaults to the median box side
+    """
+
+    # boxes spanning more cells than this are tested against every query instead of being gridded
+    MAX_CELLS_PER_BOX = 64
+
+    def __init__(self, xyxy: np.ndarray, cell_size: Optional[int] = None):
+        self.xyxy = np.asarray(xyxy).astype(int).reshape(-1, 4)
+        x1, y1, x2, y2 = self.xyxy.T
+        self.area = (x2 - x1) * (y2 - y1)
+        # boxes without a positive width and height never intersect a label
+        valid = np.flatnonzero((x2 > x1) & (y2 > y1))
+        if cell_size is None:
+            sides = np.maximum(x2 - x1, y2 - y1)[valid]
+            cell_size = int(np.median(sides)) if len(sides) else 1
+        self.cell_size = max(16, cell_size)
+
+        cells = {}
+        large = []
+        cx1, cy1 = x1 // self.cell_size, y1 // self.cell_size
+        cx2, cy2 = (x2 - 1) // self.cell_size, (y2 - 1) // self.cell_size
+        for i in valid:
+            if (cx2[i] - cx1[i] + 1) * (cy2[i] - cy1[i] + 1) > self.MAX_CELLS_PER_BOX:
+                large.append(i)
+                continue
+            for cx in range(cx1[i], cx2[i] + 1):
+                for cy in range(cy1[i], cy2[i] + 1):
+                    cells.setdefault((cx, cy), []).append(i)
+        self._cells = {k: np.array(v, dtype=int) for k, v in cells.items()}
+        self._large = np.array(large, dtype=int)
+
+    def candidates(self, x1, y1, x2, y2) -> np.ndarray:
+        found = [self._large]
+        for cx in range(x1 // self.cell_size, (x2 - 1) // self.cell_size + 1):
+            for cy in range(y1 // self.cell_size, (y2 - 1) // self.cell_size + 1):
+                if (cx, cy) in self._cells:
+                    found.append(self._cells[(cx, cy)])
+        return np.unique(np.concatenate(found))
+
+    def max_overlap(self, x1, y1, x2, y2) -> float:
+        """ max over all detections of IoU([x1, y1, x2, y2], detection), 0 if none intersects
+        """
+        if x2 <= x1 or y2 <= y1:
+            return 0
+        idx = self.candidates(x1, y1, x2, y2)
+        if len(idx) == 0:
+            return 0
+        boxes = self.xyxy[idx]
+        inter_w = np.minimum(x2, boxes[:, 2]) - np.maximum(x1, boxes[:, 0])
+        inter_h = np.minimum(y2, boxes[:, 3]) - np.maximum(y1, boxes[:, 1])
+        intersection = np.maximum(0, inter_w) * np.maximum(0, inter_h)
+        hit = intersection > 0
+        if not hit.any():
+            return 0
+        intersection, area = intersection[hit], self.area[idx][hit]
+        label_area = (x2 - x1) * (y2 - y1)
+        union = label_area + area - intersection
+        overlap = np.maximum(np.maximum(intersection / union, intersection / label_area), intersection / area)
+        return overlap.max()
+
+
+def get_optimal_label_pos(text_padding, text_width, text_height, x1, y1, x2, y2, detections, image_size, grid=None):
     """ check overlap of text and background detection box, and get_optimal_label_pos, 
         pos: str, position of the text, must be one of 'top left', 'top right', 'outer left', 'outer right' TODO: if all are overlapping, return the last one, i.e. outer right
         Threshold: default to 0.3
+        grid: DetectionGrid over detections, built here when not given
     """
+    if grid is None:
+        grid = DetectionGrid(detections.xyxy)
 
     def get_is_overlap(detections, text_background_x1, text_background_y1, text_background_x2, text_background_y2, image_size):
-        is_overlap = False
-        for i in range(len(detections)):
-            detection = detections.xyxy[i].astype(int)
-            if IoU([text_background_x1, text_background_y1, text_background_x2, text_background_y2], detection) > 0.3:
-                is_overlap = True
-                break
+        is_overlap = grid.max_overlap(text_background_x1, text_background_y1, text_background_x2, text_background_y2) > 0.3
         # check if the text is out of the image
         if text_background_x1 < 0 or text_background_x2 > image_size[0] or text_background_y1 < 0 or text_background_y2 > image_size[1]:
             is_overlap = True
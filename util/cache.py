@@ -0,0 +1,149 @@
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+
+class LRUCache:
+    """
+    A thread-safe in-memory LRU mapping of str keys to values.
+
+    Attributes:
+        max_entries (int): Number of entries kept before the least recently used is evicted
+        ttl (Optional[float]): Seconds an entry stays valid after it was put, None to keep entries until evicted
+    """
+
+    def __init__(self, max_entries: int = 4096, ttl: Optional[float] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # key -> (value, expiry time or None)
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key: str):
+        with self._lock:
+            if key not in self._data:
+                return None
+            value, expires = self._data[key]
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def put(self, key: str, value):
+        if self.max_entries <= 0:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class DiskCache:
+    """
+    A file-per-entry bytes store that survives restarts and can be shared by processes.
+
+    Entries are written to a temp file and renamed into place, so concurrent readers
+    (e.g. other gunicorn workers) never observe a partially written value.
+
+    With `max_bytes`, a put that takes this process' running estimate of the directory size
+    over the limit rescans the directory and deletes the oldest entries down to 90% of it.
+    Writes of other processes are only counted at the next rescan, so the directory can
+    briefly exceed the limit by what the other workers wrote in between.
+
+    Attributes:
+        directory (str): Root directory of the cache, created if missing
+        ttl (Optional[float]): Seconds an entry stays valid after it was written, None for no expiry
+        max_bytes (Optional[int]): Size of the directory above which the oldest entries are evicted, None for no limit
+    """
+
+    def __init__(self, directory: str, ttl: Optional[float] = None, max_bytes: Optional[int] = None):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._approx_bytes = self._scan()[1] if max_bytes else 0
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key: str) -> Optional[bytes]:
+        path = self._path(key)
+        try:
+            if self.ttl and os.path.getmtime(path) + self.ttl < time.time():
+                self._remove(path)
+                return None
+            with open(path, 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def put(self, key: str, value: bytes):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(value)
+            os.replace(tmp_path, path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        if self.max_bytes:
+            with self._lock:
+                self._approx_bytes += len(value)
+                over = self._approx_bytes > self.max_bytes
+            if over:
+                self.evict()
+
+    def evict(self):
+        """ Delete expired entries, then the oldest ones until the directory is under 90% of max_bytes. """
+        entries, total = self._scan()
+        now = time.time()
+        target = 0.9 * self.max_bytes if self.max_bytes else float('inf')
+        for mtime, size, path in sorted(entries):
+            if total <= target and not (self.ttl and mtime + self.ttl < now):
+                break
+            if self._remove(path):
+                total -= size
+        with self._lock:
+            self._approx_bytes = total
+
+    def _scan(self):
+        """ (mtime, size, path) of every entry and their total size. """
+        entries, total = [], 0
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.startswith('.tmp-'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+        return entries, total
+
+    @staticmethod
+    def _remove(path: str) -> bool:
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            # already removed by another worker
+            return False
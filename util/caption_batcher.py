@@ -0,0 +1,115 @@
+import os
+import queue
+import threading
+import time
+import weakref
+from concurrent.futures import Future
+from typing import Callable, List
+
+from util.metrics import CAPTION_QUEUE_DEPTH
+
+
+class CaptionBatcher:
+    """
+    A background scheduler that owns the caption model and batches crops across requests.
+
+    Requests submit their crops and block on the returned futures. A single worker thread
+    collects pending crops until `max_batch_size` is reached or `max_wait_ms` has passed
+    since the first one arrived, runs `generate_fn` once per batch and routes every
+    caption back to the request that submitted the crop. Under load batches fill up,
+    when idle a lone request waits at most `max_wait_ms`.
+
+    Attributes:
+        generate_fn (Callable): Captions a list of crops (PIL images or RGB uint8 ndarrays) with one prompt,
+            returns one str per crop
+        max_batch_size (int): Maximum number of crops per model.generate call
+        max_wait_ms (float): Maximum time the first crop of a batch waits for more crops
+    """
+
+    def __init__(self, generate_fn: Callable, max_batch_size: int = 16, max_wait_ms: float = 10):
+        self.generate_fn = generate_fn
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait_ms = max_wait_ms
+        self._closed = False
+        self._start()
+        _batchers.add(self)
+
+    def _start(self):
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='caption-batcher', daemon=True)
+        self._thread.start()
+
+    def submit(self, images: List, prompt: str) -> List[Future]:
+        if self._closed:
+            raise RuntimeError("CaptionBatcher is closed")
+        futures = []
+        for image in images:
+            future = Future()
+            self._queue.put((image, prompt, future))
+            futures.append(future)
+        CAPTION_QUEUE_DEPTH.set(self._queue.qsize())
+        return futures
+
+    def caption(self, images: List, prompt: str) -> List[str]:
+        return [future.result() for future in self.submit(images, prompt)]
+
+    def close(self):
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+
+    def _collect(self, first):
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait_ms / 1000
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                # keep the sentinel for the main loop, finish this batch first
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch = self._collect(first)
+            CAPTION_QUEUE_DEPTH.set(self._queue.qsize())
+            # a batch shares one prompt, group crops of requests using different prompts
+            by_prompt = {}
+            for item in batch:
+                by_prompt.setdefault(item[1], []).append(item)
+            for prompt, items in by_prompt.items():
+                try:
+                    captions = list(self.generate_fn([item[0] for item in items], prompt))
+                    if len(captions) != len(items):
+                        raise RuntimeError(f"generate_fn returned {len(captions)} captions for {len(items)} crops")
+                    for item, caption in zip(items, captions):
+                        item[2].set_result(caption)
+                except Exception as e:
+                    for item in items:
+                        if not item[2].done():
+                            item[2].set_exception(e)
+
+
+# Threads do not survive fork: a batcher built in the gunicorn master (--preload) gets a new queue and
+# worker thread in every forked worker.
+_batchers = weakref.WeakSet()
+
+
+def _restart_after_fork():
+    for batcher in list(_batchers):
+        if not batcher._closed:
+            batcher._start()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_restart_after_fork)
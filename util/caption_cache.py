@@ -0,0 +1,75 @@
+import hashlib
+import os
+import threading
+from typing import Optional
+
+import numpy as np
+
+from util.cache import LRUCache, DiskCache
+from util.metrics import CAPTION_CACHE
+
+
+# Entries kept in memory per process, 0 disables the memory tier
+CAPTION_CACHE_SIZE = int(os.getenv("CAPTION_CACHE_SIZE", 4096))
+# Optional directory for the on-disk tier, shared by every worker pointing at it
+CAPTION_CACHE_DIR = os.getenv("CAPTION_CACHE_DIR") or None
+
+
+class CaptionCache:
+    """
+    Content-addressed cache of icon captions.
+
+    Keys are an exact hash of the cropped icon pixels together with the caption model
+    and prompt, so the same toolbar icon seen on another screenshot is only captioned once.
+    Lookups go to the in-memory LRU first and then to the optional on-disk tier.
+
+    Attributes:
+        max_entries (int): Size of the in-memory LRU tier
+        cache_dir (Optional[str]): Directory of the on-disk tier, None to disable it
+    """
+
+    def __init__(self, max_entries: int = 4096, cache_dir: Optional[str] = None):
+        self.memory = LRUCache(max_entries)
+        self.disk = DiskCache(cache_dir) if cache_dir else None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+
+    @staticmethod
+    def key(crop: np.ndarray, model_id: str, prompt: str) -> str:
+        crop = np.ascontiguousarray(crop)
+        h = hashlib.sha1()
+        h.update(f"{model_id}\0{prompt}\0{crop.shape}\0{crop.dtype}\0".encode('utf-8'))
+        h.update(crop.data)
+        return h.hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        caption = self.memory.get(key)
+        from_disk = False
+        if caption is None and self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                caption = value.decode('utf-8')
+                from_disk = True
+                self.memory.put(key, caption)
+        with self._lock:
+            if caption is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.disk_hits += from_disk
+        CAPTION_CACHE.inc(result='miss' if caption is None else 'disk' if from_disk else 'memory')
+        return caption
+
+    def put(self, key: str, caption: str):
+        self.memory.put(key, caption)
+        if self.disk is not None:
+            self.disk.put(key, caption.encode('utf-8'))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'disk_hits': self.disk_hits, 'memory_entries': len(self.memory)}
+
+
+caption_cache = CaptionCache(max_entries=CAPTION_CACHE_SIZE, cache_dir=CAPTION_CACHE_DIR)
@@ -0,0 +1,59 @@
+from typing import List, Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+import torch
+
+
+def fixed_size_config(image_processor) -> Optional[Tuple[Tuple[int, int], float, Sequence[float], Sequence[float]]]:
+    """
+    ((height, width), rescale factor, mean, std) of a HF image processor that only resizes to a fixed
+    size, rescales and normalizes (Florence-2's CLIPImageProcessor, BLIP-2's BlipImageProcessor),
+    None for anything else (center crops, aspect-preserving or multi-crop resizing).
+    """
+    size = getattr(image_processor, 'size', None) or {}
+    if not isinstance(size, dict) or 'height' not in size or 'width' not in size:
+        return None
+    if getattr(image_processor, 'do_center_crop', False) or not all(
+            getattr(image_processor, flag, True) for flag in ('do_resize', 'do_rescale', 'do_normalize')):
+        return None
+    return (size['height'], size['width']), image_processor.rescale_factor, image_processor.image_mean, image_processor.image_std
+
+
+def preprocess_crops(crops: List[np.ndarray], size: Tuple[int, int], rescale_factor: float, mean: Sequence[float],
+                     std: Sequence[float]) -> torch.Tensor:
+    """
+    Pixel values of a batch of crops, without going through PIL.
+
+    Every crop (an RGB uint8 view into the screenshot, e.g. from crop_icon_images) is resized by
+    cv2 straight into its slot of one preallocated uint8 batch, bicubic when enlarging and area
+    averaging when shrinking. The batch is then converted to float once and normalized in place:
+    ((x * rescale_factor) - mean) / std, the same transform as the HF image processor.
+
+    Returns:
+        torch.Tensor: (N, 3, height, width) float32
+    """
+    height, width = size
+    batch = np.empty((len(crops), height, width, 3), dtype=np.uint8)
+    for crop, dst in zip(crops, batch):
+        if crop.size == 0:
+            # degenerate box, rounded down to no pixels
+            dst.fill(0)
+            continue
+        shrink = crop.shape[0] > height and crop.shape[1] > width
+        cv2.resize(crop, (width, height), dst=dst, interpolation=cv2.INTER_AREA if shrink else cv2.INTER_CUBIC)
+    pixel_values = torch.empty((len(crops), 3, height, width), dtype=torch.float32)
+    pixel_values.copy_(torch.from_numpy(batch).permute(0, 3, 1, 2))
+    std = torch.tensor(std, dtype=torch.float32).view(1, 3, 1, 1)
+    mean = torch.tensor(mean, dtype=torch.float32).view(1, 3, 1, 1)
+    return pixel_values.mul_(rescale_factor / std).sub_(mean / std)
+
+
+def left_pad(sequences: List[torch.Tensor], padding_value: int) -> torch.Tensor:
+    """ Stack 1-D tensors of different lengths into one (N, max_len) tensor, padded on the left, in one scatter. """
+    lengths = torch.tensor([len(sequence) for sequence in sequences])
+    max_len = int(lengths.max())
+    padded = torch.full((len(sequences), max_len), padding_value, dtype=sequences[0].dtype)
+    # row-major boolean assignment fills every row's last `length` positions in order
+    padded[torch.arange(max_len)[None, :] >= (max_len - lengths)[:, None]] = torch.cat(sequences)
+    return padded
@@ -0,0 +1,87 @@
+from typing import List
+
+import cv2
+import numpy as np
+
+
+def dirty_block_mask(prev: np.ndarray, cur: np.ndarray, block_size: int = 32) -> np.ndarray:
+    """
+    Compare two frames of the same shape block by block.
+
+    Returns:
+        np.ndarray: bool mask of shape (ceil(h / block_size), ceil(w / block_size)), True where
+            any pixel of the block changed
+    """
+    changed = np.any(prev != cur, axis=-1) if cur.ndim == 3 else prev != cur
+    h, w = changed.shape
+    gh, gw = -(-h // block_size), -(-w // block_size)
+    padded = np.zeros((gh * block_size, gw * block_size), dtype=bool)
+    padded[:h, :w] = changed
+    return padded.reshape(gh, block_size, gw, block_size).any(axis=(1, 3))
+
+
+def dirty_regions(mask: np.ndarray, block_size: int, image_size, margin_blocks: int = 1) -> List[List[int]]:
+    """
+    Group the dirty blocks into rectangles, in pixel xyxy format.
+
+    Neighbouring dirty blocks (including the `margin_blocks` around them) form one region,
+    so a changed widget is re-parsed with some context instead of as scattered tiles.
+    """
+    w, h = image_size
+    if not mask.any():
+        return []
+    grown = mask.astype(np.uint8)
+    if margin_blocks > 0:
+        kernel = np.ones((2 * margin_blocks + 1, 2 * margin_blocks + 1), np.uint8)
+        grown = cv2.dilate(grown, kernel)
+    n, _, stats, _ = cv2.connectedComponentsWithStats(grown, connectivity=8)
+    regions = []
+    for x, y, bw, bh, _ in stats[1:n]:
+        regions.append([int(x * block_size), int(y * block_size),
+                        int(min(w, (x + bw) * block_size)), int(min(h, (y + bh) * block_size))])
+    return merge_regions(regions)
+
+
+def boxes_intersect(a, b) -> bool:
+    """ True when two xyxy boxes share a positive area. """
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+def merge_regions(regions: List[List[int]]) -> List[List[int]]:
+    """ Merge intersecting xyxy rectangles until none intersect. """
+    regions = [list(r) for r in regions]
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(regions)):
+            for j in range(i + 1, len(regions)):
+                if boxes_intersect(regions[i], regions[j]):
+                    a, b = regions[i], regions.pop(j)
+                    regions[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                    merged = True
+                    break
+            if merged:
+                break
+    return regions
+
+
+def expand_regions(regions: List[List[int]], boxes: List[List[float]]) -> List[List[int]]:
+    """
+    Grow the regions to fully contain every box (xyxy, pixel) they intersect.
+
+    An element cut by a dirty region is re-parsed as a whole, so elements kept from the
+    previous frame never intersect a region that is parsed again.
+    """
+    while True:
+        grown = []
+        for region in regions:
+            x1, y1, x2, y2 = region
+            for box in boxes:
+                if boxes_intersect(region, box):
+                    x1, y1 = min(x1, int(box[0])), min(y1, int(box[1]))
+                    x2, y2 = max(x2, int(np.ceil(box[2]))), max(y2, int(np.ceil(box[3])))
+            grown.append([x1, y1, x2, y2])
+        grown = merge_regions(grown)
+        if grown == regions:
+            return regions
+        regions = grown
@@ -0,0 +1,170 @@
+import os
+import queue
+import threading
+import time
+import uuid
+import weakref
+from concurrent.futures import Future
+from typing import Callable, Optional, Tuple
+
+from util.cache import LRUCache
+from util.metrics import JOB_QUEUE_DEPTH, JOBS, COALESCED
+
+
+class QueueFull(Exception):
+    """ Raised by JobQueue.submit when the queue already holds max_queue jobs.
+
+    Attributes:
+        retry_after (int): Suggested seconds before retrying, from the queue length and recent job durations
+    """
+
+    def __init__(self, retry_after: int):
+        super().__init__(f'job queue is full, retry after {retry_after}s')
+        self.retry_after = retry_after
+
+
+class Job:
+    """
+    A parse job: its status moves from 'queued' to 'running' to 'done' or 'failed'.
+
+    Attributes:
+        id (str): Job id returned to clients polling for the result
+        future (Future): Resolved with the handler's return value or exception
+    """
+
+    def __init__(self, args: tuple, kwargs: dict, key: Optional[str] = None):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        # requests attached to this job by JobQueue.submit_coalesced, besides the one that submitted it
+        self.coalesced = 0
+        self.args = args
+        self.kwargs = kwargs
+        self.status = 'queued'
+        self.future = Future()
+        self.created = time.time()
+
+
+class JobQueue:
+    """
+    A bounded queue of jobs drained by a fixed set of inference worker threads.
+
+    Submitting never blocks: when `max_queue` jobs are already waiting the job is rejected
+    with QueueFull, so bursts are pushed back to the clients instead of piling up until
+    the server times out. Finished jobs stay available by id for polling, up to `max_jobs`.
+    Jobs submitted with submit_coalesced and the key of a job still queued or running attach to it.
+
+    Attributes:
+        handler (Callable): Runs one job, called as handler(*job.args, **job.kwargs)
+        workers (int): Number of worker threads, i.e. jobs running at the same time
+        max_queue (int): Jobs waiting for a worker before new jobs are rejected
+        max_jobs (int): Jobs (any status) kept for lookup by id
+    """
+
+    def __init__(self, handler: Callable, workers: int = 1, max_queue: int = 16, max_jobs: int = 1024):
+        self.handler = handler
+        self.workers = max(1, int(workers))
+        self.max_queue = max(1, int(max_queue))
+        self.jobs = LRUCache(max_jobs)
+        self._lock = threading.Lock()
+        # key -> job queued or running, for submit_coalesced
+        self._inflight = {}
+        # exponential moving average of job durations, for Retry-After
+        self._avg_seconds = None
+        self._start()
+        _job_queues.add(self)
+
+    def _start(self):
+        self._queue = queue.Queue(maxsize=self.max_queue)
+        self._threads = [threading.Thread(target=self._run, name=f'inference-{i}', daemon=True) for i in range(self.workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def __len__(self):
+        return self._queue.qsize()
+
+    def retry_after(self) -> int:
+        """ Seconds until a worker is likely free for one more job. """
+        avg_seconds = self._avg_seconds or 1.0
+        return max(1, int(round((len(self) + 1) * avg_seconds / self.workers)))
+
+    def submit(self, *args, **kwargs) -> Job:
+        return self._submit(Job(args, kwargs))
+
+    def submit_coalesced(self, key: str, *args, **kwargs) -> Tuple[Job, bool]:
+        """ submit, unless a job with the same key is queued or running: that job is returned instead,
+            without taking a queue slot. Returns the job and whether it was already in flight.
+        """
+        with self._lock:
+            job = self._inflight.get(key)
+            if job is not None:
+                job.coalesced += 1
+                COALESCED.inc(layer='job')
+                return job, True
+            job = self._inflight[key] = Job(args, kwargs, key=key)
+        try:
+            return self._submit(job), False
+        except QueueFull:
+            with self._lock:
+                self._inflight.pop(key, None)
+            raise
+
+    def _submit(self, job: Job) -> Job:
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            JOBS.inc(status='rejected')
+            raise QueueFull(self.retry_after())
+        self.jobs.put(job.id, job)
+        JOB_QUEUE_DEPTH.set(len(self))
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self.jobs.get(job_id)
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            JOB_QUEUE_DEPTH.set(len(self))
+            if not job.future.set_running_or_notify_cancel():
+                self._done(job)
+                continue
+            job.status = 'running'
+            start = time.perf_counter()
+            try:
+                result = self.handler(*job.args, **job.kwargs)
+            except Exception as e:
+                job.status = 'failed'
+                job.future.set_exception(e)
+                JOBS.inc(status='failed')
+            else:
+                job.status = 'done'
+                job.future.set_result(result)
+                JOBS.inc(status='done')
+            finally:
+                # the upload is not needed anymore, only the result is kept for polling
+                job.args, job.kwargs = (), {}
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self._avg_seconds = elapsed if self._avg_seconds is None else 0.8 * self._avg_seconds + 0.2 * elapsed
+            self._done(job)
+
+    def _done(self, job: Job):
+        with self._lock:
+            if job.key is not None and self._inflight.get(job.key) is job:
+                del self._inflight[job.key]
+
+
+# Threads do not survive fork: a queue built in the gunicorn master (--preload) gets new worker
+# threads in every forked worker.
+_job_queues = weakref.WeakSet()
+
+
+def _restart_after_fork():
+    for job_queue in list(_job_queues):
+        job_queue.jobs.clear()
+        job_queue._inflight.clear()
+        job_queue._start()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_restart_after_fork)
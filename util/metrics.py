@@ -0,0 +1,221 @@
+import functools
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Sequence, Tuple
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+COUNT_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 200, 500, 1000, 2000)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+
+def _format_labels(names: Sequence[str], values: Tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value) -> str:
+    return '+Inf' if value == float('inf') else repr(float(value))
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple, object] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> Tuple:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.extend(self._render_sample(key, value))
+        return lines
+
+    def _render_sample(self, key, value):
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}']
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    def _render_sample(self, key, value):
+        counts, total = value
+        lines = []
+        for bound, count in zip(self.buckets, counts):
+            le = 'le="%s"' % _format_value(bound)
+            lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, le)} {count}')
+        lines.append(f'{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}')
+        lines.append(f'{self.name}_count{_format_labels(self.labelnames, key)} {counts[-1]}')
+        return lines
+
+
+class Registry:
+    """
+    A minimal in-process registry rendered in the Prometheus text exposition format.
+
+    Metrics are per process: with several gunicorn workers each worker reports its own
+    values, and Prometheus aggregates them across scrapes of the individual workers.
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    'omniparser_stage_seconds', 'Wall time of each pipeline stage.', ['stage']))
+OCR_LINES = REGISTRY.register(Histogram(
+    'omniparser_ocr_lines', 'Number of OCR text boxes per parsed image.', buckets=COUNT_BUCKETS))
+BOXES = REGISTRY.register(Histogram(
+    'omniparser_boxes', 'Number of boxes per parsed image, before (detected) and after (filtered) overlap removal.', ['kind'], buckets=COUNT_BUCKETS))
+CAPTION_BATCH_SIZE = REGISTRY.register(Histogram(
+    'omniparser_caption_batch_size', 'Number of crops per caption model.generate call.', buckets=BATCH_SIZE_BUCKETS))
+CAPTION_QUEUE_DEPTH = REGISTRY.register(Gauge(
+    'omniparser_caption_queue_depth', 'Crops waiting in the caption batcher queue.'))
+OCR_ENGINES = REGISTRY.register(Gauge(
+    'omniparser_ocr_engines', 'OCR engines per backend, by state (busy or idle).', ['backend', 'state']))
+REQUESTS_IN_FLIGHT = REGISTRY.register(Gauge(
+    'omniparser_requests_in_flight', 'Requests currently being processed.', ['endpoint']))
+REQUESTS = REGISTRY.register(Counter(
+    'omniparser_requests_total', 'Requests processed.', ['endpoint', 'status']))
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    'omniparser_request_seconds', 'Wall time of each request.', ['endpoint']))
+MODEL_LOAD_SECONDS = REGISTRY.register(Gauge(
+    'omniparser_model_load_seconds', 'Time taken to load each model.', ['model']))
+JOB_QUEUE_DEPTH = REGISTRY.register(Gauge(
+    'omniparser_job_queue_depth', 'Parse jobs waiting for an inference worker (ASGI serving mode).'))
+JOBS = REGISTRY.register(Counter(
+    'omniparser_jobs_total', 'Parse jobs by outcome: done, failed, or rejected because the queue was full.', ['status']))
+COALESCED = REGISTRY.register(Counter(
+    'omniparser_coalesced_total', 'Requests attached to an identical parse already in progress instead of running their own, '
+    'by layer: parse (single-flight) or job (ASGI job queue).', ['layer']))
+RESPONSE_CACHE = REGISTRY.register(Counter(
+    'omniparser_response_cache_total', 'Response cache lookups by result: memory or disk hit, or miss.', ['result']))
+CAPTION_CACHE = REGISTRY.register(Counter(
+    'omniparser_caption_cache_total', 'Icon caption cache lookups by result: memory or disk hit, or miss.', ['result']))
+
+
+@contextmanager
+def stage_timer(stage: str):
+    """
+    Time a pipeline stage into omniparser_stage_seconds.
+
+    Example:
+        ```python
+        with stage_timer('ocr'):
+            result = reader.readtext(image)
+        ```
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=stage)
+
+
+def timed_stage(stage: str):
+    """ Decorator form of stage_timer. """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage_timer(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def register_flask_metrics(app):
+    """ Add GET /metrics to a Flask app and track in-flight requests, request counts and latency.
+    """
+    from flask import Response, g, request
+
+    @app.before_request
+    def _start_request():
+        if request.endpoint and request.endpoint != 'metrics':
+            g._metrics_start = time.perf_counter()
+            REQUESTS_IN_FLIGHT.inc(endpoint=request.endpoint)
+
+    @app.after_request
+    def _count_request(response):
+        if request.endpoint and request.endpoint != 'metrics':
+            REQUESTS.inc(endpoint=request.endpoint, status=response.status_code)
+        return response
+
+    @app.teardown_request
+    def _end_request(exc):
+        start = g.pop('_metrics_start', None)
+        if start is not None:
+            REQUESTS_IN_FLIGHT.dec(endpoint=request.endpoint)
+            REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=request.endpoint)
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        """
+        Prometheus metrics of this worker process.
+        ---
+        responses:
+          200:
+            description: Metrics in the Prometheus text exposition format.
+        """
+        return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+    return app
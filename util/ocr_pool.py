@@ -0,0 +1,144 @@
+import inspect
+import os
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict
+
+import cv2
+import numpy as np
+
+from util.metrics import OCR_ENGINES
+
+
+# Upper bound of OCR engines built per process and per backend. Engines are created lazily,
+# only when every existing one is checked out, so idle processes keep a single instance.
+OCR_POOL_SIZE = int(os.getenv("OCR_POOL_SIZE", 1))
+
+
+class OCREnginePool:
+    """
+    A thread-safe pool of OCR engines (easyocr.Reader / PaddleOCR).
+
+    Neither engine is safe to share between threads, so every caller checks out an engine
+    for exclusive use and returns it when done. New engines are built on demand until
+    `max_size` is reached; after that callers wait for an engine to be released.
+
+    Attributes:
+        factory (Callable): Builds a new engine instance
+        max_size (int): Maximum number of engines the pool will ever create
+        name (str): Backend name reported in the omniparser_ocr_engines gauge
+    """
+
+    def __init__(self, factory: Callable, max_size: int = 1, name: str = 'ocr'):
+        self.factory = factory
+        self.max_size = max(1, int(max_size))
+        self.name = name
+        self._idle = []
+        self._created = 0
+        self._cond = threading.Condition()
+
+    @property
+    def size(self) -> int:
+        return self._created
+
+    @contextmanager
+    def checkout(self):
+        """
+        Borrow an engine for the duration of the `with` block.
+
+        Example:
+            ```python
+            with pool.checkout() as reader:
+                result = reader.readtext(image)
+            ```
+        """
+        engine = self._acquire()
+        try:
+            yield engine
+        finally:
+            self._release(engine)
+
+    def _acquire(self):
+        with self._cond:
+            while not self._idle and self._created >= self.max_size:
+                self._cond.wait()
+            if self._idle:
+                engine = self._idle.pop()
+                self._report()
+                return engine
+            self._created += 1
+            self._report()
+        # building an engine loads model weights, keep that outside the lock
+        try:
+            return self.factory()
+        except Exception:
+            with self._cond:
+                self._created -= 1
+                self._report()
+                self._cond.notify()
+            raise
+
+    def _release(self, engine):
+        with self._cond:
+            self._idle.append(engine)
+            self._report()
+            self._cond.notify()
+
+    def _report(self):
+        OCR_ENGINES.set(len(self._idle), backend=self.name, state='idle')
+        OCR_ENGINES.set(self._created - len(self._idle), backend=self.name, state='busy')
+
+
+def create_easyocr_reader():
+    import easyocr
+    return easyocr.Reader(['en'])
+
+
+def easyocr_readtext(reader, image: np.ndarray, **easyocr_args) -> list:
+    """ reader.readtext of an RGB ndarray, fed the way readtext feeds itself from an image file: the detector
+        gets the RGB pixels and the recognizer their grey levels. readtext takes 3-channel arrays as BGR, so
+        handing it the RGB array would weigh red and blue the wrong way round in the recognizer's grey image.
+    """
+    detect_params = inspect.signature(reader.detect).parameters
+    detect_args = {key: value for key, value in easyocr_args.items() if key in detect_params}
+    recognize_args = {key: value for key, value in easyocr_args.items() if key not in detect_params}
+    horizontal_list, free_list = reader.detect(image, reformat=False, **detect_args)
+    return reader.recognize(cv2.cvtColor(image, cv2.COLOR_RGB2GRAY), horizontal_list[0], free_list[0],
+                            reformat=False, **recognize_args)
+
+
+def create_paddle_ocr():
+    from paddleocr import PaddleOCR
+    return PaddleOCR(
+        lang='en',  # other lang also available
+        use_angle_cls=False,
+        use_gpu=False,  # using cuda will conflict with pytorch in the same process
+        show_log=False,
+        max_batch_size=1024,
+        use_dilation=True,  # improves accuracy
+        det_db_score_mode='slow',  # improves accuracy
+        rec_batch_num=1024)
+
+
+_pools: Dict[bool, OCREnginePool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_ocr_pool(use_paddleocr: bool) -> OCREnginePool:
+    """ Return the per-process pool of the selected backend; the other backend is never loaded.
+    """
+    use_paddleocr = bool(use_paddleocr)
+    with _pools_lock:
+        if use_paddleocr not in _pools:
+            factory = create_paddle_ocr if use_paddleocr else create_easyocr_reader
+            name = 'paddleocr' if use_paddleocr else 'easyocr'
+            _pools[use_paddleocr] = OCREnginePool(factory, max_size=OCR_POOL_SIZE, name=name)
+        return _pools[use_paddleocr]
+
+
+def preload_ocr_engine(use_paddleocr: bool):
+    """ Build one engine of the selected backend now, e.g. in the gunicorn master before the workers
+        fork (they inherit it copy-on-write), and return it.
+    """
+    with get_ocr_pool(use_paddleocr).checkout() as engine:
+        return engine
@@ -0,0 +1,148 @@
+import copy
+import os
+import tempfile
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+import torch
+from torchvision.ops import nms
+
+
+# Same post-processing defaults as ultralytics' predictor
+NMS_IOU = 0.7
+MAX_DET = 300
+MAX_NMS = 30000
+MAX_WH = 7680
+STRIDE = 32
+
+
+def export_onnx(yolo_model, onnx_path: str, opset: int = 17):
+    """
+    Export an ultralytics YOLO detector to ONNX with dynamic batch and image size.
+
+    The graph ends at the decoded (batch, 4 + num_classes, anchors) predictions, in xywh pixels of
+    the letterboxed input, NMS is left to OnnxDetector.
+    """
+    from ultralytics.nn.modules import Detect
+
+    model = copy.deepcopy(yolo_model.model).float().eval()
+    model.requires_grad_(False)
+    model = model.fuse(verbose=False)
+    for module in model.modules():
+        if isinstance(module, Detect):
+            module.dynamic = True
+            module.export = True
+            module.format = 'onnx'
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(onnx_path)), prefix='.tmp-', suffix='.onnx')
+    os.close(fd)
+    try:
+        torch.onnx.export(
+            model, torch.zeros(1, 3, 640, 640), tmp_path, opset_version=opset, dynamo=False,
+            input_names=['images'], output_names=['output0'], do_constant_folding=True,
+            dynamic_axes={'images': {0: 'batch', 2: 'height', 3: 'width'}, 'output0': {0: 'batch', 2: 'anchors'}})
+        os.replace(tmp_path, onnx_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def quantize_onnx_int8(onnx_path: str, int8_path: str):
+    """ Dynamic int8 quantization of the conv and matmul weights; activations stay float, so no calibration set is needed. """
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(int8_path)), prefix='.tmp-', suffix='.onnx')
+    os.close(fd)
+    try:
+        quantize_dynamic(onnx_path, tmp_path, weight_type=QuantType.QUInt8)
+        os.replace(tmp_path, int8_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def letterbox(image: np.ndarray, imgsz: int, auto: bool = True):
+    """
+    Resize keeping the aspect ratio and pad, like ultralytics' LetterBox for PyTorch models: to the minimal
+    rectangle that is a multiple of the stride with auto, else to the imgsz square (centered, grey 114 padding).
+
+    Returns:
+        np.ndarray: the padded image
+    """
+    h, w = image.shape[:2]
+    gain = min(imgsz / h, imgsz / w)
+    new_w, new_h = int(round(w * gain)), int(round(h * gain))
+    dw, dh = imgsz - new_w, imgsz - new_h
+    if auto:
+        dw, dh = dw % STRIDE, dh % STRIDE
+    dw, dh = dw / 2, dh / 2
+    if (new_w, new_h) != (w, h):
+        image = cv2.resize(image, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+    top, bottom = int(round(dh - 0.1)), int(round(dh + 0.1))
+    left, right = int(round(dw - 0.1)), int(round(dw + 0.1))
+    image = cv2.copyMakeBorder(image, top, bottom, left, right, cv2.BORDER_CONSTANT, value=(114, 114, 114))
+    return image
+
+
+class OnnxDetector:
+    """
+    The icon detector run by onnxruntime on the CPU.
+
+    `predict` mirrors the part of ultralytics' YOLO.predict that predict_yolo relies on: it takes
+    one image or a list of images and returns one result per image with `boxes.xyxy` and
+    `boxes.conf` tensors, so every caller of the torch model works unchanged.
+
+    Attributes:
+        onnx_path (str): Exported model, see export_onnx and quantize_onnx_int8
+        session (onnxruntime.InferenceSession): CPU session
+    """
+
+    def __init__(self, onnx_path: str, intra_op_num_threads: int = 0):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if intra_op_num_threads:
+            options.intra_op_num_threads = intra_op_num_threads
+        self.onnx_path = onnx_path
+        self.session = ort.InferenceSession(onnx_path, sess_options=options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def predict(self, source, conf: float = 0.25, imgsz: int = 640, **kwargs):
+        images = source if isinstance(source, list) else [source]
+        images = [np.asarray(image.convert('RGB') if hasattr(image, 'convert') else image) for image in images]
+        if not images:
+            return []
+        # one batch, letterboxed as ultralytics does: minimal rectangles when every image has the same shape,
+        # else every image padded to the imgsz square
+        auto = len({image.shape for image in images}) == 1
+        padded = [letterbox(image, imgsz, auto=auto) for image in images]
+        blob = np.ascontiguousarray(np.stack(padded).transpose(0, 3, 1, 2), dtype=np.float32) / 255.0
+        predictions = self.session.run(None, {self.input_name: blob})[0]
+        return [self._postprocess(torch.from_numpy(prediction).T, image.shape[:2], blob.shape[2:], conf)
+                for prediction, image in zip(predictions, images)]
+
+    def _postprocess(self, prediction: torch.Tensor, shape, padded_shape, conf: float):
+        """ prediction: (anchors, 4 + nc) of one image; shape, padded_shape: (h, w) of the image and of the model input """
+        h, w = shape
+        scores, classes = prediction[:, 4:].max(dim=1)
+        keep = scores > conf
+        prediction, scores, classes = prediction[keep], scores[keep], classes[keep]
+        if len(scores) > MAX_NMS:
+            top = scores.argsort(descending=True)[:MAX_NMS]
+            prediction, scores, classes = prediction[top], scores[top], classes[top]
+        cx, cy, bw, bh = prediction[:, :4].unbind(1)
+        boxes = torch.stack([cx - bw / 2, cy - bh / 2, cx + bw / 2, cy + bh / 2], dim=1)
+        # per-class NMS through a class offset, as ultralytics does
+        keep = nms(boxes + classes[:, None].float() * MAX_WH, scores, NMS_IOU)[:MAX_DET]
+        boxes, scores = boxes[keep], scores[keep]
+
+        # back to the original image, with the gain and padding ultralytics' scale_boxes derives from the shapes
+        padded_h, padded_w = padded_shape
+        gain = min(padded_h / h, padded_w / w)
+        pad_x, pad_y = round((padded_w - w * gain) / 2 - 0.1), round((padded_h - h * gain) / 2 - 0.1)
+        boxes -= torch.tensor([pad_x, pad_y, pad_x, pad_y], dtype=boxes.dtype)
+        boxes /= gain
+        boxes[:, [0, 2]] = boxes[:, [0, 2]].clamp(0, w)
+        boxes[:, [1, 3]] = boxes[:, [1, 3]].clamp(0, h)
+        return SimpleNamespace(boxes=SimpleNamespace(xyxy=boxes, conf=scores))
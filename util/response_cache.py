@@ -0,0 +1,80 @@
+import hashlib
+import json
+import os
+from typing import Optional, Tuple
+
+import numpy as np
+
+from util.cache import LRUCache, DiskCache
+from util.metrics import RESPONSE_CACHE
+from util.schema import ParseResult
+
+
+# Parse results kept in memory per process, 0 disables the memory tier
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", 256))
+# Optional directory for the file tier, shared by every worker pointing at it
+RESPONSE_CACHE_DIR = os.getenv("RESPONSE_CACHE_DIR") or None
+# Seconds a cached response is served, in both tiers
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", 3600))
+# Size limit of the file tier, the oldest entries are evicted above it
+RESPONSE_CACHE_MAX_MB = float(os.getenv("RESPONSE_CACHE_MAX_MB", 1024))
+
+
+class ResponseCache:
+    """
+    Cache of whole parse results, for clients re-submitting identical screenshots (retries, polling loops).
+
+    Keys are an exact hash of the decoded pixels together with every parameter that changes the
+    result, so the same screenshot re-encoded (another PNG compressor, different metadata) still hits.
+    Lookups go to the in-memory LRU first and then to the optional file tier, both expire entries
+    after `ttl` seconds.
+
+    Attributes:
+        max_entries (int): Size of the in-memory LRU tier
+        cache_dir (Optional[str]): Directory of the file tier, None to disable it
+        ttl (Optional[float]): Seconds an entry is served after it was stored
+        max_bytes (Optional[int]): Size limit of the file tier
+    """
+
+    def __init__(self, max_entries: int = 256, cache_dir: Optional[str] = None, ttl: Optional[float] = 3600,
+                 max_bytes: Optional[int] = None):
+        self.memory = LRUCache(max_entries, ttl=ttl)
+        self.disk = DiskCache(cache_dir, ttl=ttl, max_bytes=max_bytes) if cache_dir else None
+
+    @property
+    def enabled(self) -> bool:
+        return self.memory.max_entries > 0 or self.disk is not None
+
+    @staticmethod
+    def key(image: np.ndarray, params: dict) -> str:
+        """ image: decoded RGB pixels; params: JSON serializable parse parameters """
+        image = np.ascontiguousarray(image)
+        h = hashlib.sha1()
+        h.update(f"{json.dumps(params, sort_keys=True, default=str)}\0{image.shape}\0{image.dtype}\0".encode('utf-8'))
+        h.update(image.data)
+        return h.hexdigest()
+
+    def get(self, key: str) -> Tuple[Optional[ParseResult], Optional[str]]:
+        """ Returns the cached result and the tier it came from ('memory' or 'disk'), or (None, None). """
+        result = self.memory.get(key)
+        if result is not None:
+            RESPONSE_CACHE.inc(result='memory')
+            return result, 'memory'
+        if self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                result = ParseResult.from_dict(json.loads(value))
+                self.memory.put(key, result)
+                RESPONSE_CACHE.inc(result='disk')
+                return result, 'disk'
+        RESPONSE_CACHE.inc(result='miss')
+        return None, None
+
+    def put(self, key: str, result: ParseResult):
+        self.memory.put(key, result)
+        if self.disk is not None:
+            self.disk.put(key, json.dumps(result.to_dict(include_image=True)).encode('utf-8'))
+
+
+response_cache = ResponseCache(max_entries=RESPONSE_CACHE_SIZE, cache_dir=RESPONSE_CACHE_DIR, ttl=RESPONSE_CACHE_TTL or None,
+                               max_bytes=int(RESPONSE_CACHE_MAX_MB * 1024 * 1024) or None)
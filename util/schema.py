@@ -0,0 +1,127 @@
+from dataclasses import dataclass, field, asdict
+from typing import List, Optional
+
+import numpy as np
+
+MSGPACK_MIMETYPES = ('application/msgpack', 'application/x-msgpack')
+
+
+def response_mimetype(accept: Optional[str]) -> str:
+    """ Media type of a parse response for an Accept header: application/json, or one of MSGPACK_MIMETYPES when
+        the client prefers it (q-values apply, JSON wins ties and wildcards).
+    """
+    from werkzeug.datastructures import MIMEAccept
+    from werkzeug.http import parse_accept_header
+
+    return parse_accept_header(accept, MIMEAccept).best_match(('application/json',) + MSGPACK_MIMETYPES,
+                                                              default='application/json')
+
+
+@dataclass
+class ParsedElement:
+    """
+    One parsed screen element.
+
+    Attributes:
+        id (int): Index of the element, the number drawn on the annotated image
+        type (str): 'text' for OCR boxes, 'icon' for detected icons
+        bbox (List[float]): xyxy in pixels
+        bbox_ratio (List[float]): xyxy as fractions of the image width and height
+        content (Optional[str]): OCR text or icon caption, None for icons when captioning is disabled
+        confidence (Optional[float]): Detector confidence of icons, None for text boxes
+    """
+    id: int
+    type: str
+    bbox: List[float]
+    bbox_ratio: List[float]
+    content: Optional[str] = None
+    confidence: Optional[float] = None
+
+
+@dataclass
+class ParseResult:
+    """
+    Structured output of a parse: the elements in id order (text boxes first, then icons).
+
+    Attributes:
+        width (int): Image width in pixels
+        height (int): Image height in pixels
+        elements (List[ParsedElement]): Parsed elements
+        image (Optional[str]): Base64 annotated image, None in parse-only mode
+    """
+    width: int
+    height: int
+    elements: List[ParsedElement] = field(default_factory=list)
+    image: Optional[str] = None
+
+    @classmethod
+    def from_boxes(cls, width: int, height: int, types: List[str], boxes_ratio, contents: List[Optional[str]],
+                   confidences: List[Optional[float]], image: Optional[str] = None) -> 'ParseResult':
+        """ boxes_ratio: (N, 4) xyxy ratios, one row per element. Boxes are rounded to 1/100 pixel,
+            which drops the float32 noise of the ratio round trip.
+        """
+        boxes_ratio = np.asarray(boxes_ratio, dtype=np.float64).reshape(-1, 4)
+        boxes = np.round(boxes_ratio * np.array([width, height, width, height]), 2)
+        boxes_ratio = np.round(boxes_ratio, 6)
+        elements = [ParsedElement(i, element_type, box.tolist(), box_ratio.tolist(), content,
+                                  None if confidence is None else float(confidence))
+                    for i, (element_type, box, box_ratio, content, confidence)
+                    in enumerate(zip(types, boxes, boxes_ratio, contents, confidences))]
+        return cls(width, height, elements, image)
+
+    def parsed_content_list(self) -> List[str]:
+        """ The legacy "Text Box ID i: ..." / "Icon Box ID i: ..." lines. """
+        lines = []
+        for element in self.elements:
+            if element.type == 'text':
+                lines.append(f"Text Box ID {element.id}: {element.content}")
+            elif element.content is not None:
+                lines.append(f"Icon Box ID {element.id}: {element.content}")
+        return lines
+
+    def to_dict(self, include_image: bool = True) -> dict:
+        result = asdict(self)
+        if not include_image or self.image is None:
+            result.pop('image')
+        return result
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'ParseResult':
+        """ Inverse of to_dict. """
+        return cls(data['width'], data['height'], [ParsedElement(**element) for element in data['elements']], data.get('image'))
+
+    def to_msgpack(self, include_image: bool = True, extra: Optional[dict] = None) -> bytes:
+        """
+        Compact binary encoding: one list per field instead of one map per element, with the
+        boxes and confidences packed as little-endian float32 arrays (NaN for a missing confidence).
+        Ratios are not sent, they are recomputed from the pixel boxes by from_msgpack.
+        extra: additional top-level fields, e.g. the delta of an incremental parse
+        """
+        import msgpack
+
+        confidences = [np.nan if e.confidence is None else e.confidence for e in self.elements]
+        payload = {
+            'width': self.width,
+            'height': self.height,
+            'type': [e.type for e in self.elements],
+            'content': [e.content for e in self.elements],
+            'bbox': np.asarray([e.bbox for e in self.elements], dtype='<f4').reshape(-1, 4).tobytes(),
+            'confidence': np.asarray(confidences, dtype='<f4').tobytes(),
+        }
+        if include_image and self.image is not None:
+            payload['image'] = self.image
+        if extra:
+            payload.update(extra)
+        return msgpack.packb(payload, use_bin_type=True)
+
+    @classmethod
+    def from_msgpack(cls, data: bytes) -> 'ParseResult':
+        import msgpack
+
+        payload = msgpack.unpackb(data, raw=False)
+        width, height = payload['width'], payload['height']
+        boxes = np.frombuffer(payload['bbox'], dtype='<f4').reshape(-1, 4).astype(np.float64)
+        confidences = [None if np.isnan(c) else float(c) for c in np.frombuffer(payload['confidence'], dtype='<f4')]
+        boxes_ratio = boxes / np.array([width, height, width, height]) if len(boxes) else boxes
+        return cls.from_boxes(width, height, payload['type'], boxes_ratio, payload['content'], confidences,
+                              payload.get('image'))
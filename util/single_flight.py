@@ -0,0 +1,47 @@
+import threading
+from concurrent.futures import Future
+from typing import Callable, Tuple
+
+from util.metrics import COALESCED
+
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent calls: while a call for a key is running, other calls with the
+    same key wait for its result instead of running their own.
+
+    Only in-flight calls are shared, nothing is kept once the call returns (see
+    util.response_cache for that). Exceptions are shared too, every waiter sees the leader's.
+
+    Example:
+        ```python
+        flights = SingleFlight()
+        result, shared = flights.do(key, lambda: parse_image(image, model, return_result=True))
+        ```
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._calls)
+
+    def do(self, key: str, fn: Callable) -> Tuple[object, bool]:
+        """ Returns fn's result (or that of the identical call already running) and whether it was shared. """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+        if not leader:
+            COALESCED.inc(layer='parse')
+            return future.result(), True
+        try:
+            future.set_result(fn())
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                del self._calls[key]
+        return future.result(), False
@@ -0,0 +1,129 @@
+import os
+import pickle
+import queue
+import subprocess
+import sys
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Tuple
+
+import cv2
+import numpy as np
+
+from util.ocr_pool import easyocr_readtext, get_ocr_pool, preload_ocr_engine
+
+
+# Tiled OCR worker processes run this module (python -m util.tile_worker <backend>): they load the OCR engine
+# and nothing else, whatever the parent's __main__ is (a Gradio/Flask app, the omniparser demo).
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def ocr_tile(tile: np.ndarray, use_paddleocr: bool, easyocr_args: dict) -> Tuple[list, list]:
+    """
+    OCR of one RGB tile, run inside a worker process with that process' own engine.
+
+    Returns:
+        (coord, text): quadrilaterals as lists of 4 [x, y] points in tile coordinates, and their text
+    """
+    if use_paddleocr:
+        with get_ocr_pool(use_paddleocr=True).checkout() as paddle_ocr:
+            result = paddle_ocr.ocr(cv2.cvtColor(tile, cv2.COLOR_RGB2BGR), cls=False)[0] or []
+        text = [item[1][0] for item in result]
+    else:
+        with get_ocr_pool(use_paddleocr=False).checkout() as reader:
+            result = easyocr_readtext(reader, tile, **(easyocr_args or {}))
+        text = [item[1] for item in result]
+    coord = [[[float(x), float(y)] for x, y in item[0]] for item in result]
+    return coord, text
+
+
+class TileWorker:
+    """ One worker process, driven over its stdin/stdout with pickled (tile, easyocr_args) requests. """
+
+    def __init__(self, use_paddleocr: bool):
+        pythonpath = os.pathsep.join(filter(None, [ROOT, os.environ.get('PYTHONPATH')]))
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'util.tile_worker', 'paddleocr' if use_paddleocr else 'easyocr'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=dict(os.environ, PYTHONPATH=pythonpath))
+
+    def call(self, tile: np.ndarray, easyocr_args: dict) -> Tuple[list, list]:
+        pickle.dump((tile, easyocr_args), self.process.stdin, protocol=pickle.HIGHEST_PROTOCOL)
+        self.process.stdin.flush()
+        ok, value = pickle.load(self.process.stdout)
+        if not ok:
+            raise value
+        return value
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        self.process.wait()
+
+
+class TileWorkerPool:
+    """
+    A fixed set of worker processes of one OCR backend. Workers are started with the pool, a tile is sent to
+    the first idle one and a worker that died is replaced for the next tile.
+
+    Attributes:
+        use_paddleocr (bool): OCR backend of every worker of the pool
+        max_workers (int): Number of worker processes
+    """
+
+    def __init__(self, use_paddleocr: bool, max_workers: int):
+        self.use_paddleocr = bool(use_paddleocr)
+        self.max_workers = max(1, int(max_workers))
+        self._idle = queue.LifoQueue()
+        for _ in range(self.max_workers):
+            self._idle.put(TileWorker(self.use_paddleocr))
+        self._threads = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='tile-ocr')
+
+    def submit(self, tile: np.ndarray, easyocr_args: dict) -> Future:
+        return self._threads.submit(self._run, tile, easyocr_args)
+
+    def _run(self, tile, easyocr_args):
+        worker = self._idle.get()
+        try:
+            return worker.call(tile, easyocr_args)
+        except (EOFError, OSError, pickle.UnpicklingError):
+            worker.close()
+            worker = TileWorker(self.use_paddleocr)
+            raise RuntimeError("tiled OCR worker process exited, it was restarted")
+        finally:
+            self._idle.put(worker)
+
+
+def main():
+    use_paddleocr = sys.argv[1] == 'paddleocr'
+    # replies go to the original stdout, whatever the OCR libraries print goes to stderr
+    replies = os.fdopen(os.dup(1), 'wb')
+    os.dup2(2, 1)
+    sys.stdout = sys.stderr
+    requests = sys.stdin.buffer
+    try:
+        preload_ocr_engine(use_paddleocr)
+        engine_error = None
+    except Exception as e:
+        engine_error = e
+    while True:
+        try:
+            tile, easyocr_args = pickle.load(requests)
+        except EOFError:
+            return
+        try:
+            if engine_error is not None:
+                raise engine_error
+            reply = (True, ocr_tile(tile, use_paddleocr, easyocr_args))
+        except Exception as e:
+            reply = (False, e)
+        try:
+            data = pickle.dumps(reply, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            data = pickle.dumps((False, RuntimeError(repr(reply[1]))), protocol=pickle.HIGHEST_PROTOCOL)
+        replies.write(data)
+        replies.flush()
+
+
+if __name__ == '__main__':
+    main()
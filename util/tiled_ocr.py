@@ -0,0 +1,110 @@
+import os
+import threading
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from util.tile_worker import TileWorkerPool
+
+
+# Tiled OCR is used for images whose width or height exceeds OCR_TILE_SIZE (pixels).
+# OCR_TILE_OVERLAP should be larger than the longest text line expected to cross a tile seam.
+OCR_TILED = os.getenv("OCR_TILED", "False").lower() == "true"
+OCR_TILE_SIZE = int(os.getenv("OCR_TILE_SIZE", 1280))
+OCR_TILE_OVERLAP = int(os.getenv("OCR_TILE_OVERLAP", 256))
+OCR_TILE_WORKERS = int(os.getenv("OCR_TILE_WORKERS", min(4, os.cpu_count() or 1)))
+
+
+def tile_grid(width: int, height: int, tile_size: int, overlap: int) -> List[List[int]]:
+    """
+    Overlapping tiles covering the image, in pixel xyxy format. The last row and column are
+    aligned to the image border so every tile has the full size when the image allows it.
+    """
+    def starts(length):
+        if length <= tile_size:
+            return [0]
+        step = max(1, tile_size - overlap)
+        positions = list(range(0, length - tile_size, step))
+        return positions + [length - tile_size]
+
+    return [[x, y, min(width, x + tile_size), min(height, y + tile_size)]
+            for y in starts(height) for x in starts(width)]
+
+
+def dedupe_seams(coord: list, text: list, tile_ids: list, containment: float = 0.5) -> Tuple[list, list]:
+    """
+    Drop text boxes found twice in the overlap of neighbouring tiles.
+
+    Boxes are visited from the largest to the smallest; a box is dropped when more than
+    `containment` of its area lies inside a kept box of another tile. This removes exact
+    duplicates as well as the partial box of a line cut by a tile seam. The input order is
+    preserved for the kept boxes.
+    """
+    if not coord:
+        return coord, text
+    quads = np.asarray(coord, dtype=np.float64)
+    boxes = np.concatenate([quads.min(axis=1), quads.max(axis=1)], axis=1)
+    areas = np.clip(boxes[:, 2] - boxes[:, 0], 0, None) * np.clip(boxes[:, 3] - boxes[:, 1], 0, None)
+    kept = []
+    for i in np.argsort(-areas, kind='stable'):
+        duplicate = False
+        for j in kept:
+            if tile_ids[i] == tile_ids[j]:
+                continue
+            iw = min(boxes[i, 2], boxes[j, 2]) - max(boxes[i, 0], boxes[j, 0])
+            ih = min(boxes[i, 3], boxes[j, 3]) - max(boxes[i, 1], boxes[j, 1])
+            if iw > 0 and ih > 0 and iw * ih > containment * max(areas[i], 1e-6):
+                duplicate = True
+                break
+        if not duplicate:
+            kept.append(i)
+    kept.sort()
+    return [coord[i] for i in kept], [text[i] for i in kept]
+
+
+_pools: Dict[bool, TileWorkerPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_tile_pool(use_paddleocr: bool = False) -> TileWorkerPool:
+    """ Per-process pool of OCR worker processes of the selected backend, created on first use.
+        The workers run util.tile_worker in a fresh interpreter: they never inherit a CUDA context or held locks,
+        and load the OCR engine only, never the parent's models.
+    """
+    use_paddleocr = bool(use_paddleocr)
+    with _pools_lock:
+        if use_paddleocr not in _pools:
+            _pools[use_paddleocr] = TileWorkerPool(use_paddleocr, OCR_TILE_WORKERS)
+        return _pools[use_paddleocr]
+
+
+def _forget_pools_after_fork():
+    # the pipes of the workers belong to the parent, a forked child starts its own workers
+    global _pools_lock
+    _pools.clear()
+    _pools_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_pools_after_fork)
+
+
+def tiled_ocr(image_np: np.ndarray, use_paddleocr: bool = False, easyocr_args: dict = None,
+              tile_size: int = OCR_TILE_SIZE, overlap: int = OCR_TILE_OVERLAP) -> Tuple[list, list]:
+    """
+    OCR a large RGB image as overlapping tiles in parallel processes.
+
+    Returns:
+        (coord, text) in full image coordinates, in the same layout as a single engine call
+    """
+    h, w = image_np.shape[:2]
+    tiles = tile_grid(w, h, tile_size, overlap)
+    pool = get_tile_pool(use_paddleocr)
+    futures = [pool.submit(np.ascontiguousarray(image_np[y1:y2, x1:x2]), easyocr_args) for x1, y1, x2, y2 in tiles]
+    coord, text, tile_ids = [], [], []
+    for tile_id, ((x1, y1, _, _), future) in enumerate(zip(tiles, futures)):
+        tile_coord, tile_text = future.result()
+        coord.extend([[x + x1, y + y1] for x, y in quad] for quad in tile_coord)
+        text.extend(tile_text)
+        tile_ids.extend([tile_id] * len(tile_text))
+    return dedupe_seams(coord, text, tile_ids)
@@ -0,0 +1,59 @@
+import json
+import mmap
+import os
+import struct
+import tempfile
+from typing import Dict
+
+import torch
+
+
+_DTYPES = {
+    'F64': torch.float64, 'F32': torch.float32, 'F16': torch.float16, 'BF16': torch.bfloat16,
+    'I64': torch.int64, 'I32': torch.int32, 'I16': torch.int16, 'I8': torch.int8,
+    'U8': torch.uint8, 'BOOL': torch.bool,
+}
+
+
+def load_safetensors_mmap(path: str) -> Dict[str, torch.Tensor]:
+    """
+    Load a .safetensors file as CPU tensors that point straight into a memory map of the file.
+
+    Nothing is read or copied up front: pages are faulted in from the page cache on first use,
+    so processes loading the same file share its memory. The mapping is private (copy-on-write),
+    a tensor modified in place gets its own copy of the touched pages and the file is never written.
+    """
+    with open(path, 'rb') as f:
+        header_size = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_size))
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    data_start = 8 + header_size
+    tensors = {}
+    for name, info in header.items():
+        if name == '__metadata__':
+            continue
+        dtype = _DTYPES[info['dtype']]
+        begin, end = info['data_offsets']
+        itemsize = torch.empty((), dtype=dtype).element_size()
+        if end == begin:
+            tensors[name] = torch.empty(info['shape'], dtype=dtype)
+            continue
+        tensor = torch.frombuffer(buffer, dtype=dtype, count=(end - begin) // itemsize, offset=data_start + begin)
+        tensors[name] = tensor.reshape(info['shape'])
+    return tensors
+
+
+def save_safetensors(tensors: Dict[str, torch.Tensor], path: str):
+    """ Write tensors to a .safetensors file atomically (temp file renamed into place). """
+    from safetensors.torch import save_file
+
+    tensors = {name: tensor.detach().cpu().contiguous() for name, tensor in tensors.items()}
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.tmp-', suffix='.safetensors')
+    os.close(fd)
+    try:
+        save_file(tensors, tmp_path)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
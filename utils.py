@@ -10,6 +10,7 @@ import requests
 import os
 from openai import AzureOpenAI
 
+import gc
 import json
 import sys
 import os
@@ -17,35 +18,69 @@ import cv2
 import numpy as np
 # %matplotlib inline
 from matplotlib import pyplot as plt
-import easyocr
-from paddleocr import PaddleOCR
-reader = easyocr.Reader(['en'])
-paddle_ocr = PaddleOCR(
-    lang='en',  # other lang also available
-    use_angle_cls=False,
-    use_gpu=False,  # using cuda will conflict with pytorch in the same process
-    show_log=False,
-    max_batch_size=1024,
-    use_dilation=True,  # improves accuracy
-    det_db_score_mode='slow',  # improves accuracy
-    rec_batch_num=1024)
+from util.ocr_pool import easyocr_readtext, get_ocr_pool
+from util.tiled_ocr import OCR_TILED, OCR_TILE_SIZE, OCR_TILE_OVERLAP, tiled_ocr, tile_grid
+from util.caption_cache import caption_cache
+from util.response_cache import ResponseCache, response_cache
+from util.single_flight import SingleFlight
+from util.cache import LRUCache
+from util.schema import ParseResult
+from util.weights import load_safetensors_mmap, save_safetensors
+from util.onnx_detector import OnnxDetector, export_onnx, quantize_onnx_int8
+from util.crop_preprocess import fixed_size_config, preprocess_crops, left_pad
+from util.frame_diff import dirty_block_mask, dirty_regions, expand_regions, boxes_intersect
+from util.metrics import stage_timer, timed_stage, OCR_LINES, BOXES, CAPTION_BATCH_SIZE, MODEL_LOAD_SECONDS
 import time
 import base64
 
 import os
 import ast
 import torch
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from typing import Tuple, List
-from torchvision.ops import box_convert
+from torchvision.ops import box_convert, nms
 import re
 from torchvision.transforms import ToPILImage
 import supervision as sv
 import torchvision.transforms as T
 
 
-def get_caption_model_processor(model_name, model_name_or_path="Salesforce/blip2-opt-2.7b", device=None):
+# Caption model precision on CPU: fp32, int8 (dynamic quantization of the linear layers) or bf16 (autocast,
+# only where the CPU has native bf16 support). GPUs always run the caption model in fp16.
+CAPTION_PRECISION = os.getenv("CAPTION_PRECISION", "fp32").lower()
+# Caption decoding profile: beam (num_beams=3 for Florence-2) or greedy, bounded to CAPTION_MAX_NEW_TOKENS tokens
+CAPTION_DECODING = os.getenv("CAPTION_DECODING", "beam").lower()
+CAPTION_MAX_NEW_TOKENS = int(os.getenv("CAPTION_MAX_NEW_TOKENS", 20))
+
+
+def cpu_supports_bf16():
+    """ Native bf16 matmuls (AVX512-BF16 or AMX); elsewhere bf16 autocast is emulated and slower than fp32. """
+    for check in ('_is_amx_tile_supported', '_is_avx512_bf16_supported'):
+        if getattr(torch.cpu, check, lambda: False)():
+            return True
+    return False
+
+
+def get_caption_model_processor(model_name, model_name_or_path="Salesforce/blip2-opt-2.7b", device=None, precision=None, decoding=None):
+    """ precision: 'fp32', 'int8' or 'bf16' on CPU, None to follow CAPTION_PRECISION. bf16 falls back to fp32
+            on CPUs without native support, and on GPUs the model always runs in fp16.
+        decoding: 'beam' or 'greedy', None to follow CAPTION_DECODING
+        The returned dict records the precision and decoding actually used, for generate_captions and the caption cache.
+    """
+    start = time.perf_counter()
     if not device:
         device = "cuda" if torch.cuda.is_available() else "cpu"
+    precision = (precision or CAPTION_PRECISION).lower()
+    decoding = (decoding or CAPTION_DECODING).lower()
+    if precision not in ('fp32', 'int8', 'bf16'):
+        raise ValueError(f"unknown caption precision {precision!r}, expected fp32, int8 or bf16")
+    if decoding not in ('beam', 'greedy'):
+        raise ValueError(f"unknown caption decoding {decoding!r}, expected beam or greedy")
+    if device != 'cpu':
+        precision = 'fp16'
+    elif precision == 'bf16' and not cpu_supports_bf16():
+        print("caption precision bf16 is not natively supported by this CPU, using fp32")
+        precision = 'fp32'
     if model_name == "blip2":
         from transformers import Blip2Processor, Blip2ForConditionalGeneration
         processor = Blip2Processor.from_pretrained("Salesforce/blip2-opt-2.7b")
@@ -64,154 +99,414 @@ def get_caption_model_processor(model_name, model_name_or_path="Salesforce/blip2
             model = AutoModelForCausalLM.from_pretrained(model_name_or_path, torch_dtype=torch.float32, trust_remote_code=True)
         else:
             model = AutoModelForCausalLM.from_pretrained(model_name_or_path, torch_dtype=torch.float16, trust_remote_code=True).to(device)
-    return {'model': model.to(device), 'processor': processor}
+    model = model.to(device)
+    if precision == 'int8':
+        # int8 weights, activations quantized on the fly: no calibration, the vision tower convs stay fp32
+        model = torch.ao.quantization.quantize_dynamic(model.eval(), {torch.nn.Linear}, dtype=torch.qint8)
+    MODEL_LOAD_SECONDS.set(time.perf_counter() - start, model=model_name)
+    return {'model': model, 'processor': processor, 'precision': precision, 'decoding': decoding}
+
+
+def caption_options(caption_model_processor):
+    """ generate_captions keyword arguments of a caption_model_processor (dicts built by hand default to fp32/beam). """
+    return {'precision': caption_model_processor.get('precision', 'fp32'),
+            'decoding': caption_model_processor.get('decoding', 'beam')}
+
+
+def caption_model_id(caption_model_processor):
+    """ Caption cache model id: the model path, plus precision and decoding when they differ from the defaults,
+        since they change the captions.
+    """
+    model_id = caption_model_processor['model'].config.name_or_path
+    options = caption_options(caption_model_processor)
+    if options['precision'] in ('fp32', 'fp16') and options['decoding'] == 'beam':
+        return model_id
+    return f"{model_id}\0{options['precision']}\0{options['decoding']}"
+
+
+# Keep a conv+bn fused copy of safetensors weights next to them (model.fused.safetensors) and memory-map that.
+# Without it every process holds its own fused copy of the weights.
+YOLO_FUSED_CACHE = os.getenv("YOLO_FUSED_CACHE", "True").lower() == "true"
 
 
-def get_yolo_model(model_path):
+def is_fresh(path, source):
+    """ True when the file derived from source exists and is not older than it (source None: exists). """
+    if not os.path.exists(path):
+        return False
+    return source is None or not os.path.exists(source) or os.path.getmtime(path) >= os.path.getmtime(source)
+
+
+def load_yolo_safetensors(weights_path, yaml_path, fused_cache=True):
+    """ Build the detector from model.yaml and assign it the memory-mapped model.safetensors tensors,
+        without unpickling a model.pt. Conv+bn are fused here rather than by the first predict, which would
+        replace every weight with a new anonymous tensor. With fused_cache the fused weights are written once
+        to model.fused.safetensors and memory-mapped from there, so processes share them through the page
+        cache; without it, or when that file cannot be written, each process keeps its own fused copy.
+    """
     from ultralytics import YOLO
-    # Load the model.
-    model = YOLO(model_path)
+
+    model = YOLO(yaml_path, task='detect')
+    fused_path = os.path.splitext(weights_path)[0] + '.fused.safetensors'
+    fresh = is_fresh(fused_path, weights_path)
+    if not (fused_cache and fresh):
+        model.model.load_state_dict(load_safetensors_mmap(weights_path), assign=True)
+    with torch.no_grad():
+        # on a freshly built module this only fixes the structure, its random weights are replaced below
+        model.model.fuse(verbose=False)
+    if fused_cache and not fresh:
+        try:
+            save_safetensors(model.model.state_dict(), fused_path)
+            fresh = True
+        except OSError as e:
+            print(f"could not write {fused_path} ({e}), the fused detector weights are not shared")
+    shared = fused_cache and fresh
+    if shared:
+        model.model.load_state_dict(load_safetensors_mmap(fused_path), assign=True)
+    # inference only, assign=True kept the requires_grad flags of the freshly built parameters
+    model.model.requires_grad_(False)
+    model.model.eval()
+    # no checkpoint for the ultralytics ckpt_path, detector_id identifies the weights by this file instead
+    model.weights_path = os.path.abspath(weights_path)
     return model
 
 
-@torch.inference_mode()
-def get_parsed_content_icon(filtered_boxes, ocr_bbox, image_source, caption_model_processor, prompt=None):
-    to_pil = ToPILImage()
+# Icon detector runtime: torch (ultralytics), onnx (onnxruntime CPU) or onnx-int8 (dynamically quantized)
+YOLO_BACKEND = os.getenv("YOLO_BACKEND", "torch").lower()
+
+
+def get_onnx_detector(yolo_model, directory, int8=False):
+    """ OnnxDetector of model.onnx / model.int8.onnx in directory, exported from yolo_model when missing
+        or older than the weights yolo_model was loaded from.
+    """
+    onnx_path = os.path.join(directory, 'model.onnx')
+    int8_path = os.path.join(directory, 'model.int8.onnx')
+    weights_path = getattr(yolo_model, 'weights_path', None) or getattr(yolo_model, 'ckpt_path', None)
+    if not is_fresh(onnx_path, weights_path):
+        export_onnx(yolo_model, onnx_path)
+    if int8 and not is_fresh(int8_path, onnx_path):
+        quantize_onnx_int8(onnx_path, int8_path)
+    return OnnxDetector(int8_path if int8 else onnx_path)
+
+
+def get_yolo_model(model_path, fused_cache=None, backend=None):
+    """ model_path: an ultralytics .pt file, or a model.safetensors (or the directory holding it) next to model.yaml,
+        which is loaded memory-mapped by load_yolo_safetensors. A missing model.pt falls back to the
+        model.safetensors of its directory, so weights/convert_safetensor_to_pt.py is not needed.
+        fused_cache: see load_yolo_safetensors, None to follow YOLO_FUSED_CACHE
+        backend: 'torch', 'onnx' or 'onnx-int8', None to follow YOLO_BACKEND. The onnx backends return an
+            OnnxDetector with the same predict contract, exported (and quantized) next to the weights on first use.
+            A model_path ending in .onnx is always loaded with onnxruntime.
+    """
+    from ultralytics import YOLO
+    start = time.perf_counter()
+    backend = (backend or YOLO_BACKEND).lower()
+    if model_path.endswith('.onnx'):
+        model = OnnxDetector(model_path)
+        MODEL_LOAD_SECONDS.set(time.perf_counter() - start, model='yolo')
+        return model
+    if backend not in ('torch', 'onnx', 'onnx-int8'):
+        raise ValueError(f"unknown detector backend {backend!r}, expected torch, onnx or onnx-int8")
+    directory = model_path if os.path.isdir(model_path) else os.path.dirname(model_path)
+    weights_path = model_path if model_path.endswith('.safetensors') else os.path.join(directory, 'model.safetensors')
+    if (model_path.endswith('.safetensors') or not os.path.isfile(model_path)) and os.path.isfile(weights_path):
+        model = load_yolo_safetensors(weights_path, os.path.join(directory, 'model.yaml'),
+                                      fused_cache=YOLO_FUSED_CACHE if fused_cache is None else fused_cache)
+    else:
+        # Load the model.
+        model = YOLO(model_path)
+    if backend != 'torch':
+        model = get_onnx_detector(model, directory, int8=backend == 'onnx-int8')
+    MODEL_LOAD_SECONDS.set(time.perf_counter() - start, model='yolo')
+    return model
+
+
+def share_models(*models):
+    """ Prepare models loaded in the gunicorn master (--preload) to be shared by the forked workers.
+        The weights stay where they are: forked workers map the master's pages copy-on-write and inference
+        only reads them. The objects alive now are frozen out of the cyclic garbage collector, whose scans
+        would otherwise write to the object headers and copy those pages into each worker. Nothing is moved
+        to /dev/shm, which Docker limits to 64MB by default.
+        models: torch modules, YOLO models, caption_model_processor dicts or easyocr readers, checked to be on the CPU
+    """
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        raise RuntimeError("preload mode needs the models on the CPU: CUDA cannot be used in forked workers once "
+                           "the master initialized it (hide the GPUs with CUDA_VISIBLE_DEVICES= or disable PRELOAD)")
+    for model in models:
+        if isinstance(model, dict):
+            model = model['model']
+        # YOLO wraps its module in .model, easyocr.Reader has a detector and a recognizer
+        candidates = [model] + [getattr(model, attr, None) for attr in ('model', 'detector', 'recognizer')]
+        for module in candidates:
+            if isinstance(module, torch.nn.Module) and any(p.device.type != 'cpu' for p in module.parameters()):
+                raise RuntimeError(f"preload mode needs the models on the CPU, {type(module).__name__} is not")
+    gc.collect()
+    gc.freeze()
+
+
+def crop_icon_images(filtered_boxes, ocr_bbox, image_source):
+    """ Slice every non-ocr box (xyxy, ratio) out of the RGB ndarray image_source.
+    """
     if ocr_bbox:
         non_ocr_boxes = filtered_boxes[len(ocr_bbox):]
     else:
         non_ocr_boxes = filtered_boxes
-    croped_pil_image = []
+    cropped_images = []
     for i, coord in enumerate(non_ocr_boxes):
         xmin, xmax = int(coord[0]*image_source.shape[1]), int(coord[2]*image_source.shape[1])
         ymin, ymax = int(coord[1]*image_source.shape[0]), int(coord[3]*image_source.shape[0])
-        cropped_image = image_source[ymin:ymax, xmin:xmax, :]
-        croped_pil_image.append(to_pil(cropped_image))
+        cropped_images.append(image_source[ymin:ymax, xmin:xmax, :])
+    return cropped_images
 
-    model, processor = caption_model_processor['model'], caption_model_processor['processor']
-    if not prompt:
-        if 'florence' in model.config.name_or_path:
-            prompt = "<CAPTION>"
-        else:
-            prompt = "The image shows"
 
-    batch_size = 10  # Number of samples per batch
-    generated_texts = []
-    device = model.device
+def lookup_cached_captions(cropped_images, model_id, prompt, cache):
+    """ Returns the cache keys, the captions found (None for a miss) and the indices of the misses.
+    """
+    if cache is None:
+        return [None] * len(cropped_images), [None] * len(cropped_images), list(range(len(cropped_images)))
+    keys = [cache.key(crop, model_id, prompt) for crop in cropped_images]
+    captions = [cache.get(key) for key in keys]
+    miss_idx = [i for i, caption in enumerate(captions) if caption is None]
+    return keys, captions, miss_idx
+
 
-    for i in range(0, len(croped_pil_image), batch_size):
-        batch = croped_pil_image[i:i+batch_size]
+_prompt_inputs_cache = LRUCache(64)
+
+
+def _prompt_inputs(processor, prompt):
+    """ The text inputs (input_ids, attention_mask) the processor builds for prompt, computed once per prompt. """
+    key = f"{id(processor)}\0{prompt}"
+    inputs = _prompt_inputs_cache.get(key)
+    if inputs is None:
+        # the processor wants an image along the prompt, a blank one is enough for the text side
+        inputs = processor(images=[Image.new('RGB', (32, 32))], text=[prompt], return_tensors="pt")
+        inputs = {k: v for k, v in inputs.items() if k != 'pixel_values'}
+        _prompt_inputs_cache.put(key, inputs)
+    return inputs
+
+
+@torch.inference_mode()
+def generate_captions(model, processor, images, prompt, precision='fp32', decoding='beam'):
+    """ Caption one batch of images (RGB ndarray crops or PIL images) with Florence-2 / BLIP2.
+        ndarray crops skip PIL and the per-image processor calls when the image processor is a plain
+        fixed-size resize + normalize, see util.crop_preprocess.preprocess_crops.
+        precision: 'bf16' runs the model under CPU bf16 autocast, other values use the model as loaded
+        decoding: 'greedy' decodes at most CAPTION_MAX_NEW_TOKENS tokens without beam search
+    """
+    CAPTION_BATCH_SIZE.observe(len(images))
+    device = model.device
+    crop_config = fixed_size_config(getattr(processor, 'image_processor', None))
+    if crop_config is not None and all(isinstance(image, np.ndarray) for image in images):
+        # crops straight from the screenshot array, resized and normalized as one batch
+        inputs = {k: v.repeat(len(images), *[1] * (v.dim() - 1)).to(device) for k, v in _prompt_inputs(processor, prompt).items()}
+        inputs['pixel_values'] = preprocess_crops(images, *crop_config).to(
+            device=device, dtype=torch.float16 if model.device.type == 'cuda' else torch.float32)
+    else:
+        images = [Image.fromarray(image) if isinstance(image, np.ndarray) else image for image in images]
         if model.device.type == 'cuda':
-            inputs = processor(images=batch, text=[prompt]*len(batch), return_tensors="pt").to(device=device, dtype=torch.float16)
+            inputs = processor(images=images, text=[prompt]*len(images), return_tensors="pt").to(device=device, dtype=torch.float16)
         else:
-            inputs = processor(images=batch, text=[prompt]*len(batch), return_tensors="pt").to(device=device)
-        if 'florence' in model.config.name_or_path:
+            inputs = processor(images=images, text=[prompt]*len(images), return_tensors="pt").to(device=device)
+    with torch.autocast('cpu', dtype=torch.bfloat16, enabled=precision == 'bf16'):
+        if decoding == 'greedy':
+            generation_args = {'max_new_tokens': CAPTION_MAX_NEW_TOKENS, 'num_beams': 1, 'do_sample': False}
+            if 'florence' in model.config.name_or_path:
+                generated_ids = model.generate(input_ids=inputs["input_ids"], pixel_values=inputs["pixel_values"], **generation_args)
+            else:
+                generated_ids = model.generate(**inputs, **generation_args)
+        elif 'florence' in model.config.name_or_path:
             generated_ids = model.generate(input_ids=inputs["input_ids"],pixel_values=inputs["pixel_values"],max_new_tokens=1024,num_beams=3, do_sample=False)
         else:
             generated_ids = model.generate(**inputs, max_length=100, num_beams=5, no_repeat_ngram_size=2, early_stopping=True, num_return_sequences=1) # temperature=0.01, do_sample=True,
-        generated_text = processor.batch_decode(generated_ids, skip_special_tokens=True)
-        generated_text = [gen.strip() for gen in generated_text]
-        generated_texts.extend(generated_text)
+    generated_text = processor.batch_decode(generated_ids, skip_special_tokens=True)
+    return [gen.strip() for gen in generated_text]
 
-    return generated_texts
 
+@torch.inference_mode()
+def generate_captions_phi3v(model, processor, images, prompt, precision='fp32', decoding='beam'):
+    """ Caption one batch of PIL images with Phi-3-V. Decoding is always greedy and short, so only precision applies.
+    """
+    CAPTION_BATCH_SIZE.observe(len(images))
+    device = model.device
+    # one image processor call for the whole batch (every image is padded to the same number of crops),
+    # then per-image tokenization, since the number of image tokens depends on each image's size
+    image_inputs = processor.image_processor(images, return_tensors="pt")
+    input_ids, attention_mask = [], []
+    for i in range(len(images)):
+        sample = {'pixel_values': image_inputs['pixel_values'][i:i+1], 'image_sizes': image_inputs['image_sizes'][i:i+1],
+                  'num_img_tokens': image_inputs['num_img_tokens'][i:i+1]}
+        input = processor._convert_images_texts_to_inputs(sample, prompt, return_tensors="pt")
+        input_ids.append(input['input_ids'][0])
+        attention_mask.append(input['attention_mask'][0])
+    inputs_cat = {
+        'input_ids': left_pad(input_ids, processor.tokenizer.pad_token_id),
+        'attention_mask': left_pad(attention_mask, 0),
+        'pixel_values': image_inputs['pixel_values'],
+        'image_sizes': image_inputs['image_sizes'],
+    }
+    inputs_cat = {k: v.to(device) for k, v in inputs_cat.items()}
 
+    generation_args = { 
+        "max_new_tokens": 25, 
+        "temperature": 0.01, 
+        "do_sample": False, 
+    } 
+    with torch.autocast('cpu', dtype=torch.bfloat16, enabled=precision == 'bf16'):
+        generate_ids = model.generate(**inputs_cat, eos_token_id=processor.tokenizer.eos_token_id, **generation_args)
+    # # remove input tokens 
+    generate_ids = generate_ids[:, inputs_cat['input_ids'].shape[1]:]
+    response = processor.batch_decode(generate_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False)
+    return [res.strip('\n').strip() for res in response]
 
-def get_parsed_content_icon_phi3v(filtered_boxes, ocr_bbox, image_source, caption_model_processor):
-    to_pil = ToPILImage()
-    if ocr_bbox:
-        non_ocr_boxes = filtered_boxes[len(ocr_bbox):]
-    else:
-        non_ocr_boxes = filtered_boxes
-    croped_pil_image = []
-    for i, coord in enumerate(non_ocr_boxes):
-        xmin, xmax = int(coord[0]*image_source.shape[1]), int(coord[2]*image_source.shape[1])
-        ymin, ymax = int(coord[1]*image_source.shape[0]), int(coord[3]*image_source.shape[0])
-        cropped_image = image_source[ymin:ymax, xmin:xmax, :]
-        croped_pil_image.append(to_pil(cropped_image))
 
+def enable_caption_batching(caption_model_processor, max_batch_size=16, max_wait_ms=10):
+    """ Hand the caption model to a background CaptionBatcher shared by all requests.
+        Crops from concurrent requests are then captioned together instead of in per-request batches.
+    """
+    from util.caption_batcher import CaptionBatcher
     model, processor = caption_model_processor['model'], caption_model_processor['processor']
-    device = model.device
-    messages = [{"role": "user", "content": "<|image_1|>\ndescribe the icon in one sentence"}] 
-    prompt = processor.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-
-    batch_size = 5  # Number of samples per batch
-    generated_texts = []
-
-    for i in range(0, len(croped_pil_image), batch_size):
-        images = croped_pil_image[i:i+batch_size]
-        image_inputs = [processor.image_processor(x, return_tensors="pt") for x in images]
-        inputs ={'input_ids': [], 'attention_mask': [], 'pixel_values': [], 'image_sizes': []}
-        texts = [prompt] * len(images)
-        for i, txt in enumerate(texts):
-            input = processor._convert_images_texts_to_inputs(image_inputs[i], txt, return_tensors="pt")
-            inputs['input_ids'].append(input['input_ids'])
-            inputs['attention_mask'].append(input['attention_mask'])
-            inputs['pixel_values'].append(input['pixel_values'])
-            inputs['image_sizes'].append(input['image_sizes'])
-        max_len = max([x.shape[1] for x in inputs['input_ids']])
-        for i, v in enumerate(inputs['input_ids']):
-            inputs['input_ids'][i] = torch.cat([processor.tokenizer.pad_token_id * torch.ones(1, max_len - v.shape[1], dtype=torch.long), v], dim=1)
-            inputs['attention_mask'][i] = torch.cat([torch.zeros(1, max_len - v.shape[1], dtype=torch.long), inputs['attention_mask'][i]], dim=1)
-        inputs_cat = {k: torch.concatenate(v).to(device) for k, v in inputs.items()}
-
-        generation_args = { 
-            "max_new_tokens": 25, 
-            "temperature": 0.01, 
-            "do_sample": False, 
-        } 
-        generate_ids = model.generate(**inputs_cat, eos_token_id=processor.tokenizer.eos_token_id, **generation_args) 
-        # # remove input tokens 
-        generate_ids = generate_ids[:, inputs_cat['input_ids'].shape[1]:]
-        response = processor.batch_decode(generate_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False)
-        response = [res.strip('\n').strip() for res in response]
-        generated_texts.extend(response)
-
-    return generated_texts
-
-def remove_overlap(boxes, iou_threshold, ocr_bbox=None):
-    assert ocr_bbox is None or isinstance(ocr_bbox, List)
+    generate_fn = generate_captions_phi3v if 'phi3_v' in model.config.model_type else generate_captions
+    options = caption_options(caption_model_processor)
+    caption_model_processor['batcher'] = CaptionBatcher(
+        lambda images, prompt: generate_fn(model, processor, images, prompt, **options),
+        max_batch_size=max_batch_size,
+        max_wait_ms=max_wait_ms)
+    return caption_model_processor
 
-    def box_area(box):
-        return (box[2] - box[0]) * (box[3] - box[1])
-
-    def intersection_area(box1, box2):
-        x1 = max(box1[0], box2[0])
-        y1 = max(box1[1], box2[1])
-        x2 = min(box1[2], box2[2])
-        y2 = min(box1[3], box2[3])
-        return max(0, x2 - x1) * max(0, y2 - y1)
-
-    def IoU(box1, box2):
-        intersection = intersection_area(box1, box2)
-        union = box_area(box1) + box_area(box2) - intersection + 1e-6
-        if box_area(box1) > 0 and box_area(box2) > 0:
-            ratio1 = intersection / box_area(box1)
-            ratio2 = intersection / box_area(box2)
+
+def _iter_captioning(caption_model_processor, generate_fn, images, prompt, batch_size):
+    """ Caption images, yielding (indices, captions) for every batch as soon as it is done. """
+    batcher = caption_model_processor.get('batcher')
+    if batcher is not None:
+        # crops go to the shared batcher at once, and come back in the batches it formed
+        futures = {future: i for i, future in enumerate(batcher.submit(images, prompt))}
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            done = sorted(done, key=futures.get)
+            yield [futures[future] for future in done], [future.result() for future in done]
+        return
+    model, processor = caption_model_processor['model'], caption_model_processor['processor']
+    options = caption_options(caption_model_processor)
+    for i in range(0, len(images), batch_size):
+        yield list(range(i, min(i + batch_size, len(images)))), generate_fn(model, processor, images[i:i+batch_size], prompt, **options)
+
+
+def _iter_captions(caption_model_processor, generate_fn, cropped_images, prompt, batch_size, cache, as_pil=False):
+    """ Caption cropped_images (RGB ndarrays) through the caption cache, yielding (indices, captions):
+        the cache hits at once, then only the missing crops, batched into model.generate.
+        as_pil: hand generate_fn PIL images instead of the ndarray crops
+    """
+    keys, cached_captions, miss_idx = lookup_cached_captions(cropped_images, caption_model_id(caption_model_processor), prompt, cache)
+    hits = [i for i, caption in enumerate(cached_captions) if caption is not None]
+    if hits:
+        yield hits, [cached_captions[i] for i in hits]
+    if as_pil:
+        to_pil = ToPILImage()
+        missing = [to_pil(cropped_images[i]) for i in miss_idx]
+    else:
+        missing = [cropped_images[i] for i in miss_idx]
+    for batch_idx, generated_texts in _iter_captioning(caption_model_processor, generate_fn, missing, prompt, batch_size):
+        indices = [miss_idx[j] for j in batch_idx]
+        if cache is not None:
+            for i, caption in zip(indices, generated_texts):
+                cache.put(keys[i], caption)
+        yield indices, generated_texts
+
+
+def iter_parsed_content_icon(filtered_boxes, ocr_bbox, image_source, caption_model_processor, prompt=None, cache=caption_cache):
+    """ get_parsed_content_icon (or its Phi-3-V variant) as a generator, for streaming:
+        yields (icon indices, captions) for the cached icons first, then for every caption batch as it finishes.
+    """
+    cropped_images = crop_icon_images(filtered_boxes, ocr_bbox, image_source)
+    model, processor = caption_model_processor['model'], caption_model_processor['processor']
+    if 'phi3_v' in model.config.model_type:
+        messages = [{"role": "user", "content": "<|image_1|>\ndescribe the icon in one sentence"}] 
+        prompt = processor.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        # Number of samples per batch, unless a shared batcher owns the model
+        return _iter_captions(caption_model_processor, generate_captions_phi3v, cropped_images, prompt, 5, cache, as_pil=True)
+    if not prompt:
+        if 'florence' in model.config.name_or_path:
+            prompt = "<CAPTION>"
         else:
-            ratio1, ratio2 = 0, 0
-        return max(intersection / union, ratio1, ratio2)
+            prompt = "The image shows"
+    return _iter_captions(caption_model_processor, generate_captions, cropped_images, prompt, 10, cache)
+
 
-    boxes = boxes.tolist()
-    filtered_boxes = []
+def _collect_captions(batches, count):
+    parsed_captions = [None] * count
+    for indices, captions in batches:
+        for i, caption in zip(indices, captions):
+            parsed_captions[i] = caption
+    return parsed_captions
+
+
+@timed_stage('caption')
+def get_parsed_content_icon(filtered_boxes, ocr_bbox, image_source, caption_model_processor, prompt=None, cache=caption_cache):
+    """ cache: CaptionCache consulted before captioning, None to always run the model
+    """
+    num_icons = len(filtered_boxes) - (len(ocr_bbox) if ocr_bbox else 0)
+    return _collect_captions(iter_parsed_content_icon(filtered_boxes, ocr_bbox, image_source, caption_model_processor, prompt=prompt, cache=cache), num_icons)
+
+
+@timed_stage('caption')
+def get_parsed_content_icon_phi3v(filtered_boxes, ocr_bbox, image_source, caption_model_processor, cache=caption_cache):
+    num_icons = len(filtered_boxes) - (len(ocr_bbox) if ocr_bbox else 0)
+    return _collect_captions(iter_parsed_content_icon(filtered_boxes, ocr_bbox, image_source, caption_model_processor, cache=cache), num_icons)
+
+def _pairwise_overlap(boxes1, boxes2):
+    """ max(IoU, intersection/area1, intersection/area2) for every pair of xyxy boxes.
+        Returns the (len(boxes1), len(boxes2)) overlap matrix and the areas of both box sets.
+    """
+    area1 = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
+    area2 = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
+    lt = torch.max(boxes1[:, None, :2], boxes2[None, :, :2])
+    rb = torch.min(boxes1[:, None, 2:], boxes2[None, :, 2:])
+    wh = (rb - lt).clamp(min=0)
+    intersection = wh[..., 0] * wh[..., 1]
+    union = area1[:, None] + area2[None, :] - intersection + 1e-6
+    # containment ratios are only defined when both boxes have a positive area
+    valid = (area1[:, None] > 0) & (area2[None, :] > 0)
+    ratio1 = torch.where(valid, intersection / area1[:, None].clamp(min=1e-12), torch.zeros_like(intersection))
+    ratio2 = torch.where(valid, intersection / area2[None, :].clamp(min=1e-12), torch.zeros_like(intersection))
+    return torch.max(torch.max(intersection / union, ratio1), ratio2), area1, area2
+
+
+@timed_stage('remove_overlap')
+def remove_overlap(boxes, iou_threshold, ocr_bbox=None, return_keep=False):
+    """ Drop a box when it overlaps a smaller box, or any ocr box, by more than iou_threshold.
+        boxes: (N, 4) tensor in xyxy format; ocr_bbox: list of xyxy boxes, kept first in the output.
+        return_keep: also return the (N,) bool mask of the kept boxes, e.g. to select their confidences
+    """
+    assert ocr_bbox is None or isinstance(ocr_bbox, List)
+
+    # float64 so the thresholds compare exactly like the python float arithmetic did
+    boxes = torch.as_tensor(boxes).detach().cpu().reshape(-1, 4)
+    boxes64 = boxes.double()
+    overlap, area, _ = _pairwise_overlap(boxes64, boxes64)
+    # the larger box of an overlapping pair is dropped
+    larger = (overlap > iou_threshold) & (area[:, None] > area[None, :])
+    larger.fill_diagonal_(False)
+    keep = ~larger.any(dim=1)
     if ocr_bbox:
-        filtered_boxes.extend(ocr_bbox)
-    # print('ocr_bbox!!!', ocr_bbox)
-    for i, box1 in enumerate(boxes):
-        # if not any(IoU(box1, box2) > iou_threshold and box_area(box1) > box_area(box2) for j, box2 in enumerate(boxes) if i != j):
-        is_valid_box = True
-        for j, box2 in enumerate(boxes):
-            if i != j and IoU(box1, box2) > iou_threshold and box_area(box1) > box_area(box2):
-                is_valid_box = False
-                break
-        if is_valid_box:
-            # add the following 2 lines to include ocr bbox
-            if ocr_bbox:
-                if not any(IoU(box1, box3) > iou_threshold for k, box3 in enumerate(ocr_bbox)):
-                    filtered_boxes.append(box1)
-            else:
-                filtered_boxes.append(box1)
-    return torch.tensor(filtered_boxes)
+        ocr_boxes = torch.tensor(ocr_bbox, dtype=torch.float64).reshape(-1, 4)
+        # ocr boxes always win against icon boxes
+        keep &= ~(_pairwise_overlap(boxes64, ocr_boxes)[0] > iou_threshold).any(dim=1)
+        filtered_boxes = torch.cat([ocr_boxes, boxes64[keep]]).float()
+    else:
+        filtered_boxes = boxes64[keep].float()
+    return (filtered_boxes, keep) if return_keep else filtered_boxes
+
+def load_rgb_image(image) -> Image.Image:
+    """ Accept a file path, a PIL image or an ndarray (RGB, RGBA or grayscale) and return an RGB PIL image.
+        Already decoded images are passed through, so a request decodes its upload only once.
+    """
+    if isinstance(image, np.ndarray):
+        image = Image.fromarray(image)
+    if isinstance(image, Image.Image):
+        return image if image.mode == "RGB" else image.convert("RGB")
+    with stage_timer('decode'):
+        return Image.open(image).convert("RGB")
+
 
 def load_image(image_path: str) -> Tuple[np.array, torch.Tensor]:
     transform = T.Compose(
@@ -227,6 +522,7 @@ def load_image(image_path: str) -> Tuple[np.array, torch.Tensor]:
     return image, image_transformed
 
 
+@timed_stage('annotate')
 def annotate(image_source: np.ndarray, boxes: torch.Tensor, logits: torch.Tensor, phrases: List[str], text_scale: float, 
              text_padding=5, text_thickness=2, thickness=3) -> np.ndarray:
     """    
@@ -243,9 +539,9 @@ def annotate(image_source: np.ndarray, boxes: torch.Tensor, logits: torch.Tensor
     np.ndarray: The annotated image.
     """
     h, w, _ = image_source.shape
+    label_coordinates = get_label_coordinates(boxes, phrases, w, h)
     boxes = boxes * torch.Tensor([w, h, w, h])
     xyxy = box_convert(boxes=boxes, in_fmt="cxcywh", out_fmt="xyxy").numpy()
-    xywh = box_convert(boxes=boxes, in_fmt="cxcywh", out_fmt="xywh").numpy()
     detections = sv.Detections(xyxy=xyxy)
 
     labels = [f"{phrase}" for phrase in range(boxes.shape[0])]
@@ -255,10 +551,28 @@ def annotate(image_source: np.ndarray, boxes: torch.Tensor, logits: torch.Tensor
     annotated_frame = image_source.copy()
     annotated_frame = box_annotator.annotate(scene=annotated_frame, detections=detections, labels=labels, image_size=(w,h))
 
-    label_coordinates = {f"{phrase}": v for phrase, v in zip(phrases, xywh)}
     return annotated_frame, label_coordinates
 
 
+def get_label_coordinates(boxes: torch.Tensor, phrases: List[str], w: int, h: int) -> dict:
+    """ boxes in cxcywh format, ratio scale. Returns {phrase: xywh in pixel scale} without touching any image.
+    """
+    boxes = boxes * torch.Tensor([w, h, w, h])
+    xywh = box_convert(boxes=boxes, in_fmt="cxcywh", out_fmt="xywh").numpy()
+    return {f"{phrase}": v for phrase, v in zip(phrases, xywh)}
+
+
+@timed_stage('encode')
+def encode_image(image: np.ndarray, image_format: str = "PNG", image_quality=None) -> str:
+    """ Encode an RGB ndarray as a base64 string. image_quality applies to lossy formats (JPEG, WEBP).
+    """
+    pil_img = Image.fromarray(image)
+    buffered = io.BytesIO()
+    save_args = {} if image_quality is None else {'quality': int(image_quality)}
+    pil_img.save(buffered, format=image_format, **save_args)
+    return base64.b64encode(buffered.getvalue()).decode('ascii')
+
+
 def predict(model, image, caption, box_threshold, text_threshold):
     """ Use huggingface model to replace the original model
     """
@@ -280,13 +594,86 @@ def predict(model, image, caption, box_threshold, text_threshold):
     return boxes, logits, phrases
 
 
-def predict_yolo(model, image_path, box_threshold, imgsz):
+# Sliced detection: screens larger than YOLO_SLICE_MIN_SIZE are also detected as overlapping tiles of imgsz / YOLO_SLICE_SCALE
+# screen pixels, each resized to imgsz (YOLO_SLICE_SCALE=1: native resolution). Screens larger than YOLO_SLICE_MAX_SIZE are
+# sliced at a lower scale, so they get the tile count of a YOLO_SLICE_MAX_SIZE screen, but never below YOLO_SLICE_MIN_SCALE.
+YOLO_SLICED = os.getenv("YOLO_SLICED", "False").lower() == "true"
+YOLO_SLICE_MIN_SIZE = int(os.getenv("YOLO_SLICE_MIN_SIZE", 1920))
+YOLO_SLICE_MAX_SIZE = int(os.getenv("YOLO_SLICE_MAX_SIZE", 2560))
+YOLO_SLICE_SCALE = float(os.getenv("YOLO_SLICE_SCALE", 1.0))
+YOLO_SLICE_MIN_SCALE = float(os.getenv("YOLO_SLICE_MIN_SCALE", 0.5))
+# overlap of neighbouring tiles in imgsz pixels, tiles per model.predict call
+YOLO_SLICE_OVERLAP = int(os.getenv("YOLO_SLICE_OVERLAP", 128))
+YOLO_SLICE_BATCH = int(os.getenv("YOLO_SLICE_BATCH", 4))
+YOLO_SLICE_NMS_IOU = float(os.getenv("YOLO_SLICE_NMS_IOU", 0.5))
+
+
+def _use_slicing(image, sliced):
+    if sliced is None:
+        sliced = YOLO_SLICED
+    return sliced and max(image.size) > YOLO_SLICE_MIN_SIZE
+
+
+def slice_scale(width, height, scale=YOLO_SLICE_SCALE, max_size=YOLO_SLICE_MAX_SIZE, min_scale=YOLO_SLICE_MIN_SCALE):
+    """ Scale at which the tiles of a width x height screen are detected, see YOLO_SLICE_MAX_SIZE. """
+    return min(scale, max(min_scale, scale * max_size / max(width, height)))
+
+
+def slice_grid(width, height, imgsz, scale=None, overlap=YOLO_SLICE_OVERLAP):
+    """ tile_grid of sliced detection: tiles that cover imgsz pixels once resized by scale (default slice_scale),
+        overlapping by overlap resized pixels.
+    """
+    if scale is None:
+        scale = slice_scale(width, height)
+    return tile_grid(width, height, round(imgsz / scale), round(overlap / scale))
+
+
+def predict_yolo_sliced(model, image, box_threshold, imgsz, scale=None, overlap=YOLO_SLICE_OVERLAP,
+                        nms_iou=YOLO_SLICE_NMS_IOU, batch_size=YOLO_SLICE_BATCH):
+    """ Detect on the full frame resized to imgsz, for elements larger than a tile, and on overlapping tiles
+        (see slice_grid), each resized to imgsz, batch_size images per model.predict call.
+        Tile boxes cut by an inner tile edge are dropped (the neighbouring tile or the full frame has them whole),
+        the rest are shifted to frame coordinates and merged with the full frame boxes by NMS.
+        Returns (boxes, conf) like predict_yolo, in pixel xyxy.
+    """
+    w, h = image.size
+    tiles = slice_grid(w, h, imgsz, scale, overlap)
+    sources = [image] + [image.crop(tuple(tile)) for tile in tiles]
+    results = []
+    # one call for the whole list is slower on CPU than a few small batches
+    for i in range(0, len(sources), max(1, batch_size)):
+        results.extend(model.predict(
+        source=sources[i:i + max(1, batch_size)],
+        conf=box_threshold,
+        imgsz=imgsz
+        ))
+    boxes, conf = [results[0].boxes.xyxy], [results[0].boxes.conf]
+    margin = 1
+    for (x1, y1, x2, y2), result in zip(tiles, results[1:]):
+        xyxy = result.boxes.xyxy
+        cut = ((xyxy[:, 0] <= margin) & (x1 > 0)) | ((xyxy[:, 1] <= margin) & (y1 > 0)) | \
+              ((xyxy[:, 2] >= x2 - x1 - margin) & (x2 < w)) | ((xyxy[:, 3] >= y2 - y1 - margin) & (y2 < h))
+        boxes.append(xyxy[~cut] + torch.tensor([x1, y1, x1, y1], dtype=xyxy.dtype, device=xyxy.device))
+        conf.append(result.boxes.conf[~cut])
+    boxes, conf = torch.cat(boxes), torch.cat(conf)
+    keep = nms(boxes.float(), conf.float(), nms_iou)
+    return boxes[keep], conf[keep]
+
+
+@timed_stage('yolo')
+def predict_yolo(model, image_path, box_threshold, imgsz, sliced=None):
     """ Use huggingface model to replace the original model
+        image_path: file path or decoded PIL image
+        sliced: use predict_yolo_sliced for screens larger than YOLO_SLICE_MIN_SIZE, None to follow YOLO_SLICED
     """
     # model = model['model']
-    
+    image = load_rgb_image(image_path)
+    if _use_slicing(image, sliced):
+        boxes, conf = predict_yolo_sliced(model, image, box_threshold, imgsz)
+        return boxes, conf, [str(i) for i in range(len(boxes))]
+
     result = model.predict(
-    source=image_path,
+    source=image,
     conf=box_threshold,
     imgsz=imgsz
     # iou=0.5, # default 0.7
@@ -298,19 +685,50 @@ def predict_yolo(model, image_path, box_threshold, imgsz):
     return boxes, conf, phrases
 
 
-def get_som_labeled_img(img_path, model=None, BOX_TRESHOLD = 0.01, output_coord_in_ratio=False, ocr_bbox=None, text_scale=0.4, text_padding=5, draw_bbox_config=None, caption_model_processor=None, ocr_text=[], use_local_semantics=True, iou_threshold=0.9,prompt=None,imgsz=640):
-    """ ocr_bbox: list of xyxy format bbox
+@timed_stage('yolo')
+def predict_yolo_batch(model, images, box_threshold, imgsz, sliced=None):
+    """ predict_yolo over a list of decoded images in a single model.predict call.
+        Images large enough for sliced detection get their own predict_yolo_sliced call.
+        Returns one (boxes, conf, phrases) per image, in order.
+    """
+    images = list(images)
+    large = {i for i, image in enumerate(images) if _use_slicing(image, sliced)}
+    small = [i for i in range(len(images)) if i not in large]
+    outputs = [None] * len(images)
+    if small:
+        results = model.predict(
+        source=[images[i] for i in small],
+        conf=box_threshold,
+        imgsz=imgsz
+        )
+        for i, result in zip(small, results):
+            outputs[i] = (result.boxes.xyxy, result.boxes.conf)
+    for i in large:
+        outputs[i] = predict_yolo_sliced(model, images[i], box_threshold, imgsz)
+    return [(boxes, conf, [str(i) for i in range(len(boxes))]) for boxes, conf in outputs]
+
+
+def get_som_labeled_img(img_path, model=None, BOX_TRESHOLD = 0.01, output_coord_in_ratio=False, ocr_bbox=None, text_scale=0.4, text_padding=5, draw_bbox_config=None, caption_model_processor=None, ocr_text=[], use_local_semantics=True, iou_threshold=0.9,prompt=None,imgsz=640, yolo_result=None, output_image=True, image_format="PNG", image_quality=None, return_result=False):
+    """ img_path: file path, PIL image or RGB ndarray
+        ocr_bbox: list of xyxy format bbox
+        yolo_result: (xyxy, logits, phrases) from predict_yolo when detection already ran, see parse_image
+        output_image: False for parse-only mode, the returned encoded_image is then None
+        image_format, image_quality: encoder of the annotated image, e.g. "PNG" or "JPEG" with quality 85
+        return_result: return a util.schema.ParseResult (elements with pixel and ratio boxes, content, confidence,
+            and the encoded image) instead of the (encoded_image, label_coordinates, parsed_content_list) tuple
     """
     TEXT_PROMPT = "clickable buttons on the screen"
     # BOX_TRESHOLD = 0.02 # 0.05/0.02 for web and 0.1 for mobile
     TEXT_TRESHOLD = 0.01 # 0.9 # 0.01
-    image_source = Image.open(img_path).convert("RGB")
+    image_source = load_rgb_image(img_path)
     w, h = image_source.size
     # import pdb; pdb.set_trace()
-    if False: # TODO
+    if yolo_result is not None:
+        xyxy, logits, phrases = yolo_result
+    elif False: # TODO
         xyxy, logits, phrases = predict(model=model, image=image_source, caption=TEXT_PROMPT, box_threshold=BOX_TRESHOLD, text_threshold=TEXT_TRESHOLD)
     else:
-        xyxy, logits, phrases = predict_yolo(model=model, image_path=img_path, box_threshold=BOX_TRESHOLD, imgsz=imgsz)
+        xyxy, logits, phrases = predict_yolo(model=model, image_path=image_source, box_threshold=BOX_TRESHOLD, imgsz=imgsz)
     xyxy = xyxy / torch.Tensor([w, h, w, h]).to(xyxy.device)
     image_source = np.asarray(image_source)
     phrases = [str(i) for i in range(len(phrases))]
@@ -323,8 +741,13 @@ def get_som_labeled_img(img_path, model=None, BOX_TRESHOLD = 0.01, output_coord_
     else:
         print('no ocr bbox!!!')
         ocr_bbox = None
-    filtered_boxes = remove_overlap(boxes=xyxy, iou_threshold=iou_threshold, ocr_bbox=ocr_bbox)
+    filtered_boxes, keep = remove_overlap(boxes=xyxy, iou_threshold=iou_threshold, ocr_bbox=ocr_bbox, return_keep=True)
+    BOXES.observe(len(xyxy), kind='detected')
+    BOXES.observe(len(filtered_boxes), kind='filtered')
     
+    num_text = len(ocr_bbox) if ocr_bbox else 0
+    ocr_text_raw = list(ocr_text)
+    parsed_content_icon = [None] * (len(filtered_boxes) - num_text)
     # get parsed icon local semantics
     if use_local_semantics:
         caption_model = caption_model_processor['model']
@@ -342,28 +765,315 @@ def get_som_labeled_img(img_path, model=None, BOX_TRESHOLD = 0.01, output_coord_
         ocr_text = [f"Text Box ID {i}: {txt}" for i, txt in enumerate(ocr_text)]
         parsed_content_merged = ocr_text
 
+    if return_result:
+        types = ['text'] * num_text + ['icon'] * (len(filtered_boxes) - num_text)
+        contents = ocr_text_raw + list(parsed_content_icon)
+        confidences = [None] * num_text + logits.detach().cpu()[keep].tolist()
+        result_boxes = filtered_boxes
+
     filtered_boxes = box_convert(boxes=filtered_boxes, in_fmt="xyxy", out_fmt="cxcywh")
 
     phrases = [i for i in range(len(filtered_boxes))]
     
-    # draw boxes
-    if draw_bbox_config:
-        annotated_frame, label_coordinates = annotate(image_source=image_source, boxes=filtered_boxes, logits=logits, phrases=phrases, **draw_bbox_config)
+    # draw boxes, only when the annotated image is requested
+    if output_image:
+        if draw_bbox_config:
+            annotated_frame, label_coordinates = annotate(image_source=image_source, boxes=filtered_boxes, logits=logits, phrases=phrases, **draw_bbox_config)
+        else:
+            annotated_frame, label_coordinates = annotate(image_source=image_source, boxes=filtered_boxes, logits=logits, phrases=phrases, text_scale=text_scale, text_padding=text_padding)
+        encoded_image = encode_image(annotated_frame, image_format=image_format, image_quality=image_quality)
     else:
-        annotated_frame, label_coordinates = annotate(image_source=image_source, boxes=filtered_boxes, logits=logits, phrases=phrases, text_scale=text_scale, text_padding=text_padding)
-    
-    pil_img = Image.fromarray(annotated_frame)
-    buffered = io.BytesIO()
-    pil_img.save(buffered, format="PNG")
-    encoded_image = base64.b64encode(buffered.getvalue()).decode('ascii')
+        # parse-only mode: the annotated frame is never allocated, drawn or encoded
+        label_coordinates = get_label_coordinates(filtered_boxes, phrases, w, h)
+        encoded_image = None
+    if return_result:
+        return ParseResult.from_boxes(w, h, types, result_boxes.numpy(), contents, confidences, image=encoded_image)
     if output_coord_in_ratio:
         # h, w, _ = image_source.shape
         label_coordinates = {k: [v[0]/w, v[1]/h, v[2]/w, v[3]/h] for k, v in label_coordinates.items()}
-        assert w == annotated_frame.shape[1] and h == annotated_frame.shape[0]
 
     return encoded_image, label_coordinates, parsed_content_merged
 
 
+# OCR runs here while the calling thread runs icon detection; paddle, easyocr and torch release the GIL in native code
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", 4))
+_parse_executor = ThreadPoolExecutor(max_workers=PARSE_WORKERS, thread_name_prefix='parse')
+
+
+def parse_image(image, model=None, use_paddleocr=False, easyocr_args=None, **kwargs):
+    """ Run check_ocr_box and predict_yolo concurrently, then join them in get_som_labeled_img
+        for overlap removal and captioning. Latency is roughly the max of the two stages instead of their sum.
+        kwargs are passed to get_som_labeled_img; returns its (encoded_image, label_coordinates, parsed_content_list).
+    """
+    image_source = load_rgb_image(image)
+    ocr_future = _parse_executor.submit(
+        check_ocr_box, image_source, display_img=False, output_bb_format='xyxy',
+        easyocr_args=easyocr_args, use_paddleocr=use_paddleocr)
+    yolo_result = predict_yolo(model=model, image_path=image_source, box_threshold=kwargs.get('BOX_TRESHOLD', 0.01), imgsz=kwargs.get('imgsz', 640))
+    (text, ocr_bbox), _ = ocr_future.result()
+    return get_som_labeled_img(image_source, model, ocr_bbox=ocr_bbox, ocr_text=text, yolo_result=yolo_result, **kwargs)
+
+
+def detector_id(model):
+    """ Identifies the detector weights and runtime, for cache keys: the runtime type with the path and mtime of
+        the weights file (onnx file, .pt checkpoint or the safetensors of load_yolo_safetensors).
+    """
+    path = getattr(model, 'onnx_path', None) or getattr(model, 'ckpt_path', None) or getattr(model, 'weights_path', None)
+    mtime = os.path.getmtime(path) if path and os.path.exists(path) else None
+    return f"{type(model).__name__}:{path}:{mtime}"
+
+
+def parse_settings():
+    """ Process-level settings that change parse results without being parse_image arguments, for cache keys.
+    """
+    return dict(yolo_sliced=YOLO_SLICED, yolo_slice_min_size=YOLO_SLICE_MIN_SIZE, yolo_slice_max_size=YOLO_SLICE_MAX_SIZE,
+                yolo_slice_scale=YOLO_SLICE_SCALE, yolo_slice_min_scale=YOLO_SLICE_MIN_SCALE, yolo_slice_overlap=YOLO_SLICE_OVERLAP,
+                yolo_slice_nms_iou=YOLO_SLICE_NMS_IOU, ocr_tiled=OCR_TILED, ocr_tile_size=OCR_TILE_SIZE,
+                ocr_tile_overlap=OCR_TILE_OVERLAP, caption_max_new_tokens=CAPTION_MAX_NEW_TOKENS)
+
+
+def parse_image_stream(image, model=None, caption_model_processor=None, use_paddleocr=False, easyocr_args=None,
+                       BOX_TRESHOLD=0.01, iou_threshold=0.9, imgsz=640, prompt=None, use_local_semantics=True):
+    """ parse_image as a generator of events, for streaming responses (parse-only, no annotated image):
+        {'event': 'elements', 'width', 'height', 'elements'}: every element as soon as remove_overlap is done,
+            same fields as ParseResult.to_dict, with the icon contents still None
+        {'event': 'captions', 'captions': [{'id', 'content'}, ...]}: icon captions, once per caption batch as it finishes
+        {'event': 'done', 'parsed_content'}: the "Text Box ID i" / "Icon Box ID i" lines of the complete result
+    """
+    image_source = load_rgb_image(image)
+    ocr_future = _parse_executor.submit(
+        check_ocr_box, image_source, display_img=False, output_bb_format='xyxy',
+        easyocr_args=easyocr_args, use_paddleocr=use_paddleocr)
+    xyxy, logits, _ = predict_yolo(model=model, image_path=image_source, box_threshold=BOX_TRESHOLD, imgsz=imgsz)
+    (text, ocr_bbox), _ = ocr_future.result()
+
+    w, h = image_source.size
+    scale = torch.Tensor([w, h, w, h])
+    xyxy = xyxy.detach().cpu().float() / scale
+    ocr_bbox = (torch.tensor(ocr_bbox, dtype=torch.float).reshape(-1, 4) / scale).tolist() or None
+    filtered_boxes, keep = remove_overlap(boxes=xyxy, iou_threshold=iou_threshold, ocr_bbox=ocr_bbox, return_keep=True)
+    BOXES.observe(len(xyxy), kind='detected')
+    BOXES.observe(len(filtered_boxes), kind='filtered')
+
+    num_text = len(text)
+    num_icons = len(filtered_boxes) - num_text
+    result = ParseResult.from_boxes(w, h, ['text'] * num_text + ['icon'] * num_icons, filtered_boxes.numpy(),
+                                    list(text) + [None] * num_icons, [None] * num_text + logits.detach().cpu()[keep].tolist())
+    yield dict(event='elements', **result.to_dict(include_image=False))
+
+    if use_local_semantics and num_icons:
+        batches = iter_parsed_content_icon(filtered_boxes, ocr_bbox, np.asarray(image_source), caption_model_processor, prompt=prompt)
+        for indices, captions in batches:
+            for i, caption in zip(indices, captions):
+                result.elements[num_text + i].content = caption
+            yield {'event': 'captions', 'captions': [{'id': num_text + i, 'content': caption} for i, caption in zip(indices, captions)]}
+    yield {'event': 'done', 'parsed_content': '\n'.join(result.parsed_content_list())}
+
+
+# Identical parses running at the same time are run once and shared (see util.single_flight)
+COALESCE_REQUESTS = os.getenv("COALESCE_REQUESTS", "True").lower() == "true"
+parse_flights = SingleFlight() if COALESCE_REQUESTS else None
+
+
+def response_cache_key(image_source, model=None, use_paddleocr=False, easyocr_args=None, **kwargs):
+    """ ResponseCache key of a parse_image call on a decoded image: the pixels with the detector, the OCR engine,
+        the caption model (with its precision and decoding), every get_som_labeled_img keyword argument and the
+        parse_settings of this process.
+        Also identifies identical in-flight parses for request coalescing.
+    """
+    params = {name: value for name, value in kwargs.items() if name != 'caption_model_processor'}
+    caption_model_processor = kwargs.get('caption_model_processor')
+    params.update(
+        detector=detector_id(model),
+        ocr='paddleocr' if use_paddleocr else 'easyocr',
+        easyocr_args=easyocr_args,
+        caption_model=caption_model_id(caption_model_processor) if caption_model_processor is not None else None,
+        settings=parse_settings())
+    return ResponseCache.key(np.asarray(image_source), params)
+
+
+def parse_image_cached(image, model=None, use_paddleocr=False, easyocr_args=None, cache=response_cache, flights=parse_flights, **kwargs):
+    """ parse_image(..., return_result=True) behind a util.response_cache.ResponseCache, see response_cache_key.
+        flights: util.single_flight.SingleFlight sharing one parse between identical concurrent calls, None to disable
+        Returns (ParseResult, cache status): 'memory' or 'disk' for a hit, 'coalesced' when the result of an identical
+        parse in progress was shared, 'miss', or 'bypass' when the cache is disabled.
+    """
+    cache = cache if cache is not None and cache.enabled else None
+    if cache is None and flights is None:
+        return parse_image(image, model, use_paddleocr=use_paddleocr, easyocr_args=easyocr_args, return_result=True, **kwargs), 'bypass'
+    image_source = load_rgb_image(image)
+    key = response_cache_key(image_source, model, use_paddleocr=use_paddleocr, easyocr_args=easyocr_args, **kwargs)
+    if cache is not None:
+        result, tier = cache.get(key)
+        if result is not None:
+            return result, tier
+
+    def parse():
+        result = parse_image(image_source, model, use_paddleocr=use_paddleocr, easyocr_args=easyocr_args, return_result=True, **kwargs)
+        if cache is not None:
+            cache.put(key, result)
+        return result
+
+    if flights is None:
+        return parse(), 'miss'
+    result, shared = flights.do(key, parse)
+    return result, 'coalesced' if shared else ('miss' if cache is not None else 'bypass')
+
+
+def _capture(fn, *args, **kwargs):
+    try:
+        return fn(*args, **kwargs)
+    except Exception as e:
+        return e
+
+
+def parse_images(images, model=None, caption_model_processor=None, use_paddleocr=False, easyocr_args=None, **kwargs):
+    """ parse_image for many screenshots at once:
+        the images are decoded in parallel, icon detection runs over the whole list in one model.predict call,
+        OCR runs on the parse worker pool, and the icon crops of all images share the same caption batches.
+        Returns one entry per image, either the get_som_labeled_img tuple or the Exception raised for that image.
+    """
+    results = list(_parse_executor.map(lambda image: _capture(load_rgb_image, image), images))
+    ok = [i for i, result in enumerate(results) if not isinstance(result, Exception)]
+    decoded = {i: results[i] for i in ok}
+    ocr_futures = {i: _parse_executor.submit(
+        _capture, check_ocr_box, decoded[i], display_img=False, output_bb_format='xyxy',
+        easyocr_args=easyocr_args, use_paddleocr=use_paddleocr) for i in ok}
+
+    box_threshold, imgsz = kwargs.get('BOX_TRESHOLD', 0.01), kwargs.get('imgsz', 640)
+    try:
+        yolo_results = predict_yolo_batch(model, [decoded[i] for i in ok], box_threshold, imgsz) if ok else []
+    except Exception:
+        # fall back to one call per image so a single bad image only fails itself
+        yolo_results = [_capture(predict_yolo, model, decoded[i], box_threshold, imgsz) for i in ok]
+
+    # a temporary batcher pools the crops of every image into shared caption batches
+    own_batcher = caption_model_processor is not None and kwargs.get('use_local_semantics', True) and 'batcher' not in caption_model_processor
+    if own_batcher:
+        caption_model_processor = enable_caption_batching(dict(caption_model_processor))
+
+    def finish(i, yolo_result):
+        ocr_result = ocr_futures[i].result()
+        if isinstance(ocr_result, Exception):
+            return ocr_result
+        if isinstance(yolo_result, Exception):
+            return yolo_result
+        (text, ocr_bbox), _ = ocr_result
+        return _capture(get_som_labeled_img, decoded[i], model, ocr_bbox=ocr_bbox, ocr_text=text, yolo_result=yolo_result,
+                        caption_model_processor=caption_model_processor, **kwargs)
+
+    try:
+        # separate pool: these tasks wait on the ocr futures queued on _parse_executor
+        with ThreadPoolExecutor(max_workers=max(1, min(len(ok), 16)), thread_name_prefix='parse-batch') as pool:
+            for i, result in zip(ok, pool.map(finish, ok, yolo_results)):
+                results[i] = result
+    finally:
+        if own_batcher:
+            caption_model_processor['batcher'].close()
+    return results
+
+
+# Last frame and elements of each session for parse_image_incremental, per process
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", 256))
+_sessions = LRUCache(SESSION_CACHE_SIZE)
+
+
+def _parse_regions(image_source, regions, model, caption_model_processor, use_paddleocr=False, easyocr_args=None,
+                   box_threshold=0.01, iou_threshold=0.9, imgsz=640, prompt=None, use_local_semantics=True):
+    """ OCR, icon detection, overlap removal and captioning restricted to regions (pixel xyxy) of an RGB ndarray.
+        Returns the text elements then the icon elements, as dicts with a ratio xyxy 'bbox'.
+    """
+    h, w, _ = image_source.shape
+    crops = [np.ascontiguousarray(image_source[y1:y2, x1:x2]) for x1, y1, x2, y2 in regions]
+    ocr_futures = [_parse_executor.submit(
+        check_ocr_box, crop, display_img=False, output_bb_format='xyxy',
+        easyocr_args=easyocr_args, use_paddleocr=use_paddleocr) for crop in crops]
+    yolo_results = predict_yolo_batch(model, [Image.fromarray(crop) for crop in crops], box_threshold, imgsz)
+
+    scale = torch.Tensor([w, h, w, h])
+    texts, icon_boxes, icon_conf = [], [], []
+    for (x1, y1, _, _), ocr_future, (xyxy, conf, _) in zip(regions, ocr_futures, yolo_results):
+        (text, ocr_bbox), _ = ocr_future.result()
+        offset = torch.Tensor([x1, y1, x1, y1])
+        ocr_ratio = ((torch.tensor(ocr_bbox, dtype=torch.float).reshape(-1, 4) + offset) / scale).tolist()
+        xyxy_ratio = (xyxy.detach().cpu().float() + offset) / scale
+        # overlap removal stays local: boxes of different regions never intersect
+        filtered_boxes, keep = remove_overlap(boxes=xyxy_ratio, iou_threshold=iou_threshold, ocr_bbox=ocr_ratio or None, return_keep=True)
+        texts.extend({'type': 'text', 'bbox': box, 'content': txt, 'confidence': None} for txt, box in zip(text, ocr_ratio))
+        icon_boxes.extend(filtered_boxes[len(ocr_ratio):].tolist())
+        icon_conf.extend(conf.detach().cpu()[keep].tolist())
+
+    icon_contents = [None] * len(icon_boxes)
+    if use_local_semantics and icon_boxes:
+        boxes = torch.tensor(icon_boxes)
+        if 'phi3_v' in caption_model_processor['model'].config.model_type:
+            icon_contents = get_parsed_content_icon_phi3v(boxes, None, image_source, caption_model_processor)
+        else:
+            icon_contents = get_parsed_content_icon(boxes, None, image_source, caption_model_processor, prompt=prompt)
+    return texts + [{'type': 'icon', 'bbox': box, 'content': txt, 'confidence': c}
+                    for box, txt, c in zip(icon_boxes, icon_contents, icon_conf)]
+
+
+def parse_image_incremental(image, session_id, model=None, caption_model_processor=None, use_paddleocr=False, easyocr_args=None,
+                            BOX_TRESHOLD=0.01, iou_threshold=0.9, imgsz=640, prompt=None, use_local_semantics=True,
+                            output_coord_in_ratio=False, block_size=32, max_dirty_ratio=0.5, return_result=False):
+    """ Session-aware parse of consecutive screenshots, e.g. the frames of a GUI agent trace.
+        The frame is diffed block by block against the previous frame of session_id; OCR, detection and captioning
+        only run on the changed regions (grown to cover every element they cut), the other elements are reused.
+        A full parse runs for the first frame, after a resolution or parameter change, or when more than
+        max_dirty_ratio of the blocks changed. Parse-only: no annotated image is drawn.
+        Returns (label_coordinates, parsed_content_list, delta) where delta is
+        {'added': [elements], 'removed': [uids], 'reused': count}, elements being dicts of uid, type, bbox (ratio xyxy), content
+        and confidence. With return_result, returns (util.schema.ParseResult, delta) instead.
+    """
+    image_source = np.asarray(load_rgb_image(image))
+    h, w, _ = image_source.shape
+    params = (BOX_TRESHOLD, iou_threshold, imgsz, bool(use_paddleocr), prompt, use_local_semantics)
+    state = _sessions.get(session_id)
+
+    regions, kept = [[0, 0, w, h]], []
+    if state is not None and state['params'] == params and state['image'].shape == image_source.shape:
+        with stage_timer('diff'):
+            mask = dirty_block_mask(state['image'], image_source, block_size)
+        if mask.mean() <= max_dirty_ratio:
+            scale = (w, h, w, h)
+            boxes = [[v * s for v, s in zip(element['bbox'], scale)] for element in state['elements']]
+            regions = expand_regions(dirty_regions(mask, block_size, (w, h)), boxes)
+            kept = [element for element, box in zip(state['elements'], boxes)
+                    if not any(boxes_intersect(region, box) for region in regions)]
+
+    next_uid = state['next_uid'] if state is not None else 0
+    added = _parse_regions(image_source, regions, model, caption_model_processor, use_paddleocr, easyocr_args,
+                           BOX_TRESHOLD, iou_threshold, imgsz, prompt, use_local_semantics) if regions else []
+    for element in added:
+        element['uid'] = next_uid
+        next_uid += 1
+    kept_uids = {element['uid'] for element in kept}
+    removed = [element['uid'] for element in state['elements'] if element['uid'] not in kept_uids] if state is not None else []
+
+    # same ordering as get_som_labeled_img: text boxes first, then icon boxes
+    elements = [e for e in kept + added if e['type'] == 'text'] + [e for e in kept + added if e['type'] == 'icon']
+    _sessions.put(session_id, {'image': image_source, 'elements': elements, 'params': params, 'next_uid': next_uid})
+
+    delta = {'added': added, 'removed': removed, 'reused': len(kept)}
+    if return_result:
+        result = ParseResult.from_boxes(w, h, [e['type'] for e in elements], [e['bbox'] for e in elements],
+                                        [e['content'] for e in elements], [e['confidence'] for e in elements])
+        return result, delta
+
+    parsed_content_list = []
+    for i, element in enumerate(elements):
+        if element['type'] == 'text':
+            parsed_content_list.append(f"Text Box ID {i}: {element['content']}")
+        elif use_local_semantics:
+            parsed_content_list.append(f"Icon Box ID {i}: {element['content']}")
+    boxes = torch.tensor([element['bbox'] for element in elements], dtype=torch.float).reshape(-1, 4)
+    label_coordinates = get_label_coordinates(box_convert(boxes=boxes, in_fmt="xyxy", out_fmt="cxcywh"), list(range(len(elements))), w, h)
+    if output_coord_in_ratio:
+        label_coordinates = {k: [v[0]/w, v[1]/h, v[2]/w, v[3]/h] for k, v in label_coordinates.items()}
+    return label_coordinates, parsed_content_list, delta
+
+
 def get_xywh(input):
     x, y, w, h = input[0][0], input[0][1], input[2][0] - input[0][0], input[2][1] - input[0][1]
     x, y, w, h = int(x), int(y), int(w), int(h)
@@ -381,22 +1091,37 @@ def get_xywh_yolo(input):
     
 
 
-def check_ocr_box(image_path, display_img = True, output_bb_format='xywh', goal_filtering=None, easyocr_args=None, use_paddleocr=False):
-    if use_paddleocr:
-        result = paddle_ocr.ocr(image_path, cls=False)[0]
+@timed_stage('ocr')
+def check_ocr_box(image_path, display_img = True, output_bb_format='xywh', goal_filtering=None, easyocr_args=None, use_paddleocr=False, tiled=None):
+    """ image_path: file path, PIL image or RGB ndarray
+        tiled: OCR images larger than OCR_TILE_SIZE as overlapping tiles in a process pool, None to follow OCR_TILED
+    """
+    image_np = np.asarray(load_rgb_image(image_path))
+    if tiled is None:
+        tiled = OCR_TILED
+    if tiled and max(image_np.shape[:2]) > OCR_TILE_SIZE:
+        coord, text = tiled_ocr(image_np, use_paddleocr=use_paddleocr, easyocr_args=easyocr_args)
+    elif use_paddleocr:
+        # paddleocr expects the BGR layout it would get from cv2.imread
+        with get_ocr_pool(use_paddleocr=True).checkout() as paddle_ocr:
+            # [None] when the image holds no text, e.g. a small changed region
+            result = paddle_ocr.ocr(cv2.cvtColor(image_np, cv2.COLOR_RGB2BGR), cls=False)[0] or []
         coord = [item[0] for item in result]
         text = [item[1][0] for item in result]
     else:  # EasyOCR
         if easyocr_args is None:
             easyocr_args = {}
-        result = reader.readtext(image_path, **easyocr_args)
+        with get_ocr_pool(use_paddleocr=False).checkout() as reader:
+            if isinstance(image_path, str):
+                # from the file itself, as readtext always did: its grey read of transparent PNGs differs slightly
+                result = reader.readtext(image_path, **easyocr_args)
+            else:
+                result = easyocr_readtext(reader, image_np, **easyocr_args)
         # print('goal filtering pred:', result[-5:])
         coord = [item[0] for item in result]
         text = [item[1] for item in result]
-    # read the image using cv2
     if display_img:
-        opencv_img = cv2.imread(image_path)
-        opencv_img = cv2.cvtColor(opencv_img, cv2.COLOR_RGB2BGR)
+        opencv_img = image_np.copy()
         bb = []
         for item in coord:
             x, y, a, b = get_xywh(item)
@@ -412,6 +1137,7 @@ def check_ocr_box(image_path, display_img = True, output_bb_format='xywh', goal_
         elif output_bb_format == 'xyxy':
             bb = [get_xyxy(item) for item in coord]
         # print('bounding box!!!', bb)
+    OCR_LINES.observe(len(text))
     return (text, bb), goal_filtering
 
 